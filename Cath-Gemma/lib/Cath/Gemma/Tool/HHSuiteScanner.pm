@@ -14,6 +14,7 @@ use Carp                qw/ confess                  /;
 use English             qw/ -no_match_vars           /;
 use File::Copy          qw/ copy move                /;
 use FindBin;
+use IO::Socket::UNIX;
 use Time::HiRes         qw/ gettimeofday tv_interval /;
 use v5.10;
 
@@ -160,10 +161,137 @@ sub hhsuite_scan {
 
 
 
+=head2 _embedding_distance_file
+
+Get the distance file to use for embedding scans of the profiles in the specified directory
+
+This is the global "embs" file in the working directory, unless there is also
+an "embs.manifest" there (as written by split_distances_by_project.py) that lists
+a text distance file for the project (the name of the profile directory), in
+which case it is that file, which only holds the pairs within the project.
+A manifest entry for the project in any other format is skipped with a warning.
+
+=cut
+
+sub _embedding_distance_file {
+	state $check = compile( ClassName, Path );
+	my ( $class, $profile_dir ) = $check->( @ARG );
+
+	my $manifest_file = path( 'embs.manifest' );
+	if ( -e $manifest_file ) {
+		my $project = $profile_dir->basename();
+		foreach my $line ( $manifest_file->lines( { chomp => 1 } ) ) {
+			my ( $manifest_project, $dist_file, $format ) = split( /\t/, $line );
+			if ( defined( $format ) && $manifest_project eq $project ) {
+				if ( $format eq 'text' ) {
+					return path( $dist_file )->absolute( $manifest_file->parent() )->stringify();
+				}
+				WARN "Skipping $dist_file in $manifest_file for project $project: it is in $format format, not text";
+			}
+		}
+	}
+	return 'embs';
+}
+
+=head2 _embedding_profile_protids
+
+Get the protein IDs in the specified cluster's profile file (its lines that contain a '/')
+
+=cut
+
+sub _embedding_profile_protids {
+	state $check = compile( ClassName, Path, Str, CathGemmaHHSuiteProfileType );
+	my ( $class, $profile_dir, $cluster_id, $profile_build_type ) = $check->( @ARG );
+
+	my $prof_file = prof_file_of_prof_dir_and_cluster_id( $profile_dir, $cluster_id, $profile_build_type );
+	my @protids;
+	open(my $fh, "<", $prof_file)
+		or die "cannot open $prof_file";
+	while (my $line = <$fh>) {
+		if ($line =~ m{/}) {
+			$line =~ s/\s*$//;
+			push(@protids, $line);
+		}
+	}
+	return \@protids;
+}
+
+=head2 _embedding_server_scan
+
+Get the embedding scan results from the distance server (serve_distances.py) listening on the
+Unix socket named by the CATH_EMMA_DISTANCE_SERVER environment variable, if there is one
+
+This returns undef if the variable isn't set or nothing is listening on the socket, so the caller
+can fall back to reading the distance file itself
+
+=cut
+
+sub _embedding_server_scan {
+	state $check = compile( ClassName, Path, ArrayRef[Str], ArrayRef[Str], CathGemmaHHSuiteProfileType );
+	my ( $class, $profile_dir, $query_cluster_ids, $match_cluster_ids, $profile_build_type ) = $check->( @ARG );
+
+	my $socket_path = $ENV{ CATH_EMMA_DISTANCE_SERVER };
+	if ( ! defined( $socket_path ) || ! -S $socket_path ) {
+		return undef;
+	}
+	my $socket = IO::Socket::UNIX->new( Type => SOCK_STREAM(), Peer => $socket_path );
+	if ( ! defined( $socket ) ) {
+		WARN "Cannot connect to the distance server at $socket_path ($OS_ERROR): reading the distance file instead";
+		return undef;
+	}
+
+	my %protids_of_cluster = map {
+		( $ARG => __PACKAGE__->_embedding_profile_protids( $profile_dir, $ARG, $profile_build_type ) );
+	} ( @$query_cluster_ids, @$match_cluster_ids );
+
+	my @cluster_pairs;
+	for my $query_cluster_id ( @$query_cluster_ids ) {
+		for my $match_cluster_id ( @$match_cluster_ids ) {
+			push( @cluster_pairs, [ $query_cluster_id, $match_cluster_id ] );
+		}
+	}
+
+	# Send the queries in batches, reading each batch's responses before sending
+	# the next, so that neither end blocks on a full socket buffer
+	my $batch_size = 100;
+	my @embedding_diff_results = ();
+	for ( my $batch_start = 0; $batch_start < scalar( @cluster_pairs ); $batch_start += $batch_size ) {
+		my $batch_end = $batch_start + $batch_size < scalar( @cluster_pairs ) ? $batch_start + $batch_size : scalar( @cluster_pairs );
+		my @batch = @cluster_pairs[ $batch_start .. ( $batch_end - 1 ) ];
+		foreach my $cluster_pair ( @batch ) {
+			my ( $query_cluster_id, $match_cluster_id ) = @$cluster_pair;
+			print $socket join( "\t",
+				'AVG',
+				join( ' ', @{ $protids_of_cluster{ $query_cluster_id } } ),
+				join( ' ', @{ $protids_of_cluster{ $match_cluster_id } } ),
+			) . "\n";
+		}
+		$socket->flush();
+		foreach my $cluster_pair ( @batch ) {
+			my $response = <$socket>;
+			if ( ! defined( $response ) ) {
+				confess "Distance server at $socket_path closed the connection";
+			}
+			chomp( $response );
+			my ( $status, $aver_dist ) = split( /\t/, $response, 2 );
+			if ( $status ne 'OK' ) {
+				confess "Distance server at $socket_path failed a request for $cluster_pair->[ 0 ] vs $cluster_pair->[ 1 ]: $aver_dist";
+			}
+			push( @embedding_diff_results, [ @$cluster_pair, $aver_dist ] );
+		}
+	}
+	close( $socket );
+
+	return Cath::Gemma::Scan::ScanData->new( scan_data => \@embedding_diff_results );
+}
+
 =head2 _embedding_scan_impl
 
 Function to get the scan files from embedding or other distance metric
 
+The distances come from the distance server if one is running (see _embedding_server_scan()),
+otherwise from the distance file (see _embedding_distance_file())
+
 =cut
 
 sub _embedding_scan_impl {
@@ -180,35 +308,29 @@ sub _embedding_scan_impl {
 		$profile_build_type
 	);
 
+	my $server_scan_data = __PACKAGE__->_embedding_server_scan(
+		$profile_dir,
+		$query_cluster_ids,
+		$match_cluster_ids,
+		$profile_build_type
+	);
+	if ( defined( $server_scan_data ) ) {
+		return $server_scan_data;
+	}
+
+	# get all the protein IDs from the query and match profiles, as for the server
+	my %protids_of_cluster = map {
+		( $ARG => __PACKAGE__->_embedding_profile_protids( $profile_dir, $ARG, $profile_build_type ) );
+	} ( @$query_cluster_ids, @$match_cluster_ids );
+
 	# search individual query alignments against the library of match profiles
 	my @all_scan_data;
 	my @embedding_diff_results = ();
 	my %dist_scores_by_query_match = ();
 	for my $query_cluster_id ( @$query_cluster_ids ) {
-		# Set up @query_protids and get all the protein IDs from the query profile
-		my $query_prof_file = prof_file_of_prof_dir_and_cluster_id( $profile_dir, $query_cluster_id, $profile_build_type );
-		my @query_protids;
-		my $delim="/";
-		open(my $fh, "<", $query_prof_file)
-			or die "cannot open $query_prof_file";
-		while (my $line = <$fh>) {
-			if ($line =~ m/$delim/) {
-				$line =~ s/\s*$//;
-				push(@query_protids, $line);
-			}
-		}
+		my @query_protids = @{ $protids_of_cluster{ $query_cluster_id } };
 	for my $match_cluster_id ( @$match_cluster_ids ) {
-			my $match_prof_file = prof_file_of_prof_dir_and_cluster_id( $profile_dir, $match_cluster_id, $profile_build_type );
-			my @match_protids;
-			my $delim="/";
-			open(my $fh, "<", $match_prof_file)
-				or die "cannot open $match_prof_file";
-			while (my $line = <$fh>) {
-				if ($line =~ m/$delim/) {
-					$line =~ s/\s*$//;
-					push(@match_protids, $line);
-				}
-			}
+			my @match_protids = @{ $protids_of_cluster{ $match_cluster_id } };
 
 			for my $match_protid (@match_protids) {
 			    for my $query_protid (@query_protids) {
@@ -222,45 +344,37 @@ sub _embedding_scan_impl {
 
 
 	# search through file for any matches and store distance scores
+	# (a sparse file starts with a "#missing_distance <dist>" line giving the distance of the pairs it leaves out)
 	my $dist_sum;
 	my $dist_num;
-	open (my $df, "<", "embs")
-		or die "cannot open embedding distance file";
+	my $missing_dist;
+	my $dist_file = __PACKAGE__->_embedding_distance_file( $profile_dir );
+	open (my $df, "<", $dist_file)
+		or die "cannot open embedding distance file $dist_file";
 	while (my $dist_line = <$df>){
+		if ( $dist_line =~ /^#missing_distance\s+(\S+)/ ) {
+			$missing_dist = $1;
+			next;
+		}
 		my ($query_id, $match_id, $dist) = split(' ', $dist_line);
 		if (exists $dist_scores_by_query_match{$query_id}{$match_id}) {
 			$dist_scores_by_query_match{$query_id}{$match_id} = $dist;
 			$dist_scores_by_query_match{$match_id}{$query_id} = $dist;
 		}
 	}
+	if ( defined( $missing_dist ) ) {
+		foreach my $dists_of_query ( values( %dist_scores_by_query_match ) ) {
+			foreach my $dist ( values( %$dists_of_query ) ) {
+				$dist //= $missing_dist;
+			}
+		}
+	}
 
 
 	for my $query_cluster_id ( @$query_cluster_ids ) {
-		# Set up @query_protids and get all the protein IDs from the query profile
-		my $query_prof_file = prof_file_of_prof_dir_and_cluster_id( $profile_dir, $query_cluster_id, $profile_build_type );
-		my @query_protids;
-		my $delim="/";
-		open(my $fh, "<", $query_prof_file)
-			or die "cannot open $query_prof_file";
-		while (my $line = <$fh>) {
-			if ($line =~ m/$delim/) {
-				$line =~ s/\s*$//;
-				push(@query_protids, $line);
-			}
-		}
+		my @query_protids = @{ $protids_of_cluster{ $query_cluster_id } };
 		for my $match_cluster_id ( @$match_cluster_ids ) {
-				my $match_prof_file = prof_file_of_prof_dir_and_cluster_id( $profile_dir, $match_cluster_id, $profile_build_type );
-				# open match profile file and get sequence ids
-				my @match_protids;
-				my $delim="/";
-				open(my $fh, "<", $match_prof_file)
-					or die "cannot open $match_prof_file";
-				while (my $line = <$fh>) {
-					if ($line =~ m/$delim/) {
-						$line =~ s/\s*$//;
-						push(@match_protids, $line);
-					}
-				}
+				my @match_protids = @{ $protids_of_cluster{ $match_cluster_id } };
 
 				my $dist_sum;
 				my $dist_num;
@@ -1,16 +1,45 @@
+import importlib
 import logging
 import click
 
-from .commands import calculate_esm_embeddings
-from .commands import convert_fasta_to_csv
-
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s"
 )
 
 LOG = logging.getLogger(__name__)
 
-@click.group()
+# command name -> "module:function" of each subcommand. A command's module is
+# only imported when it is run or listed, and the command modules leave their
+# heavy imports (torch, esm, pandas...) until the command actually runs, so
+# that light commands and --help start quickly
+SUBCOMMANDS = {
+    "benchmark-esm-to-embed": "cath_emma.commands.benchmark_esm_embeddings:benchmark_esm_to_embed",
+    "calculate-esm-to-embed": "cath_emma.commands.calculate_esm_embeddings:calculate_esm_to_embed",
+    "convert-fasta-to-csv-for-embed": "cath_emma.commands.convert_fasta_to_csv:convert_fasta_to_csv_for_embed",
+    "merge-esm-embeddings": "cath_emma.commands.merge_esm_embeddings:merge_esm_embeddings",
+    "serve-esm-embed": "cath_emma.commands.serve_esm_embeddings:serve_esm_embed",
+}
+
+
+class LazyGroup(click.Group):
+    """Click group that imports each of its `lazy_subcommands` on first use"""
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            module_name, function_name = self.lazy_subcommands[cmd_name].split(":")
+            command = getattr(importlib.import_module(module_name), function_name)
+            self.add_command(command, cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+
+@click.group(cls=LazyGroup, lazy_subcommands=SUBCOMMANDS)
 @click.version_option()
 @click.option("--verbose", "-v", "verbosity", default=0, count=True)
 @click.pass_context
@@ -23,6 +52,3 @@ def cli(ctx, verbosity):
     LOG.info(
         f"Starting logging... (level={logging.getLevelName(root_logger.getEffectiveLevel())})"
     )
-
-cli.add_command(calculate_esm_embeddings.calculate_esm_to_embed)
-cli.add_command(convert_fasta_to_csv.convert_fasta_to_csv_for_embed)
\ No newline at end of file
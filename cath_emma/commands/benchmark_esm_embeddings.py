@@ -0,0 +1,90 @@
+import logging
+import random
+import time
+
+import click
+
+from ..defaults import ESM_MODEL_NAMES, PRECISIONS
+
+LOG = logging.getLogger(__name__)
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+@click.command()
+@click.option(
+    "--input_sequence_csv",
+    type=click.File("rt"),
+    required=False,
+    help="Input: CSV file of 'label,sequence' to benchmark with (default: random sequences)",
+)
+@click.option(
+    "--esm_model",
+    type=click.Choice(ESM_MODEL_NAMES),
+    default="esm2",
+    help=f"ESM model to benchmark (default: ESM2)",
+)
+@click.option(
+    "--num_sequences",
+    type=int,
+    default=256,
+    help=f"Number of sequences to embed in each run (default: 256)",
+)
+@click.option(
+    "--workers",
+    type=str,
+    default="1,2,4,8",
+    help=f"Comma-separated numbers of worker processes to compare (default: 1,2,4,8)",
+)
+@click.option(
+    "--threads_per_worker",
+    type=int,
+    default=1,
+    help=f"Number of torch threads for each worker process (default: 1)",
+)
+@click.option(
+    "--max_tokens_per_batch",
+    type=int,
+    default=4096,
+    help=f"Token budget for each length-sorted batch (default: 4096)",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    default="fp32",
+    help=f"Numeric precision of the forward pass (default: fp32)",
+)
+def benchmark_esm_to_embed(input_sequence_csv, esm_model, num_sequences, workers, threads_per_worker, max_tokens_per_batch, precision):
+    """
+    Measure how embedding throughput scales with the number of worker processes
+
+    Each timing includes starting the workers, as in a real run.
+    """
+    import pandas as pd
+    from ..embeddings import load_esm_model, token_budget_batches
+    from ..parallel_embedding import embed_batches_in_parallel
+
+    if input_sequence_csv:
+        df = pd.read_csv(input_sequence_csv, names=['label', 'sequence']).head(num_sequences)
+        pairs = list(zip(df['label'], df['sequence']))
+    else:
+        # domain-like lengths between 40 and 500 residues
+        rng = random.Random(2023)
+        pairs = [
+            (f"seq{idx}", "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(40, 500))))
+            for idx in range(num_sequences)
+        ]
+
+    model, alphabet = load_esm_model(esm_model)
+    batch_idxs = token_budget_batches([len(seq) for _, seq in pairs], max_tokens_per_batch)
+    batches = [[pairs[idx] for idx in idxs] for idxs in batch_idxs]
+
+    click.echo(f"{'workers':>8} {'threads':>8} {'seconds':>9} {'seqs/sec':>9} {'speedup':>8}")
+    baseline = None
+    for num_workers in (int(value) for value in workers.split(',')):
+        start = time.perf_counter()
+        for _ in embed_batches_in_parallel(model, alphabet, batches, [(model.num_layers, "mean")], num_workers=num_workers, threads_per_worker=threads_per_worker, precision=precision):
+            pass
+        seconds = time.perf_counter() - start
+        rate = len(pairs) / seconds
+        baseline = baseline or rate
+        click.echo(f"{num_workers:>8} {threads_per_worker:>8} {seconds:>9.2f} {rate:>9.2f} {rate / baseline:>8.2f}")
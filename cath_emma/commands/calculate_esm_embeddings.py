@@ -1,29 +1,112 @@
-import pandas as pd
-import esm
-import torch
 import click
-from torch.utils.data import DataLoader, Dataset
-from tqdm import tqdm
+import logging
 import os
 
+from ..defaults import DEFAULT_SHARD_SIZE, DEFAULT_WINDOW_OVERLAP, ESM_MODEL_NAMES, POOLINGS, PRECISIONS
+from ..embedding_server import DEFAULT_SOCKET_ENVVAR, submit_embedding_job
+
+LOG = logging.getLogger(__name__)
+
 @click.command()
 @click.option(
     "--input_sequence_csv",
-    type=click.File("rt"),
+    type=click.Path(exists=True, dir_okay=False),
     required=True,
-    help="Input: CSV file containing protein sequences in the format 'label,sequence'",
+    help="Input: CSV file containing protein sequences in the format 'label,sequence' (or a FASTA file)",
 )
 @click.option(
     "--esm_model",
-    type=click.Choice(["esm1v","esm1b","esm2_3b","esm2","esm2_15b"]),
+    type=click.Choice(ESM_MODEL_NAMES),
     default="esm2",
     help=f"ESM model used to generate embeddings (default: ESM2)",
 )
 @click.option(
     "--embeddings_output",
-    type=click.File("wt"),
+    type=click.Path(),
     required=True,
-    help=f"Output: Torch .pt file with embeddings",
+    help=f"Output: Torch .pt file with embeddings (or a directory for --output_format shards)",
+)
+@click.option(
+    "--repr_layers",
+    type=int,
+    multiple=True,
+    help=f"Layer to take representations from; repeat for several layers from one forward pass, negative values count back from the last layer (default: the model's last layer)",
+)
+@click.option(
+    "--pooling",
+    "poolings",
+    type=click.Choice(POOLINGS),
+    multiple=True,
+    help=f"How to pool the residue representations of each layer into one vector; repeat for several (default: mean)",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(["pt", "shards"]),
+    default="pt",
+    help=f"Write one Torch .pt list at the end, or stream float32 .npy shards (one matrix per layer and pooling) plus labels as batches finish (default: pt)",
+)
+@click.option(
+    "--shard_size",
+    type=int,
+    default=DEFAULT_SHARD_SIZE,
+    help=f"Number of embeddings per .npy shard for --output_format shards (default: {DEFAULT_SHARD_SIZE})",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help=f"Continue an interrupted --output_format shards run, skipping labels that are already written",
+)
+@click.option(
+    "--slice",
+    "input_slice",
+    type=str,
+    default=None,
+    callback=lambda ctx, param, value: parse_slice(value),
+    help=f"Only embed slice I of N (0-based, e.g. '2/8') of the input CSV, so that several workers can share one input",
+)
+@click.option(
+    "--embedding_cache",
+    type=click.Path(dir_okay=False),
+    default=None,
+    envvar="CATH_EMMA_EMBEDDING_CACHE",
+    help=f"SQLite file of embeddings keyed by model, layer and sequence MD5: only sequences missing from it are run through ESM (default: $CATH_EMMA_EMBEDDING_CACHE, if set)",
+)
+@click.option(
+    "--num_workers",
+    type=int,
+    default=0,
+    help=f"Run the model in this many CPU worker processes sharing one copy of the weights (default: 0, embed in this process)",
+)
+@click.option(
+    "--threads_per_worker",
+    type=int,
+    default=None,
+    help=f"Number of torch threads for each worker process (default: the available CPUs split evenly between the workers)",
+)
+@click.option(
+    "--max_window_length",
+    type=int,
+    default=None,
+    help=f"Embed sequences longer than this as overlapping windows combined into one length-weighted vector (default: the model's limit, if it has one, otherwise off)",
+)
+@click.option(
+    "--window_overlap",
+    type=int,
+    default=DEFAULT_WINDOW_OVERLAP,
+    help=f"Number of residues shared by consecutive windows (default: {DEFAULT_WINDOW_OVERLAP})",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    default="fp32",
+    help=f"Numeric precision of the forward pass: bf16 autocast or dynamic int8 quantization of the linear layers (default: fp32)",
+)
+@click.option(
+    "--precision_check",
+    type=int,
+    default=0,
+    help=f"Before embedding, report the drift of --precision vectors from fp32 ones on a sample of this many sequences (default: 0, no check)",
 )
 @click.option(
     "--batch_size",
@@ -31,76 +114,63 @@ import os
     default=2,
     help=f"Change value to determine how many embeddings to generate for each round (default: 2).",
 )
-def calculate_esm_to_embed(input_sequence_csv, esm_model, embeddings_output):
+@click.option(
+    "--max_tokens_per_batch",
+    type=int,
+    default=None,
+    help=f"Sort sequences by length and pack each batch up to this many tokens (overrides --batch_size).",
+)
+@click.option(
+    "--server",
+    type=click.Path(),
+    default=None,
+    envvar=DEFAULT_SOCKET_ENVVAR,
+    help=f"Unix socket of a running serve-esm-embed server to run the job on, instead of loading the model here (default: ${DEFAULT_SOCKET_ENVVAR}, if set)",
+)
+def calculate_esm_to_embed(input_sequence_csv, embeddings_output, server, **job_options):
     """Calculate embeddings for an input csv file containing sequences and labels using ESM2"""
-    if torch.cuda.is_available():
-        SEED = 2023
-        device = torch.device("cuda")
-        torch.cuda.manual_seed(SEED)
-        print(f'There are {torch.cuda.device_count()} GPU(s) available.')
-        print('Device name:', torch.cuda.get_device_name(0))
-    else:
-        print('No GPU available, using the CPU instead.')
-    device = torch.device("cpu")
     path_to_csv = input_sequence_csv
     output_path = embeddings_output
 
-    if not os.path.exists(os.path.join(output_path)):
-        os.makedirs(os.path.join(output_path), exist_ok=True)
-
-    df = pd.read_csv(path_to_csv,names=['label','sequence'])
-
-    batch_size = 2 # you can change here to determine how many embeddings to generate for each round.
-
-    model_selection = esm_model
-
-    if model_selection =='esm1v':
-        model, alphabet = esm.pretrained.esm1v_t33_650M_UR90S_1() # can run on 12GB GPU
-    elif model_selection == 'esm1b':
-        model, alphabet = esm.pretrained.esm1b_t33_650M_UR50S() # can run on 12GB GPU
-    elif model_selection == 'esm2':
-        model, alphabet = esm.pretrained.esm2_t33_650M_UR50D() # can run on 12GB GPU
-    elif model_selection == "esm2_3b":
-        model, alphabet = esm.pretrained.esm2_t36_3B_UR50D() # can run on 24GB GPU
-    elif model_selection == "esm2_15b":
-        model, alphabet = esm.pretrained.esm2_t48_15B_UR50D() # not possible to run on the cluster, too large
-
-    batch_converter = alphabet.get_batch_converter()
-    model = model.to(device) # move the model to GPU
-
-    dataset = ESMDataset(df)
-    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,collate_fn=collate_fn, drop_last=False)
-
-    
-    embeddings = []
-    for i in tqdm(data_loader):
-        batch_labels, batch_strs, batch_tokens = batch_converter(i)
-        with torch.no_grad():
-            results = model(batch_tokens.to(device), repr_layers=[33])["representations"][33] # batch_size, max_seq_len, embedding_size
-            avg_x = torch.mean(results, dim=1) # average the embedding for each sequence -> batch_size, embedding_size
-            for j in range(len(batch_labels)):
-                embeddings.append({'label': batch_labels[j], 'mean_representations': {33: avg_x[j]}})
-
-
-    # save the embeddings
-    torch.save(embeddings,embeddings_output) # length of the dataset, embedding_size, e.g. (140000, 1280)
-
-
-
-
-# prepare dataset for ESM
-class ESMDataset(Dataset):
-    def __init__(self,row):
-        super().__init__()
-        self.seq = row['sequence']
-        self.label = row['label']
-    def __len__(self):
-        return len(self.seq)
-    def __getitem__(self, idx):
-        return (self.label[idx],self.seq[idx])
-    
-def collate_fn(batch):
-    labels, sequences = zip(*batch)
-    return list(zip(labels, sequences))
-
-
+    if server:
+        LOG.info(f"Submitting embedding job to the server at {server}")
+        job = dict(job_options, input_path=os.path.abspath(path_to_csv), output_path=os.path.abspath(output_path))
+        if job['embedding_cache']:
+            job['embedding_cache'] = os.path.abspath(job['embedding_cache'])
+        try:
+            result = submit_embedding_job(server, job)
+        except (OSError, RuntimeError) as err:
+            raise click.ClickException(str(err))
+    else:
+        # torch (and esm, pandas...) take seconds to import, so only do it when embedding here
+        import torch
+        from ..embedding_job import run_embedding_job
+
+        if torch.cuda.is_available():
+            SEED = 2023
+            device = torch.device("cuda")
+            torch.cuda.manual_seed(SEED)
+            print(f'There are {torch.cuda.device_count()} GPU(s) available.')
+            print('Device name:', torch.cuda.get_device_name(0))
+        else:
+            print('No GPU available, using the CPU instead.')
+        device = torch.device("cpu")
+
+        try:
+            result = run_embedding_job(path_to_csv, output_path, device=device, **job_options)
+        except (FileExistsError, ValueError) as err:
+            raise click.ClickException(str(err))
+    LOG.info(f"Wrote embeddings for {result['num_rows']} row(s) ({result['num_embedded']} sequence(s) run through the model)")
+
+
+def parse_slice(value):
+    """Parse an 'I/N' slice specification into a (slice index, number of slices) tuple"""
+    if value is None:
+        return None
+    try:
+        slice_idx, num_slices = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter(f"expected I/N (e.g. 2/8), got '{value}'")
+    if num_slices < 1 or not 0 <= slice_idx < num_slices:
+        raise click.BadParameter(f"slice index must be between 0 and N-1, got '{value}'")
+    return slice_idx, num_slices
@@ -1,5 +1,4 @@
 import click
-from Bio import SeqIO
 
 @click.command()
 @click.option(
@@ -18,6 +17,8 @@ from Bio import SeqIO
 
 def convert_fasta_to_csv_for_embed(input_file, output_file):
     """Convert a (multi)FASTA file into a csv file for embedding generation"""
+    from Bio import SeqIO
+
     records = SeqIO.parse(input_file, 'fasta')
     with open(output_file, 'w') as f:
         for record in records:
@@ -0,0 +1,25 @@
+import click
+
+@click.command()
+@click.option(
+    "--embeddings_dir",
+    "embeddings_dirs",
+    type=click.Path(exists=True, file_okay=False),
+    multiple=True,
+    required=True,
+    help="Input: sharded embeddings directory from calculate-esm-to-embed (repeat for each slice)",
+)
+@click.option(
+    "--output_dir",
+    type=click.Path(file_okay=False),
+    required=True,
+    help="Output: directory for the merged embedding shards",
+)
+def merge_esm_embeddings(embeddings_dirs, output_dir):
+    """Merge the sharded embeddings of several --slice runs into one directory"""
+    from ..embedding_store import merge_sharded_embeddings
+
+    try:
+        merge_sharded_embeddings(embeddings_dirs, output_dir)
+    except ValueError as err:
+        raise click.ClickException(str(err))
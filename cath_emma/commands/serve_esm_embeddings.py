@@ -0,0 +1,48 @@
+import logging
+
+import click
+
+from ..defaults import ESM_MODEL_NAMES
+from ..embedding_server import DEFAULT_SOCKET_ENVVAR, EmbeddingServer
+
+LOG = logging.getLogger(__name__)
+
+@click.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(),
+    required=True,
+    envvar=DEFAULT_SOCKET_ENVVAR,
+    help=f"Unix socket to listen on (default: ${DEFAULT_SOCKET_ENVVAR}, if set)",
+)
+@click.option(
+    "--preload",
+    type=click.Choice(ESM_MODEL_NAMES),
+    multiple=True,
+    help="ESM model to load at startup rather than on first use (repeat for several)",
+)
+@click.option(
+    "--num_threads",
+    type=int,
+    default=None,
+    help="Number of torch threads to use for each job (default: torch's own default)",
+)
+def serve_esm_embed(socket_path, preload, num_threads):
+    """Keep ESM models loaded and run embedding jobs sent by calculate-esm-to-embed --server"""
+    if num_threads:
+        import torch
+        torch.set_num_threads(num_threads)
+
+    try:
+        server = EmbeddingServer(socket_path, preload=preload)
+    except OSError as err:
+        raise click.ClickException(str(err))
+
+    LOG.info(f"Embedding server listening on {socket_path}")
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    LOG.info("Embedding server stopped")
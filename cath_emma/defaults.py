@@ -0,0 +1,32 @@
+# Settings shared by the command line and the embedding code. This module must
+# stay free of heavy imports (torch, esm, pandas, numpy...) because the CLI
+# imports it just to build its options.
+
+# names of the ESM models that can be asked for on the command line
+ESM_MODEL_NAMES = ["esm1v", "esm1b", "esm2_3b", "esm2", "esm2_15b"]
+
+# number of transformer layers in each model (the last one is the default representation)
+NUM_LAYERS = {
+    "esm1v": 33,
+    "esm1b": 33,
+    "esm2": 33,
+    "esm2_3b": 36,
+    "esm2_15b": 48,
+}
+
+# longest sequence (in residues) that each model can embed in one piece
+MAX_SEQUENCE_LENGTHS = {
+    "esm1v": 1022,
+    "esm1b": 1022,
+}
+
+# ways of pooling the per-residue representations into one vector per sequence
+POOLINGS = ["mean", "max", "cls"]
+
+# numeric precisions for the forward pass: bf16 autocasts to bfloat16, int8
+# dynamically quantizes the weights of the linear layers
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+DEFAULT_WINDOW_OVERLAP = 128
+
+DEFAULT_SHARD_SIZE = 4096
@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import sqlite3
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# keep well below SQLite's limit on the number of host parameters per statement
+MAX_QUERY_PARAMS = 500
+
+
+def sequence_md5(sequence):
+    """MD5 hex digest of an amino acid sequence (as in the `sequence_md5` Gene3D columns)"""
+    return hashlib.md5(sequence.encode("ascii")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent local store of pooled embeddings keyed by (model, layer, sequence MD5)
+
+    Backed by a single SQLite file, so it can be shared between runs (and, with
+    SQLite's locking, between processes on the same machine). Vectors are
+    stored as raw float32 bytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=600)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model        TEXT    NOT NULL,
+                layer        INTEGER NOT NULL,
+                sequence_md5 TEXT    NOT NULL,
+                embedding    BLOB    NOT NULL,
+                PRIMARY KEY (model, layer, sequence_md5)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def iter_cached(self, model, layer, md5s):
+        """
+        Yield (md5s, vectors) chunks for those of `md5s` that are in the cache
+
+        Chunks are at most MAX_QUERY_PARAMS rows, so the hits never all need to
+        be held in memory at once.
+        """
+        md5s = list(md5s)
+        for start in range(0, len(md5s), MAX_QUERY_PARAMS):
+            chunk = md5s[start:start + MAX_QUERY_PARAMS]
+            rows = self._conn.execute(
+                f"SELECT sequence_md5, embedding FROM embeddings "
+                f"WHERE model = ? AND layer = ? AND sequence_md5 IN ({','.join('?' * len(chunk))})",
+                [model, layer, *chunk],
+            ).fetchall()
+            if rows:
+                yield (
+                    [md5 for md5, _ in rows],
+                    np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]),
+                )
+
+    def put(self, model, layer, md5s, vectors):
+        """Store the (len(md5s) x embedding size) `vectors` for `md5s`"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, layer, sequence_md5, embedding) VALUES (?, ?, ?, ?)",
+            [(model, layer, md5, vector.tobytes()) for md5, vector in zip(md5s, vectors)],
+        )
+        self._conn.commit()
@@ -0,0 +1,211 @@
+import logging
+import os
+import random
+
+import numpy as np
+import pandas as pd
+import torch
+from Bio import SeqIO
+from tqdm import tqdm
+
+from .defaults import DEFAULT_WINDOW_OVERLAP, MAX_SEQUENCE_LENGTHS
+from .embedding_cache import EmbeddingCache, sequence_md5
+from .embedding_store import DEFAULT_SHARD_SIZE, ShardedEmbeddingWriter
+from .embeddings import (
+    combine_windows,
+    embed_batches,
+    fixed_size_batches,
+    load_esm_model,
+    model_for_precision,
+    precision_drift,
+    representation_name,
+    resolve_layers,
+    token_budget_batches,
+    windowed_pairs,
+)
+from .parallel_embedding import embed_batches_in_parallel
+
+LOG = logging.getLogger(__name__)
+
+
+def read_sequences(path):
+    """
+    Read 'label,sequence' rows from a CSV file, or the records of a FASTA file
+
+    Returns a DataFrame with `label` and `sequence` columns.
+    """
+    with open(path, "rt") as fh:
+        is_fasta = fh.read(1) == ">"
+    if is_fasta:
+        records = SeqIO.parse(path, "fasta")
+        return pd.DataFrame([(record.id, str(record.seq)) for record in records], columns=['label', 'sequence'])
+    return pd.read_csv(path, names=['label', 'sequence'])
+
+
+def run_embedding_job(
+    input_path,
+    output_path,
+    *,
+    esm_model="esm2",
+    repr_layers=(),
+    poolings=(),
+    output_format="pt",
+    shard_size=DEFAULT_SHARD_SIZE,
+    resume=False,
+    input_slice=None,
+    embedding_cache=None,
+    num_workers=0,
+    threads_per_worker=None,
+    max_window_length=None,
+    window_overlap=DEFAULT_WINDOW_OVERLAP,
+    precision="fp32",
+    precision_check=0,
+    batch_size=2,
+    max_tokens_per_batch=None,
+    device=torch.device("cpu"),
+    load_model=load_esm_model,
+):
+    """
+    Embed the sequences of a CSV (or FASTA) file and write them to `output_path`
+
+    This is the work behind `calculate-esm-to-embed` (see its options for the
+    meaning of the arguments), shared with the embedding server. `load_model`
+    is called with the model name only if some sequence actually needs
+    embedding, which lets the server hand over an already-loaded model.
+    Bad settings raise a ValueError (or a FileExistsError for existing shards).
+    Returns the number of input rows and of sequences that went through the model.
+    """
+    if resume and output_format != "shards":
+        raise ValueError("resuming needs the shards output format")
+
+    output_dir = output_path if output_format == "shards" else os.path.dirname(os.path.abspath(output_path))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    df = read_sequences(input_path)
+
+    if input_slice:
+        slice_idx, num_slices = input_slice
+        start, stop = slice_idx * len(df) // num_slices, (slice_idx + 1) * len(df) // num_slices
+        LOG.info(f"Embedding slice {slice_idx}/{num_slices}: rows {start} to {stop - 1} of {len(df)}")
+        df = df.iloc[start:stop].reset_index(drop=True)
+
+    layers = resolve_layers(esm_model, repr_layers)
+    # every requested (layer, pooling) pair comes out of the same forward pass
+    representations = [(layer, pooling) for layer in layers for pooling in (poolings or ["mean"])]
+    representation_names = [representation_name(layer, pooling) for layer, pooling in representations]
+    poolings_by_name = {representation_name(layer, pooling): pooling for layer, pooling in representations}
+
+    max_window_length = max_window_length or MAX_SEQUENCE_LENGTHS.get(esm_model)
+    if max_window_length and not 0 <= window_overlap < max_window_length:
+        raise ValueError(f"window overlap ({window_overlap}) must be less than the window length ({max_window_length})")
+    # embeddings of over-length sequences depend on the windowing, so keep them apart in the cache
+    cache_model = f"{esm_model}:window{max_window_length}:overlap{window_overlap}" if max_window_length else esm_model
+    if precision != "fp32":
+        cache_model = f"{cache_model}:{precision}"
+
+    if output_format == "shards":
+        metadata = {'model': esm_model, 'representations': representation_names}
+        if max_window_length:
+            metadata['window'] = {'length': max_window_length, 'overlap': window_overlap}
+        if precision != "fp32":
+            metadata['precision'] = precision
+        if input_slice:
+            metadata['slice'] = f'{slice_idx}/{num_slices}'
+        writer = ShardedEmbeddingWriter(output_path, shard_size=shard_size, metadata=metadata, resume=resume)
+        if resume:
+            done_labels = writer.written_labels()
+            df = df[~df['label'].astype(str).isin(done_labels)].reset_index(drop=True)
+            LOG.info(f"Skipping {len(done_labels)} embedding(s) that are already written, {len(df)} left to do")
+
+    # identical sequences (e.g. the same domain under different UniProt IDs) are only embedded once
+    df['sequence_md5'] = df['sequence'].map(sequence_md5)
+    rows_by_md5 = df.groupby('sequence_md5', sort=False).indices
+    unique_df = df.drop_duplicates('sequence_md5')[['sequence_md5', 'sequence']].reset_index(drop=True)
+
+    if output_format != "shards":
+        embeddings = [None] * len(df)
+
+    def store_embeddings(md5s, vectors):
+        """Write out the embeddings (a dict keyed by representation name) of each md5 for every input row with that sequence"""
+        counts = [len(rows_by_md5[md5]) for md5 in md5s]
+        row_idxs = np.concatenate([rows_by_md5[md5] for md5 in md5s])
+        vectors = {name: np.repeat(np.asarray(matrix, dtype=np.float32), counts, axis=0) for name, matrix in vectors.items()}
+        if output_format == "shards":
+            writer.add(df['label'].values[row_idxs].tolist(), vectors)
+        else:
+            for row, idx in enumerate(row_idxs):
+                # store in the original (file) order, whatever order the batches ran in
+                embeddings[idx] = {'label': df['label'][idx]}
+                for layer, pooling in representations:
+                    vector = torch.tensor(vectors[representation_name(layer, pooling)][row])
+                    embeddings[idx].setdefault(f'{pooling}_representations', {})[layer] = vector
+
+    def cache_key(pooling):
+        return cache_model if pooling == "mean" else f"{cache_model}:{pooling}"
+
+    cache = EmbeddingCache(embedding_cache) if embedding_cache else None
+    if cache:
+        cached_md5s = set()
+        unique_md5s = unique_df['sequence_md5'].tolist()
+        for start in range(0, len(unique_md5s), shard_size):
+            # a sequence only counts as cached if every requested representation is
+            chunk_vectors = {
+                representation_name(layer, pooling): {
+                    md5: vector
+                    for md5s, vectors in cache.iter_cached(cache_key(pooling), layer, unique_md5s[start:start + shard_size])
+                    for md5, vector in zip(md5s, vectors)
+                }
+                for layer, pooling in representations
+            }
+            md5s = [md5 for md5 in unique_md5s[start:start + shard_size] if all(md5 in found for found in chunk_vectors.values())]
+            if md5s:
+                store_embeddings(md5s, {name: np.stack([found[md5] for md5 in md5s]) for name, found in chunk_vectors.items()})
+                cached_md5s.update(md5s)
+        unique_df = unique_df[~unique_df['sequence_md5'].isin(cached_md5s)].reset_index(drop=True)
+        LOG.info(f"Found {len(cached_md5s)} sequence(s) in the embedding cache {embedding_cache}")
+
+    LOG.info(f"Embedding {len(unique_df)} unique sequence(s) for {len(df)} input row(s)")
+    num_embedded = len(unique_df)
+
+    if len(unique_df):
+        model, alphabet = load_model(esm_model)
+        model = model.to(device) # move the model to GPU
+
+        # long sequences are split into windows that are batched like any other sequence
+        pairs, num_windows = windowed_pairs(zip(unique_df['sequence_md5'], unique_df['sequence']), max_window_length, window_overlap)
+        if max_tokens_per_batch:
+            batch_idxs = token_budget_batches([len(seq) for _, seq in pairs], max_tokens_per_batch)
+        else:
+            batch_idxs = fixed_size_batches(len(pairs), batch_size)
+        batches = [[pairs[idx] for idx in idxs] for idxs in batch_idxs]
+
+        if precision_check and precision != "fp32":
+            sample = random.Random(2023).sample(pairs, min(precision_check, len(pairs)))
+            for name, drift in precision_drift(model, alphabet, sample, representations, precision).items():
+                LOG.info(f"Drift of {precision} from fp32 {name} vectors over {drift['num_sequences']} sequence(s): "
+                         f"cosine distance mean {drift['cosine_mean']:.3g} max {drift['cosine_max']:.3g}, "
+                         f"Euclidean distance mean {drift['euclidean_mean']:.3g} max {drift['euclidean_max']:.3g} "
+                         f"(relative to fp32 norm: mean {drift['relative_euclidean_mean']:.3g} max {drift['relative_euclidean_max']:.3g})")
+
+        if num_workers:
+            results = embed_batches_in_parallel(model, alphabet, batches, representations, num_workers=num_workers, threads_per_worker=threads_per_worker, precision=precision)
+        else:
+            results = embed_batches(model_for_precision(model, precision), alphabet, batches, representations, device, precision=precision)
+
+        for batch_md5s, vectors in combine_windows(tqdm(results, total=len(batches)), num_windows, poolings_by_name):
+            if cache:
+                for layer, pooling in representations:
+                    cache.put(cache_key(pooling), layer, batch_md5s, vectors[representation_name(layer, pooling)])
+            store_embeddings(batch_md5s, vectors)
+
+    if cache:
+        cache.close()
+
+    # save the embeddings
+    if output_format == "shards":
+        writer.close() # shards are in batch order, the .labels files say which row is which
+    else:
+        torch.save(embeddings,output_path) # length of the dataset, embedding_size, e.g. (140000, 1280)
+
+    return {'num_rows': len(df), 'num_embedded': num_embedded}
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_ENVVAR = "CATH_EMMA_EMBEDDING_SERVER"
+
+
+def _send_request(socket_path, request):
+    """Send one JSON request line to the server and return its JSON response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as fh:
+            fh.write(json.dumps(request).encode("utf-8") + b"\n")
+            fh.flush()
+            response = fh.readline()
+    if not response:
+        raise RuntimeError(f"embedding server at {socket_path} closed the connection without replying")
+    return json.loads(response)
+
+
+def submit_embedding_job(socket_path, job):
+    """
+    Run an embedding job (the keyword arguments of `run_embedding_job()`, plus
+    `input_path` and `output_path`) on the server and return its result
+
+    Paths are opened by the server, so they should be absolute.
+    """
+    response = _send_request(socket_path, {"command": "embed", "job": job})
+    if response["status"] != "ok":
+        raise RuntimeError(f"embedding server failed the job: {response['message']}")
+    return response["result"]
+
+
+def ping_embedding_server(socket_path):
+    """Return the names of the models that the server has loaded"""
+    return _send_request(socket_path, {"command": "ping"})["models"]
+
+
+def stop_embedding_server(socket_path):
+    _send_request(socket_path, {"command": "shutdown"})
+
+
+class _EmbeddingRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request.get("command")
+            if command == "ping":
+                response = {"status": "ok", "models": sorted(self.server.models)}
+            elif command == "embed":
+                response = {"status": "ok", "result": self.server.run_job(request["job"])}
+            elif command == "shutdown":
+                # shutdown() waits for serve_forever() to return, so it can't run in this (handler) thread
+                threading.Thread(target=self.server.shutdown).start()
+                response = {"status": "ok"}
+            else:
+                response = {"status": "error", "message": f"unknown command '{command}'"}
+        except Exception as err:
+            LOG.exception("Embedding request failed")
+            response = {"status": "error", "message": f"{type(err).__name__}: {err}"}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long-running local server that keeps ESM models loaded between embedding jobs
+
+    Clients connect to a Unix socket and send one JSON request per connection
+    (see `submit_embedding_job()`). Jobs run one at a time, each with the whole
+    machine, but reuse the models loaded by earlier jobs (or `preload`ed at
+    startup), so small jobs don't pay for importing torch and loading a
+    multi-GB checkpoint every time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, *, preload=()):
+        self.socket_path = socket_path
+        self.models = {}
+        self._job_lock = threading.Lock()
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _EmbeddingRequestHandler)
+        for model_name in preload:
+            self.get_model(model_name)
+
+    def get_model(self, model_name):
+        # imported here so that clients of this module don't pay for importing torch and esm
+        from .embeddings import load_esm_model
+
+        if model_name not in self.models:
+            self.models[model_name] = load_esm_model(model_name)
+        return self.models[model_name]
+
+    def run_job(self, job):
+        from .embedding_job import run_embedding_job
+
+        job = dict(job)
+        input_path = job.pop("input_path")
+        output_path = job.pop("output_path")
+        with self._job_lock:
+            LOG.info(f"Embedding {input_path} -> {output_path}")
+            return run_embedding_job(input_path, output_path, load_model=self.get_model, **job)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _remove_stale_socket(socket_path):
+    """Remove a socket file left behind by a server that is no longer running"""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        ping_embedding_server(socket_path)
+    except (OSError, RuntimeError, ValueError):
+        os.remove(socket_path)
+        return
+    raise OSError(f"an embedding server is already running on {socket_path}")
@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from .defaults import DEFAULT_SHARD_SIZE
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.json"
+SHARD_NAME_FORMAT = "shard_{:05d}"
+
+
+def shard_matrix_path(out_dir, shard_name, representation=None):
+    """Path of a shard's matrix of one (named) representation"""
+    return os.path.join(out_dir, shard_name + (f".{representation}" if representation else "") + ".npy")
+
+
+def _atomic_write(path, write_fn, mode="wb"):
+    """Write to a temporary file next to `path` and rename it into place"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode) as fh:
+        write_fn(fh)
+    os.replace(tmp_path, path)
+
+
+class ShardedEmbeddingWriter:
+    """
+    Stream embeddings into fixed-size float32 `.npy` shards as they are computed
+
+    Each shard is a `shard_NNNNN.npy` matrix (rows x embedding size) with a
+    matching `shard_NNNNN.labels` file (one label per row). If several
+    representations are stored (listed in `metadata["representations"]`),
+    each shard has one `shard_NNNNN.<representation>.npy` matrix per
+    representation, all in the order of the `.labels` file. `manifest.json` is
+    rewritten after every shard so that a partial run is always readable.
+    Only the rows of the current (unfinished) shard are held in memory.
+
+    With `resume=True` the shards listed in an existing manifest are kept and
+    new shards are numbered on from them (see `written_labels()`); otherwise
+    an existing manifest is an error rather than being silently overwritten.
+    """
+
+    def __init__(self, out_dir, *, shard_size=DEFAULT_SHARD_SIZE, metadata=None, resume=False):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.metadata = dict(metadata or {})
+        self.shards = []
+        self._labels = []
+        self._rows = {}
+        self._num_buffered = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+        manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            if not resume:
+                raise FileExistsError(f"{out_dir} already contains embedding shards (resume the run or remove them)")
+            with open(manifest_path, "rt") as fh:
+                manifest = json.load(fh)
+            for key, value in self.metadata.items():
+                if key in manifest and manifest[key] != value:
+                    raise ValueError(
+                        f"cannot resume {out_dir}: it was written with {key}={manifest[key]!r}, not {value!r}"
+                    )
+            if "embedding_size" in manifest:
+                self.metadata["embedding_size"] = manifest["embedding_size"]
+            self.shards = manifest["shards"]
+            LOG.info(f"Resuming {out_dir} after {self.num_written} embeddings in {len(self.shards)} shard(s)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def num_written(self):
+        return sum(shard["rows"] for shard in self.shards)
+
+    def written_labels(self):
+        """Set of the labels that are already stored in finished shards"""
+        labels = set()
+        for shard in self.shards:
+            with open(os.path.join(self.out_dir, shard["name"] + ".labels"), "rt") as fh:
+                labels.update(line.rstrip("\n") for line in fh)
+        return labels
+
+    @property
+    def representations(self):
+        return self.metadata.get("representations", [None])
+
+    def add(self, labels, vectors):
+        """
+        Add a batch of labels and their (batch_size x embedding size) vectors
+
+        With named representations, `vectors` is a dict of such arrays keyed by name.
+        """
+        if not isinstance(vectors, dict):
+            vectors = {None: vectors}
+        if set(vectors) != set(self.representations):
+            raise ValueError(f"got representations {sorted(vectors, key=str)}, expected {self.representations}")
+        vectors = {name: np.asarray(matrix, dtype=np.float32) for name, matrix in vectors.items()}
+        for matrix in vectors.values():
+            if len(labels) != len(matrix):
+                raise ValueError(f"got {len(labels)} labels for {len(matrix)} vectors")
+            self.metadata.setdefault("embedding_size", matrix.shape[1])
+        offset = 0
+        while offset < len(labels):
+            take = min(self.shard_size - self._num_buffered, len(labels) - offset)
+            self._labels.extend(labels[offset:offset + take])
+            for name, matrix in vectors.items():
+                self._rows.setdefault(name, []).append(matrix[offset:offset + take])
+            self._num_buffered += take
+            offset += take
+            if self._num_buffered >= self.shard_size:
+                self.flush()
+
+    def flush(self):
+        """Write out the buffered rows as a new shard"""
+        if not self._num_buffered:
+            return
+        name = SHARD_NAME_FORMAT.format(len(self.shards))
+        for representation, row_blocks in self._rows.items():
+            rows = np.concatenate(row_blocks)
+            _atomic_write(shard_matrix_path(self.out_dir, name, representation), lambda fh: np.save(fh, rows))
+        _atomic_write(
+            os.path.join(self.out_dir, name + ".labels"),
+            lambda fh: fh.write("".join(f"{label}\n" for label in self._labels)),
+            mode="wt",
+        )
+        self.shards.append({"name": name, "rows": len(rows)})
+        LOG.debug(f"Wrote {len(rows)} embeddings to shard {name}")
+        self._labels = []
+        self._rows = {}
+        self._num_buffered = 0
+        self._write_manifest(complete=False)
+
+    def close(self):
+        self.flush()
+        self._write_manifest(complete=True)
+
+    def _write_manifest(self, *, complete):
+        manifest = {**self.metadata, "complete": complete, "shards": self.shards}
+        _atomic_write(
+            os.path.join(self.out_dir, MANIFEST_FILENAME),
+            lambda fh: json.dump(manifest, fh, indent=2),
+            mode="wt",
+        )
+
+
+class ShardedEmbeddings:
+    """
+    Read-only view of the shards written by `ShardedEmbeddingWriter`
+
+    Gives the matrices of one `representation` (by default, the first one written).
+    """
+
+    def __init__(self, out_dir, *, representation=None, mmap_mode="r"):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, MANIFEST_FILENAME), "rt") as fh:
+            self.manifest = json.load(fh)
+        representations = self.manifest.get("representations", [None])
+        self.representation = representation or representations[0]
+        if self.representation not in representations:
+            raise ValueError(f"{out_dir} has no representation '{representation}' (it has {representations})")
+        self.labels = []
+        self.shards = []
+        for shard in self.manifest["shards"]:
+            path_stub = os.path.join(out_dir, shard["name"])
+            with open(path_stub + ".labels", "rt") as fh:
+                self.labels.extend(line.rstrip("\n") for line in fh)
+            self.shards.append(np.load(shard_matrix_path(out_dir, shard["name"], self.representation), mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def to_array(self):
+        """Concatenate all shards into one (rows x embedding size) float32 matrix"""
+        if not self.shards:
+            return np.zeros((0, self.manifest.get("embedding_size", 0)), dtype=np.float32)
+        return np.concatenate(self.shards)
+
+
+def merge_sharded_embeddings(in_dirs, out_dir):
+    """
+    Combine the shards of several (e.g. per-slice) runs into one output directory
+
+    Shards are renumbered and hard-linked into `out_dir` where possible (copied
+    otherwise), so merging costs no extra disk space on the same filesystem.
+    """
+    merged = None
+    shards = []
+    for in_dir in in_dirs:
+        with open(os.path.join(in_dir, MANIFEST_FILENAME), "rt") as fh:
+            manifest = json.load(fh)
+        if not manifest["complete"]:
+            LOG.warning(f"Merging incomplete embedding run {in_dir}")
+        if merged is None:
+            merged = {key: value for key, value in manifest.items() if key not in ("complete", "shards", "slice")}
+        for key in ("model", "representations", "embedding_size"):
+            if key in manifest and manifest[key] != merged.get(key):
+                raise ValueError(f"cannot merge {in_dir}: {key}={manifest[key]!r} differs from {merged.get(key)!r}")
+        for shard in manifest["shards"]:
+            name = SHARD_NAME_FORMAT.format(len(shards))
+            _link_or_copy(os.path.join(in_dir, shard["name"] + ".labels"), os.path.join(out_dir, name + ".labels"))
+            for representation in manifest.get("representations", [None]):
+                _link_or_copy(
+                    shard_matrix_path(in_dir, shard["name"], representation),
+                    shard_matrix_path(out_dir, name, representation),
+                )
+            shards.append({"name": name, "rows": shard["rows"]})
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {**(merged or {}), "complete": True, "shards": shards}
+    _atomic_write(
+        os.path.join(out_dir, MANIFEST_FILENAME),
+        lambda fh: json.dump(manifest, fh, indent=2),
+        mode="wt",
+    )
+    LOG.info(f"Merged {len(shards)} shard(s) from {len(in_dirs)} run(s) into {out_dir}")
+
+
+def _link_or_copy(src, dest):
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
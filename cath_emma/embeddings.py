@@ -0,0 +1,260 @@
+import logging
+
+import esm
+import numpy as np
+import torch
+
+from .defaults import NUM_LAYERS
+
+LOG = logging.getLogger(__name__)
+
+# ESM model loaders, keyed by the names accepted on the command line
+ESM_MODELS = {
+    "esm1v": esm.pretrained.esm1v_t33_650M_UR90S_1,  # can run on 12GB GPU
+    "esm1b": esm.pretrained.esm1b_t33_650M_UR50S,  # can run on 12GB GPU
+    "esm2": esm.pretrained.esm2_t33_650M_UR50D,  # can run on 12GB GPU
+    "esm2_3b": esm.pretrained.esm2_t36_3B_UR50D,  # can run on 24GB GPU
+    "esm2_15b": esm.pretrained.esm2_t48_15B_UR50D,  # not possible to run on the cluster, too large
+}
+
+
+def load_esm_model(model_name):
+    """Load a pretrained ESM model (in eval mode) and its alphabet"""
+    LOG.info(f"Loading ESM model '{model_name}'")
+    model, alphabet = ESM_MODELS[model_name]()
+    model.eval()
+    return model, alphabet
+
+
+def resolve_layers(model_name, layers):
+    """
+    Check the requested representation layers for a model, defaulting to its last layer
+
+    As in ESM's own extract script, negative layers count back from the last one.
+    """
+    num_layers = NUM_LAYERS[model_name]
+    if not layers:
+        return [num_layers]
+    resolved = []
+    for layer in layers:
+        if not -(num_layers + 1) <= layer <= num_layers:
+            raise ValueError(f"model '{model_name}' has no layer {layer} (it has layers 0 to {num_layers})")
+        resolved.append((layer + num_layers + 1) % (num_layers + 1))
+    return sorted(set(resolved))
+
+
+def representation_name(layer, pooling):
+    """Name of the (layer, pooling) representation, used for its output files"""
+    return f"{pooling}_{layer}"
+
+
+def model_for_precision(model, precision):
+    """Return the version of (fp32) `model` to run at `precision` (int8 makes a quantized copy)"""
+    if precision == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def fixed_size_batches(num_sequences, batch_size):
+    """Split the sequence indices (in file order) into batches of `batch_size`"""
+    return [
+        list(range(start, min(start + batch_size, num_sequences)))
+        for start in range(0, num_sequences, batch_size)
+    ]
+
+
+def token_budget_batches(sequence_lengths, max_tokens, extra_tokens_per_seq=2):
+    """
+    Group sequence indices into length-sorted batches of at most `max_tokens` tokens
+
+    Sequences are sorted by length (longest first, so any memory problems show up
+    at the start of a run) and greedily packed while the padded size of the batch
+    (number of sequences * (longest sequence + BOS/EOS)) stays within the budget.
+    A sequence that is longer than the budget on its own gets a batch to itself.
+    """
+    order = sorted(
+        range(len(sequence_lengths)), key=lambda idx: sequence_lengths[idx], reverse=True
+    )
+    batches = []
+    batch = []
+    batch_max_len = 0
+    for idx in order:
+        seq_len = sequence_lengths[idx] + extra_tokens_per_seq
+        new_max_len = max(batch_max_len, seq_len)
+        if batch and new_max_len * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+            new_max_len = seq_len
+        batch.append(idx)
+        batch_max_len = new_max_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def residue_mask(batch_tokens, alphabet):
+    """Boolean mask (batch_size, num_tokens) that is True for residue tokens only"""
+    special_idxs = [alphabet.padding_idx, alphabet.cls_idx, alphabet.eos_idx]
+    return ~torch.isin(batch_tokens, torch.tensor(special_idxs, device=batch_tokens.device))
+
+
+def mean_pool(representations, batch_tokens, alphabet):
+    """
+    Average the per-residue representations of each sequence in the batch
+
+    Padding, BOS and EOS positions are excluded from the average, so a sequence
+    gets the same embedding whatever else happens to be in its batch.
+    """
+    mask = residue_mask(batch_tokens, alphabet).unsqueeze(-1).to(representations.dtype)
+    summed = (representations * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1)
+    return summed / counts
+
+
+def pool(representations, batch_tokens, alphabet, pooling):
+    """Pool per-residue representations (batch_size, num_tokens, embedding_size) with `pooling`"""
+    if pooling == "mean":
+        return mean_pool(representations, batch_tokens, alphabet)
+    if pooling == "max":
+        mask = residue_mask(batch_tokens, alphabet).unsqueeze(-1)
+        return representations.masked_fill(~mask, float("-inf")).max(dim=1).values
+    if pooling == "cls":
+        # the BOS token, which ESM uses as its CLS token
+        return representations[:, 0]
+    raise ValueError(f"unknown pooling '{pooling}'")
+
+
+def embed_batches(model, alphabet, batches, representations, device=torch.device("cpu"), precision="fp32"):
+    """
+    Yield the labels and pooled float32 vectors of each batch of (label, sequence) pairs
+
+    `representations` is a list of (layer, pooling) pairs, which all come from
+    the same forward pass. The vectors are yielded as a dict of
+    (batch_size x embedding size) arrays keyed by `representation_name()`.
+    `model` should already have been through `model_for_precision()`.
+    """
+    batch_converter = alphabet.get_batch_converter()
+    repr_layers = sorted(set(layer for layer, _ in representations))
+    for batch in batches:
+        batch_labels, batch_strs, batch_tokens = batch_converter(batch)
+        batch_tokens = batch_tokens.to(device)
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+            results = model(batch_tokens, repr_layers=repr_layers)["representations"] # layer -> batch_size, max_seq_len, embedding_size
+            vectors = {
+                representation_name(layer, pooling): pool(results[layer].float(), batch_tokens, alphabet, pooling).cpu().numpy()
+                for layer, pooling in representations
+            }
+        yield batch_labels, vectors
+
+
+def precision_drift(model, alphabet, pairs, representations, precision, max_tokens_per_batch=4096):
+    """
+    Measure how far the `precision` vectors of (label, sequence) pairs drift from the fp32 ones
+
+    Returns, for each representation, the mean and max cosine distance,
+    Euclidean distance and Euclidean distance relative to the fp32 vector's norm.
+    """
+    batch_idxs = token_budget_batches([len(seq) for _, seq in pairs], max_tokens_per_batch)
+    batches = [[pairs[idx] for idx in idxs] for idxs in batch_idxs]
+    reference = [vectors for _, vectors in embed_batches(model, alphabet, batches, representations)]
+    reduced_model = model_for_precision(model, precision)
+    reduced = [vectors for _, vectors in embed_batches(reduced_model, alphabet, batches, representations, precision=precision)]
+
+    drift = {}
+    for layer, pooling in representations:
+        name = representation_name(layer, pooling)
+        reference_vectors = np.concatenate([vectors[name] for vectors in reference])
+        reduced_vectors = np.concatenate([vectors[name] for vectors in reduced])
+        norms = np.linalg.norm(reference_vectors, axis=1)
+        euclidean = np.linalg.norm(reduced_vectors - reference_vectors, axis=1)
+        cosine = 1.0 - (reduced_vectors * reference_vectors).sum(axis=1) / (np.linalg.norm(reduced_vectors, axis=1) * norms)
+        relative = euclidean / norms
+        drift[name] = {
+            "num_sequences": len(pairs),
+            "cosine_mean": float(cosine.mean()),
+            "cosine_max": float(cosine.max()),
+            "euclidean_mean": float(euclidean.mean()),
+            "euclidean_max": float(euclidean.max()),
+            "relative_euclidean_mean": float(relative.mean()),
+            "relative_euclidean_max": float(relative.max()),
+        }
+    return drift
+
+
+def sequence_windows(sequence, window_length, overlap):
+    """
+    Split a sequence into overlapping windows of at most `window_length` residues
+
+    Windows start every `window_length - overlap` residues and the last one is
+    aligned to the end of the sequence, so every residue is covered. A sequence
+    that fits in one window is returned unchanged.
+    """
+    if window_length is None or len(sequence) <= window_length:
+        return [sequence]
+    step = window_length - overlap
+    starts = list(range(0, len(sequence) - window_length + 1, step))
+    if starts[-1] + window_length < len(sequence):
+        starts.append(len(sequence) - window_length)
+    return [sequence[start:start + window_length] for start in starts]
+
+
+def windowed_pairs(pairs, window_length, overlap):
+    """
+    Split (label, sequence) pairs into ((label, window length), window) pairs
+
+    Also returns the number of windows for each label, for `combine_windows()`.
+    """
+    window_pairs = []
+    num_windows = {}
+    for label, sequence in pairs:
+        windows = sequence_windows(sequence, window_length, overlap)
+        num_windows[label] = len(windows)
+        window_pairs.extend(((label, len(window)), window) for window in windows)
+    return window_pairs, num_windows
+
+
+def combine_windows(results, num_windows, poolings):
+    """
+    Combine the embedded windows from `windowed_pairs()` into one vector per label
+
+    Takes and yields (labels, vectors) batch results, where the vectors are a
+    dict of arrays keyed by representation name and `poolings` gives the pooling
+    of each name. A label's max-pooled vectors are the element-wise max over its
+    windows and its other vectors are the average of its window vectors weighted
+    by window length. Each label is yielded with the batch in which its last
+    window finishes (windows of one sequence can be spread over several batches).
+    """
+    partial = {}
+    for window_labels, window_vectors in results:
+        labels = []
+        rows = []
+        for row, (label, window_length) in enumerate(window_labels):
+            vectors = {name: window_vectors[name][row] for name in window_vectors}
+            if num_windows[label] == 1:
+                labels.append(label)
+                rows.append(vectors)
+                continue
+            if label in partial:
+                totals, weight, seen = partial[label]
+                for name, vector in vectors.items():
+                    if poolings[name] == "max":
+                        totals[name] = np.maximum(totals[name], vector)
+                    else:
+                        totals[name] = totals[name] + window_length * vector
+            else:
+                totals, weight, seen = {
+                    name: vector if poolings[name] == "max" else window_length * vector
+                    for name, vector in vectors.items()
+                }, 0, 0
+            weight, seen = weight + window_length, seen + 1
+            if seen == num_windows[label]:
+                del partial[label]
+                labels.append(label)
+                rows.append({
+                    name: total if poolings[name] == "max" else (total / weight).astype(total.dtype)
+                    for name, total in totals.items()
+                })
+            else:
+                partial[label] = (totals, weight, seen)
+        if labels:
+            yield labels, {name: np.stack([row[name] for row in rows]) for name in window_vectors}
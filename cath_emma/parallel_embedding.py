@@ -0,0 +1,88 @@
+import logging
+import os
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing
+
+from .embeddings import embed_batches, model_for_precision
+
+LOG = logging.getLogger(__name__)
+
+# how often (in seconds) to check that the workers are still alive while waiting for results
+WORKER_POLL_SECONDS = 10
+
+
+def default_threads_per_worker(num_workers):
+    """Split the CPUs available to this process evenly between the workers"""
+    return max(1, len(os.sched_getaffinity(0)) // num_workers)
+
+
+def _embedding_worker(model, alphabet, representations, precision, num_threads, task_queue, result_queue):
+    """Embed batches from `task_queue` (until a None) and put the results on `result_queue`"""
+    torch.set_num_threads(num_threads)
+    try:
+        # quantized models can't be sent through shared memory, so each worker makes its own
+        model = model_for_precision(model, precision)
+        for result in embed_batches(model, alphabet, iter(task_queue.get, None), representations, precision=precision):
+            result_queue.put(result)
+    except Exception:
+        result_queue.put(traceback.format_exc())
+
+
+def embed_batches_in_parallel(model, alphabet, batches, representations, *, num_workers, threads_per_worker=None, precision="fp32"):
+    """
+    Yield the same (labels, vectors) results as `embed_batches()` using `num_workers` CPU processes
+
+    The (fp32) model's weights are moved to shared memory, so the workers all
+    use one copy of them (except with int8, where each worker quantizes its own). Each worker is limited to `threads_per_worker` intra-op
+    threads (by default an even split of the available CPUs) and pulls batches
+    from a shared queue, so giving it length-sorted batches keeps the workers
+    evenly loaded. Results are yielded in the order they finish.
+    """
+    threads_per_worker = threads_per_worker or default_threads_per_worker(num_workers)
+    LOG.info(f"Starting {num_workers} embedding worker(s) with {threads_per_worker} thread(s) each")
+
+    model.share_memory()
+    ctx = torch.multiprocessing.get_context("spawn")
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for batch in batches:
+        task_queue.put(batch)
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+    workers = [
+        ctx.Process(
+            target=_embedding_worker,
+            args=(model, alphabet, representations, precision, threads_per_worker, task_queue, result_queue),
+            daemon=True,
+        )
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for _ in range(len(batches)):
+            result = _next_result(result_queue, workers)
+            if isinstance(result, str):
+                raise RuntimeError(f"embedding worker failed:\n{result}")
+            yield result
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def _next_result(result_queue, workers):
+    while True:
+        try:
+            return result_queue.get(timeout=WORKER_POLL_SECONDS)
+        except queue.Empty:
+            dead = [worker for worker in workers if worker.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"embedding worker(s) died with exit code(s) {[w.exitcode for w in dead]}")
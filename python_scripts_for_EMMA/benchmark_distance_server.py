@@ -0,0 +1,76 @@
+import argparse
+import logging
+import random
+import time
+
+from distance_lookup import DistanceClient, DistanceLookup
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(
+    description="Compare the throughput of average-distance queries from a distance server with direct reads of the distance file",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--distances', '-d', type=str, dest='distances_file', required=True,
+                    help='distance file (binary matrix, k-nearest-neighbour graph or text)')
+
+parser.add_argument('--socket', '-s', type=str, dest='socket_path', required=False,
+                    help='Unix socket of a running serve_distances.py for the same distances')
+
+parser.add_argument('--num_queries', '-q', type=int, dest='num_queries', default=10000,
+                    help='number of average-distance queries')
+
+parser.add_argument('--set_size', type=int, dest='set_size', default=10,
+                    help='number of sequences in each set of a query')
+
+parser.add_argument('--names', '-n', type=str, dest='names_file', required=False,
+                    help='file of the names to draw the sets from (needed for text distances; default: the names of the binary file)')
+
+parser.add_argument('--seed', type=int, dest='seed', default=0,
+                    help='random seed for the query sets')
+
+parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
+                    help='more verbose logging')
+
+
+
+def time_queries(label, lookup, set_pairs):
+    """Run the queries through `lookup`, log their throughput and return the averages"""
+    start = time.perf_counter()
+    averages = lookup.average_distances(set_pairs)
+    seconds = time.perf_counter() - start
+    LOGGER.info(f'{label}: {len(set_pairs)} queries in {seconds:.3f}s ({len(set_pairs) / seconds:.0f} queries/s)')
+    return averages
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
+    logging.basicConfig(level=log_level)
+
+
+    start = time.perf_counter()
+    direct = DistanceLookup(args.distances_file)
+    LOGGER.info(f'Opened {args.distances_file} in {time.perf_counter() - start:.3f}s')
+
+    if args.names_file:
+        with open(args.names_file, 'r') as f:
+            names = [line.rstrip('\n') for line in f if line.strip()]
+    else:
+        names = direct._store.names
+
+    rng = random.Random(args.seed)
+    set_pairs = [
+        (rng.sample(names, args.set_size), rng.sample(names, args.set_size))
+        for _ in range(args.num_queries)
+    ]
+
+    direct_averages = time_queries('direct reads', direct, set_pairs)
+
+    if args.socket_path:
+        with DistanceClient(args.socket_path) as client:
+            server_averages = time_queries('server', client, set_pairs)
+        worst = max(abs(a - b) for a, b in zip(direct_averages, server_averages))
+        LOGGER.info(f'Largest difference between the server and direct reads: {worst}')
@@ -0,0 +1,91 @@
+import argparse
+import logging
+
+from cluster_moments import SCORES, ClusterMoments
+from emmautils import load_named_embeddings, read_names, read_starting_clusters
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(
+    description="Generate embedding scan results (cluster, cluster, average distance) from per-cluster moments of the embeddings",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--embed', '-e', type=str, dest='embed_file', required=False,
+                    help='npz (or npy) file from embedding (not needed with --moments_in)')
+
+parser.add_argument('--names', '-n', type=str, dest='names_file', required=False,
+                    help='file containing the names in the same order as the embedding file')
+
+parser.add_argument('--starting_clusters', '-sc', type=str, dest='starting_cluster_dir', required=False,
+                    help='GeMMA starting clusters directory: one FASTA file of members per cluster')
+
+parser.add_argument('--moments_in', type=str, dest='moments_in', required=False,
+                    help='start from the cluster moments saved by an earlier run instead of the embeddings')
+
+parser.add_argument('--merges', '-m', type=str, dest='merges_file', required=False,
+                    help="file of merges to apply in order, one 'cluster cluster [new_id]' per line "
+                         "(default new_id: the GeMMA node ID of their starting clusters)")
+
+parser.add_argument('--query_ids', '-q', type=str, dest='query_ids_file', required=False,
+                    help='file of the query cluster IDs (default: all current clusters)')
+
+parser.add_argument('--match_ids', '-t', type=str, dest='match_ids_file', required=False,
+                    help='file of the match cluster IDs (default: all current clusters)')
+
+parser.add_argument('--score', type=str, dest='score', choices=SCORES, default='mean_squared',
+                    help='mean squared Euclidean distance over all member pairs (exact), or its square root')
+
+parser.add_argument('--output', '-o', type=str, dest='out_file', required=False,
+                    help='Name for the scan results file (query<TAB>match<TAB>score lines, as written by HHSuiteScanner.pm)')
+
+parser.add_argument('--moments_out', type=str, dest='moments_out', required=False,
+                    help='save the cluster moments (after any merges) to this .npz file')
+
+parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
+                    help='more verbose logging')
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not args.moments_in and not (args.embed_file and args.names_file and args.starting_cluster_dir):
+        parser.error('give either --moments_in, or --embed, --names and --starting_clusters')
+    log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
+    logging.basicConfig(level=log_level)
+
+
+    if args.moments_in:
+        moments = ClusterMoments.load(args.moments_in)
+    else:
+        try:
+            embeddings, name_index = load_named_embeddings(args.embed_file, args.names_file)
+            moments = ClusterMoments.from_members(
+                embeddings,
+                name_index.names,
+                read_starting_clusters(args.starting_cluster_dir),
+            )
+        except (KeyError, ValueError) as error:
+            parser.error(error.args[0])
+    LOGGER.info(f'Loaded the moments of {len(moments)} clusters')
+
+    if args.merges_file:
+        with open(args.merges_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    moments.merge(*fields[:3])
+        LOGGER.info(f'{len(moments)} clusters after merging')
+
+    if args.moments_out:
+        moments.save(args.moments_out)
+
+    if args.out_file:
+        query_ids = read_names(args.query_ids_file) if args.query_ids_file else moments.current_ids()
+        match_ids = read_names(args.match_ids_file) if args.match_ids_file else moments.current_ids()
+        with open(args.out_file, 'w') as g:
+            g.writelines(
+                f"{query_id}\t{match_id}\t{score}\n"
+                for query_id, match_id, score in moments.iter_scan_results(query_ids, match_ids, args.score)
+            )
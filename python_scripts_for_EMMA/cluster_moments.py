@@ -0,0 +1,196 @@
+import hashlib
+import logging
+
+import numpy as np
+
+from emmautils import NameIndex
+
+LOG = logging.getLogger(__name__)
+
+# ways of turning the mean squared Euclidean distance between two clusters
+# into the score written to the scan results
+SCORES = ['mean_squared', 'rms']
+
+# clusters whose mean squared distances are computed in one matrix product
+SCAN_BLOCK_CLUSTERS = 4096
+
+
+def node_id_of_clusters(starting_cluster_ids):
+    """
+    ID of the node made of `starting_cluster_ids`, as Cath::Gemma::Util::id_of_clusters() makes it
+
+    One starting cluster keeps its own ID; a list of them gets 'n0de_' and
+    the MD5 of the IDs run together, in the order given.
+    """
+    if not starting_cluster_ids:
+        raise ValueError("cannot calculate an ID for an empty list of starting clusters")
+    if len(starting_cluster_ids) == 1:
+        return starting_cluster_ids[0]
+    return 'n0de_' + hashlib.md5(''.join(starting_cluster_ids).encode()).hexdigest()
+
+
+class ClusterMoments:
+    """
+    Running moments of the embeddings of each cluster
+
+    For each cluster this keeps the number of members n, the sum of their
+    embeddings s and the sum of their squared norms q. That is enough to get
+    the mean squared Euclidean distance over all pairs of members of two
+    clusters A and B exactly:
+
+        mean ||a - b||^2 = ||muA - muB||^2 + tr(SigmaA) + tr(SigmaB)
+                         = qA / nA + qB / nB - 2 muA . muB
+
+    where mu = s / n is a cluster's mean and tr(Sigma) = q / n - ||mu||^2 the
+    trace of its covariance. Each pair of clusters costs O(d) instead of
+    O(|A| |B| d), and merging two clusters just adds their moments, also O(d).
+    """
+
+    def __init__(self, embedding_size):
+        self.embedding_size = embedding_size
+        self.ids = []
+        self.starting_clusters = {}
+        self._rows = {}
+        self._counts = []
+        self._sums = []
+        self._sq_norms = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._rows
+
+    @classmethod
+    def from_members(cls, embeddings, names, clusters):
+        """
+        Moments of `clusters` (a dict of cluster ID to member names), with the embeddings of `names`
+
+        Members are matched to `names` ignoring any leading '>' on either.
+        """
+        index = NameIndex(names, strip_chars='>')
+        moments = cls(embeddings.shape[1])
+        for cluster_id, members in clusters.items():
+            rows = index.rows(members, what=f'members of cluster {cluster_id}')
+            moments.add_cluster(cluster_id, embeddings[np.sort(rows)])
+        return moments
+
+    def add_cluster(self, cluster_id, member_embeddings, starting_clusters=None):
+        """Add a cluster with the (members x embedding size) `member_embeddings`"""
+        member_embeddings = np.asarray(member_embeddings, dtype=np.float64)
+        self._add(
+            cluster_id,
+            len(member_embeddings),
+            member_embeddings.sum(axis=0),
+            float(np.einsum('ij,ij->', member_embeddings, member_embeddings)),
+            starting_clusters or [cluster_id],
+        )
+
+    def _add(self, cluster_id, count, sums, sq_norm, starting_clusters):
+        if cluster_id in self._rows:
+            raise ValueError(f"there is already a cluster {cluster_id}")
+        if not count:
+            raise ValueError(f"cluster {cluster_id} has no members")
+        self._rows[cluster_id] = len(self.ids)
+        self.ids.append(cluster_id)
+        self.starting_clusters[cluster_id] = list(starting_clusters)
+        self._counts.append(count)
+        self._sums.append(np.asarray(sums, dtype=np.float64))
+        self._sq_norms.append(sq_norm)
+
+    def merge(self, cluster_a, cluster_b, new_id=None):
+        """
+        Replace clusters `cluster_a` and `cluster_b` with their union, in O(d)
+
+        The new cluster's ID defaults to `node_id_of_clusters()` of their
+        starting clusters (those of `cluster_a` followed by those of `cluster_b`).
+        Returns the new ID.
+        """
+        row_a, row_b = self._rows[cluster_a], self._rows[cluster_b]
+        starting_clusters = self.starting_clusters[cluster_a] + self.starting_clusters[cluster_b]
+        new_id = new_id or node_id_of_clusters(starting_clusters)
+        count = self._counts[row_a] + self._counts[row_b]
+        sums = self._sums[row_a] + self._sums[row_b]
+        sq_norm = self._sq_norms[row_a] + self._sq_norms[row_b]
+        self.remove(cluster_a)
+        self.remove(cluster_b)
+        self._add(new_id, count, sums, sq_norm, starting_clusters)
+        return new_id
+
+    def remove(self, cluster_id):
+        """Drop a cluster (its slot is left empty, not reused)"""
+        row = self._rows.pop(cluster_id)
+        del self.starting_clusters[cluster_id]
+        self._counts[row] = 0
+        self._sums[row] = None
+        self._sq_norms[row] = 0.0
+
+    def current_ids(self):
+        """IDs of the clusters that have not been merged away, in the order they were added"""
+        return [cluster_id for cluster_id in self.ids if cluster_id in self._rows]
+
+    def _arrays(self, cluster_ids):
+        rows = [self._rows[cluster_id] for cluster_id in cluster_ids]
+        counts = np.array([self._counts[row] for row in rows], dtype=np.float64)
+        means = np.array([self._sums[row] for row in rows], dtype=np.float64).reshape(len(rows), self.embedding_size) / counts[:, None]
+        mean_sq_norms = np.array([self._sq_norms[row] for row in rows], dtype=np.float64) / counts
+        return means, mean_sq_norms
+
+    def mean_squared_distance(self, cluster_a, cluster_b):
+        """Mean squared Euclidean distance over all pairs of members of two clusters"""
+        means, mean_sq_norms = self._arrays([cluster_a, cluster_b])
+        return max(0.0, float(mean_sq_norms[0] + mean_sq_norms[1] - 2 * means[0] @ means[1]))
+
+    def mean_squared_distances(self, query_ids, match_ids):
+        """(queries x matches) matrix of the mean squared Euclidean distances between clusters"""
+        query_means, query_sq = self._arrays(query_ids)
+        match_means, match_sq = self._arrays(match_ids)
+        dists = query_means @ match_means.T
+        dists *= -2
+        dists += query_sq[:, None]
+        dists += match_sq[None, :]
+        return np.maximum(dists, 0, out=dists)
+
+    def iter_scan_results(self, query_ids, match_ids, score='mean_squared'):
+        """
+        Yield (query ID, match ID, score) for each pair of a query and a different match cluster
+
+        The triples are in the order of the queries, then the matches, as
+        HHSuiteScanner.pm writes them. `score` is the mean squared Euclidean
+        distance or its square root ('rms').
+        """
+        if score not in SCORES:
+            raise ValueError(f"unknown score '{score}' (expected one of {', '.join(SCORES)})")
+        for start in range(0, len(query_ids), SCAN_BLOCK_CLUSTERS):
+            block_ids = query_ids[start:start + SCAN_BLOCK_CLUSTERS]
+            dists = self.mean_squared_distances(block_ids, match_ids)
+            if score == 'rms':
+                np.sqrt(dists, out=dists)
+            for query_id, row in zip(block_ids, dists.tolist()):
+                for match_id, dist in zip(match_ids, row):
+                    if match_id != query_id:
+                        yield query_id, match_id, dist
+
+    def save(self, path):
+        """Save the moments of the current clusters to an .npz file"""
+        cluster_ids = self.current_ids()
+        rows = [self._rows[cluster_id] for cluster_id in cluster_ids]
+        np.savez(
+            path,
+            ids=np.array(cluster_ids, dtype=str),
+            starting_clusters=np.array([' '.join(self.starting_clusters[cluster_id]) for cluster_id in cluster_ids], dtype=str),
+            counts=np.array([self._counts[row] for row in rows], dtype=np.int64),
+            sums=np.array([self._sums[row] for row in rows], dtype=np.float64).reshape(len(rows), self.embedding_size),
+            sq_norms=np.array([self._sq_norms[row] for row in rows], dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load moments saved by `save()`"""
+        with np.load(path) as npz:
+            moments = cls(npz['sums'].shape[1])
+            for cluster_id, starting_clusters, count, sums, sq_norm in zip(
+                npz['ids'], npz['starting_clusters'], npz['counts'], npz['sums'], npz['sq_norms']
+            ):
+                moments._add(str(cluster_id), int(count), sums, float(sq_norm), str(starting_clusters).split())
+        return moments
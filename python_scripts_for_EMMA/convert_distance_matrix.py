@@ -0,0 +1,46 @@
+import argparse
+import logging
+
+from distance_store import binary_to_text, concatenate_binary_shards, is_binary_distance_file, is_knn_graph_file, knn_graph_to_text, text_to_binary
+from emmautils import read_names
+
+
+parser = argparse.ArgumentParser(
+    description="Convert a distance file between the text 'name name dist' format and the binary (memory-mappable) format, or concatenate binary shards",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--input', '-i', type=str, dest='in_files', required=True, nargs='+',
+                    help='distance file to convert (the direction is worked out from its format), or the binary shards of one matrix to concatenate')
+
+parser.add_argument('--output', '-o', type=str, dest='out_file', required=True,
+                    help='Name for the converted distance file (a binary file also gets a .names file next to it)')
+
+parser.add_argument('--names', '-n', type=str, dest='names_file', required=False,
+                    help='file containing the names in the order for the binary matrix (default: order of first appearance in the text file)')
+
+parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
+                    help='more verbose logging')
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
+    logging.basicConfig(level=log_level)
+    LOGGER = logging.getLogger(__name__)
+
+
+    if len(args.in_files) > 1:
+        if not all(is_binary_distance_file(in_file) and not is_knn_graph_file(in_file) for in_file in args.in_files):
+            parser.error('only binary shards can be concatenated (concatenate text shards with cat)')
+        concatenate_binary_shards(args.in_files, args.out_file)
+    elif is_knn_graph_file(args.in_files[0]):
+        LOGGER.info(f'Converting binary nearest-neighbour graph {args.in_files[0]} to text')
+        knn_graph_to_text(args.in_files[0], args.out_file)
+    elif is_binary_distance_file(args.in_files[0]):
+        LOGGER.info(f'Converting binary distance matrix {args.in_files[0]} to text')
+        binary_to_text(args.in_files[0], args.out_file)
+    else:
+        LOGGER.info(f'Converting text distance file {args.in_files[0]} to binary')
+        names = read_names(args.names_file) if args.names_file else None
+        text_to_binary(args.in_files[0], args.out_file, names)
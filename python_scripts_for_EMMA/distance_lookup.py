@@ -0,0 +1,246 @@
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+import numpy as np
+
+from distance_store import (
+    DistanceMatrix,
+    KnnGraph,
+    is_binary_distance_file,
+    is_knn_graph_file,
+    read_missing_distance,
+)
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_ENVVAR = 'CATH_EMMA_DISTANCE_SERVER'
+
+# requests a client writes to the socket at a time
+CLIENT_BATCH_SIZE = 1000
+
+# The line protocol: each request is one line of tab-separated fields and gets
+# one response line, in order, so clients can send many requests at once.
+#
+#   AVG <TAB> <names of set A, space-separated> <TAB> <names of set B>
+#       -> OK <TAB> <average distance over all pairs of a member of A and a member of B>
+#   PING -> OK <TAB> <number of names>
+#   SHUTDOWN -> OK
+#
+# A failed request gets 'ERR <TAB> <message>' instead.
+
+
+class DistanceLookup:
+    """
+    Average distances between sets of names, read straight from a distance file
+
+    A binary distance matrix or nearest-neighbour graph is memory-mapped, so
+    only the pairs asked for are read. A text file is scanned once per call to
+    `average_distances()`, keeping only the pairs that are needed (as
+    HHSuiteScanner.pm does); pairs that it leaves out get its missing distance,
+    if it records one.
+    """
+
+    def __init__(self, distances_path):
+        self.distances_path = distances_path
+        self._store = None
+        if is_knn_graph_file(distances_path):
+            self._store = KnnGraph(distances_path)
+        elif is_binary_distance_file(distances_path):
+            self._store = DistanceMatrix(distances_path)
+
+    def __len__(self):
+        if self._store is None:
+            raise TypeError(f"{self.distances_path} is a text file, so its names aren't indexed")
+        return len(self._store)
+
+    def average_distance(self, names_a, names_b):
+        """Average distance over all pairs of a member of `names_a` and a member of `names_b`"""
+        return self.average_distances([(names_a, names_b)])[0]
+
+    def average_distances(self, set_pairs):
+        """Average distance of each (names_a, names_b) pair of sets"""
+        if self._store is None:
+            return self._text_average_distances(set_pairs)
+        averages = []
+        for names_a, names_b in set_pairs:
+            rows_a = [self._row(name) for name in names_a]
+            rows_b = [self._row(name) for name in names_b]
+            averages.append(float(self._store.submatrix(rows_a, rows_b).mean(dtype=np.float64)))
+        return averages
+
+    def _row(self, name):
+        try:
+            return self._store.index[name]
+        except KeyError:
+            raise KeyError(f"{name} is not in {self.distances_path}") from None
+
+    def _text_average_distances(self, set_pairs):
+        wanted = {}
+        for names_a, names_b in set_pairs:
+            for name_a in names_a:
+                wanted.setdefault(name_a, set()).update(names_b)
+            for name_b in names_b:
+                wanted.setdefault(name_b, set()).update(names_a)
+        found = {}
+        with open(self.distances_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[1] in wanted.get(fields[0], ()):
+                    found[fields[0], fields[1]] = found[fields[1], fields[0]] = float(fields[2])
+        missing_distance = read_missing_distance(self.distances_path)
+
+        averages = []
+        for names_a, names_b in set_pairs:
+            total = 0.0
+            for name_a in names_a:
+                for name_b in names_b:
+                    if name_a == name_b:
+                        continue
+                    dist = found.get((name_a, name_b), missing_distance)
+                    if dist is None:
+                        raise KeyError(f"{self.distances_path} has no distance between {name_a} and {name_b}")
+                    total += dist
+            averages.append(total / (len(names_a) * len(names_b)))
+        return averages
+
+
+class _DistanceRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            fields = line.decode('utf-8').rstrip('\n').split('\t')
+            try:
+                if fields[0] == 'AVG' and len(fields) == 3:
+                    average = self.server.lookup.average_distance(fields[1].split(), fields[2].split())
+                    response = f'OK\t{average}'
+                elif fields[0] == 'PING':
+                    response = f'OK\t{len(self.server.lookup)}'
+                elif fields[0] == 'SHUTDOWN':
+                    # shutdown() waits for serve_forever() to return, so it can't run in this (handler) thread
+                    threading.Thread(target=self.server.shutdown).start()
+                    response = 'OK'
+                else:
+                    response = f"ERR\tbad request '{fields[0]}'"
+            except Exception as err:
+                response = f'ERR\t{type(err).__name__}: {err}'
+            self.wfile.write(response.encode('utf-8') + b'\n')
+
+
+class DistanceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Long-running local server that answers average-distance queries from one memory-mapped distance file
+
+    Clients connect to a Unix socket and send any number of request lines (see
+    the protocol above and `DistanceClient`), so each scan no longer has to
+    load or parse the distances itself.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, distances_path):
+        self.socket_path = socket_path
+        self.lookup = DistanceLookup(distances_path)
+        if self.lookup._store is None:
+            raise ValueError(f"{distances_path} is a text file: convert it to a binary matrix with convert_distance_matrix.py")
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _DistanceRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class DistanceClient:
+    """Client of a `DistanceServer`, with the same interface as `DistanceLookup`"""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._rfile = self._sock.makefile('rb')
+        self._wfile = self._sock.makefile('wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._sock.close()
+
+    def _send(self, lines):
+        for start in range(0, len(lines), CLIENT_BATCH_SIZE):
+            self._wfile.write(''.join(f'{line}\n' for line in lines[start:start + CLIENT_BATCH_SIZE]).encode('utf-8'))
+            self._wfile.flush()
+
+    def _requests(self, lines):
+        # Send from another thread while reading the responses here: if all the
+        # requests were written first, the server could block writing responses
+        # that nobody reads, while the client blocks writing requests to it.
+        sender = threading.Thread(target=self._send, args=(lines,), daemon=True)
+        sender.start()
+        responses = []
+        for _ in lines:
+            response = self._rfile.readline().decode('utf-8').rstrip('\n')
+            if not response:
+                raise RuntimeError(f'distance server at {self.socket_path} closed the connection')
+            status, _, value = response.partition('\t')
+            if status != 'OK':
+                sender.join()
+                raise RuntimeError(f'distance server failed a request: {value}')
+            responses.append(value)
+        sender.join()
+        return responses
+
+    def __len__(self):
+        return int(self._requests(['PING'])[0])
+
+    def average_distance(self, names_a, names_b):
+        """Average distance over all pairs of a member of `names_a` and a member of `names_b`"""
+        return self.average_distances([(names_a, names_b)])[0]
+
+    def average_distances(self, set_pairs):
+        """Average distance of each (names_a, names_b) pair of sets, sent in batches"""
+        return [
+            float(value)
+            for value in self._requests([f"AVG\t{' '.join(names_a)}\t{' '.join(names_b)}" for names_a, names_b in set_pairs])
+        ]
+
+    def shutdown(self):
+        self._requests(['SHUTDOWN'])
+
+
+def open_distance_lookup(distances_path, socket_path=None):
+    """
+    A `DistanceClient` of the server on `socket_path` (default: $CATH_EMMA_DISTANCE_SERVER), if it is up
+
+    Falls back to reading `distances_path` directly (a `DistanceLookup`) when
+    there is no server.
+    """
+    socket_path = socket_path or os.environ.get(DEFAULT_SOCKET_ENVVAR)
+    if socket_path and os.path.exists(socket_path):
+        try:
+            return DistanceClient(socket_path)
+        except OSError as err:
+            LOG.warning(f"Cannot connect to the distance server at {socket_path} ({err}): reading {distances_path} instead")
+    return DistanceLookup(distances_path)
+
+
+def _remove_stale_socket(socket_path):
+    """Remove a socket file left behind by a server that is no longer running"""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        with DistanceClient(socket_path) as client:
+            len(client)
+    except (OSError, RuntimeError, ValueError):
+        os.remove(socket_path)
+        return
+    raise OSError(f"a distance server is already running on {socket_path}")
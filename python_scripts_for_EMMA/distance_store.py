@@ -0,0 +1,582 @@
+import logging
+import shutil
+import struct
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+# A binary distance matrix is a file holding a fixed-size header followed by
+# the condensed upper triangle (without the diagonal, which is all zeros) as
+# little-endian float32, row by row: (0,1), (0,2), ..., (0,n-1), (1,2), ...
+# The names, in matrix order, are in a text file next to it, one per line.
+# A shard of a matrix (see `BinaryRowsWriter`) holds the condensed rows
+# [first row, end row) only.
+MAGIC = b"EMMADIST"
+FORMAT_VERSION = 1
+HEADER_FORMAT = "<8sIQQQ"  # magic, format version, number of names, first row, end row
+HEADER_SIZE = 64
+DTYPE = np.dtype("<f4")
+NAMES_SUFFIX = ".names"
+
+# A binary distance graph (a k-nearest-neighbour graph, or any other set of
+# pairs) is a file holding a fixed-size header, then the pairs of each row in
+# CSR layout: the (names + 1) offsets of the rows' pairs as little-endian
+# int64, then the column of each pair as int32 and its distance as float32,
+# each row nearest first. A pair may be in either or both of its rows, so the
+# file grows with the number of pairs only. Its names index is next to it, as
+# for a distance matrix. Pairs that are not in the graph have the missing
+# distance recorded in the header.
+KNN_MAGIC = b"EMMAKNNG"
+GRAPH_FORMAT_VERSION = 2
+KNN_HEADER_FORMAT = "<8sIQQd"  # magic, format version, number of names, number of pairs, missing distance
+OFFSET_DTYPE = np.dtype("<i8")
+INDEX_DTYPE = np.dtype("<i4")
+
+# A text distance file can start with a line giving the distance of the
+# pairs that it leaves out, e.g. '#missing_distance 0.02'
+MISSING_DISTANCE_HEADER = "#missing_distance"
+
+
+def format_distances(dists):
+    """
+    The distances as strings, each the shortest that reads back as the same value of their dtype
+
+    float32 distances are written with float32 precision (as str() of a
+    numpy float32, e.g. '7.739493'), not as the longer repr of the float64
+    that they would become as Python floats.
+    """
+    return np.asarray(dists).astype(str).tolist()
+
+
+def names_path(path):
+    """Path of the names index of the binary distance matrix at `path`"""
+    return path + NAMES_SUFFIX
+
+
+def condensed_size(num_names):
+    """Number of distances in the condensed upper triangle of `num_names` names"""
+    return num_names * (num_names - 1) // 2
+
+
+def condensed_index(i, j, num_names):
+    """Position of the distance between rows i and j (i != j) in the condensed upper triangle"""
+    if i > j:
+        i, j = j, i
+    return condensed_row_start(i, num_names) + (j - i - 1)
+
+
+def condensed_row_start(i, num_names):
+    """Position of the first distance of row i (to row i+1) in the condensed upper triangle"""
+    return num_names * i - i * (i + 1) // 2
+
+
+def _header(num_names, first_row=0, end_row=None):
+    end_row = num_names if end_row is None else end_row
+    return struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, num_names, first_row, end_row).ljust(HEADER_SIZE, b"\0")
+
+
+def read_header(path):
+    """(number of names, first row, end row) of a binary distance file"""
+    with open(path, "rb") as fh:
+        magic, version, num_names, first_row, end_row = struct.unpack(HEADER_FORMAT, fh.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a binary distance matrix")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {version}, expected {FORMAT_VERSION}")
+    return num_names, first_row, end_row
+
+
+def _write_names(path, names):
+    with open(names_path(path), "w") as f:
+        f.writelines(f"{name}\n" for name in names)
+
+
+def is_binary_distance_file(path):
+    """Whether `path` is a binary distance matrix or k-nearest-neighbour graph (rather than a text `emb` file)"""
+    with open(path, "rb") as fh:
+        return fh.read(len(MAGIC)) in (MAGIC, KNN_MAGIC)
+
+
+def is_knn_graph_file(path):
+    """Whether `path` is a binary k-nearest-neighbour graph"""
+    with open(path, "rb") as fh:
+        return fh.read(len(KNN_MAGIC)) == KNN_MAGIC
+
+
+def read_missing_distance(text_path):
+    """The missing distance recorded at the top of a text distance file, or None"""
+    with open(text_path, "r") as f:
+        fields = f.readline().split()
+    if len(fields) == 2 and fields[0] == MISSING_DISTANCE_HEADER:
+        return float(fields[1])
+    return None
+
+
+class DistanceMatrixWriter:
+    """
+    Write a binary distance matrix of `names`
+
+    The file is created at its full size up front and memory-mapped, so the
+    distances can be filled in any order, either a pair at a time with `set()`
+    or in whole strips of rows with `set_rows()`. Pairs that are never set are
+    left as NaN. The names index is written when the writer is closed.
+    """
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = list(names)
+        num_names = len(self.names)
+        with open(path, "wb") as fh:
+            fh.write(_header(num_names))
+            fh.truncate(HEADER_SIZE + condensed_size(num_names) * DTYPE.itemsize)
+        self._condensed = np.memmap(path, dtype=DTYPE, mode="r+", offset=HEADER_SIZE, shape=(condensed_size(num_names),)) if num_names > 1 else np.zeros(0, dtype=DTYPE)
+        self._condensed[:] = np.nan
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def set(self, i, j, dist):
+        """Set the distance between rows i and j"""
+        if i != j:
+            self._condensed[condensed_index(i, j, len(self.names))] = dist
+
+    def set_rows(self, row_start, strip):
+        """
+        Set a strip of rows of the upper triangle
+
+        `strip` holds the distances of rows row_start, row_start + 1, ... to
+        columns row_start onwards (as from `pairwise_distances.iter_upper_triangle_rows()`).
+        """
+        num_names = len(self.names)
+        for offset, row in enumerate(strip):
+            i = row_start + offset
+            start = condensed_row_start(i, num_names)
+            self._condensed[start:start + num_names - i - 1] = row[offset + 1:]
+
+    def set_pairs(self, rows, cols, dists):
+        """Set the distances of many pairs at once (pairs of a row with itself are ignored)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        off_diagonal = rows != cols
+        rows, cols = rows[off_diagonal], cols[off_diagonal]
+        lo, hi = np.minimum(rows, cols), np.maximum(rows, cols)
+        self._condensed[condensed_row_start(lo, len(self.names)) + (hi - lo - 1)] = np.asarray(dists)[off_diagonal]
+
+    def num_unset(self):
+        """Number of pairs that have not been set (so are still NaN)"""
+        return int(np.count_nonzero(np.isnan(self._condensed)))
+
+    def fill_unset(self, dist):
+        """Set every pair that has not been set to `dist`"""
+        self._condensed[np.isnan(self._condensed)] = dist
+
+    def close(self):
+        if isinstance(self._condensed, np.memmap):
+            self._condensed.flush()
+        del self._condensed
+        _write_names(self.path, self.names)
+
+
+class BinaryRowsWriter:
+    """
+    Write the rows [`row_start`, `row_end`) of a binary distance matrix of `names` sequentially
+
+    Rows must be added in order (see `add_rows()`), so the file is written as a
+    stream and nothing is held in memory. With the default row range the result
+    is a complete matrix; otherwise it is a shard, and the shards of a matrix
+    can be put back together with `concatenate_binary_shards()`.
+    """
+
+    def __init__(self, path, names, row_start=0, row_end=None):
+        self.path = path
+        self.names = list(names)
+        self.row_start = row_start
+        self.row_end = len(self.names) if row_end is None else row_end
+        self._next_row = row_start
+        self._fh = open(path, "wb")
+        self._fh.write(_header(len(self.names), self.row_start, self.row_end))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_condensed(self, row_start, row_end, condensed):
+        """Add the condensed distances of rows [row_start, row_end), which must follow on from the last rows added"""
+        if row_start != self._next_row:
+            raise ValueError(f"expected rows from {self._next_row}, got rows from {row_start}")
+        num_names = len(self.names)
+        expected = condensed_row_start(row_end, num_names) - condensed_row_start(row_start, num_names)
+        if len(condensed) != expected:
+            raise ValueError(f"rows {row_start}-{row_end} need {expected} distances, got {len(condensed)}")
+        self._fh.write(np.asarray(condensed, dtype=DTYPE).tobytes())
+        self._next_row = row_end
+
+    def add_rows(self, row_start, strip):
+        """Add a strip of rows of the upper triangle (as for `DistanceMatrixWriter.set_rows()`)"""
+        self.add_condensed(row_start, row_start + len(strip), strip_to_condensed(strip))
+
+    def close(self):
+        self._fh.close()
+        if self._next_row != self.row_end:
+            raise ValueError(f"{self.path} was closed after row {self._next_row}, before row {self.row_end}")
+        _write_names(self.path, self.names)
+
+
+def strip_to_condensed(strip):
+    """Condensed upper triangle distances of a strip of rows (see `DistanceMatrixWriter.set_rows()`)"""
+    if not len(strip):
+        return np.zeros(0, dtype=DTYPE)
+    return np.concatenate([row[offset + 1:] for offset, row in enumerate(strip)]).astype(DTYPE, copy=False)
+
+
+def concatenate_binary_shards(shard_paths, out_path):
+    """Put the shards of a binary distance matrix (in any order) back together into one matrix"""
+    shards = sorted((read_header(path), path) for path in shard_paths)
+    num_names = shards[0][0][0]
+    next_row = 0
+    for (shard_num_names, first_row, end_row), path in shards:
+        if shard_num_names != num_names:
+            raise ValueError(f"{path} has {shard_num_names} names, but {shards[0][1]} has {num_names}")
+        if first_row != next_row:
+            raise ValueError(f"the shards have no rows from {next_row} (next is {path}, from row {first_row})")
+        next_row = end_row
+    if next_row != num_names:
+        raise ValueError(f"the shards have no rows from {next_row}")
+
+    with open(out_path, "wb") as out:
+        out.write(_header(num_names))
+        for _, path in shards:
+            with open(path, "rb") as fh:
+                fh.seek(HEADER_SIZE)
+                shutil.copyfileobj(fh, out, 16 * 1024 * 1024)
+    shutil.copyfile(names_path(shards[0][1]), names_path(out_path))
+    LOG.info(f"Concatenated {len(shards)} shard(s) into {out_path}")
+
+
+class DistanceMatrix:
+    """
+    Read-only, memory-mapped view of a binary distance matrix
+
+    Any distance can be looked up in O(1) by row (`distance(i, j)`) or by name
+    (`distance_by_name(a, b)`), without reading the rest of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        num_names, first_row, end_row = read_header(path)
+        if (first_row, end_row) != (0, num_names):
+            raise ValueError(f"{path} is a shard holding rows {first_row}-{end_row} only (concatenate the shards first)")
+        with open(names_path(path), "r") as f:
+            self.names = [line.rstrip("\n") for line in f]
+        if len(self.names) != num_names:
+            raise ValueError(f"{names_path(path)} has {len(self.names)} names, but {path} has {num_names}")
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.condensed = np.memmap(path, dtype=DTYPE, mode="r", offset=HEADER_SIZE, shape=(condensed_size(num_names),)) if num_names > 1 else np.zeros(0, dtype=DTYPE)
+
+    def __len__(self):
+        return len(self.names)
+
+    def distance(self, i, j):
+        """Distance between rows i and j"""
+        if i == j:
+            return 0.0
+        return float(self.condensed[condensed_index(i, j, len(self.names))])
+
+    def distance_by_name(self, name_a, name_b):
+        """Distance between two names"""
+        return self.distance(self.index[name_a], self.index[name_b])
+
+    def submatrix(self, rows_a, rows_b):
+        """(len(rows_a) x len(rows_b)) float32 array of the distances between two lists of rows"""
+        rows_a = np.asarray(rows_a, dtype=np.int64)[:, None]
+        rows_b = np.asarray(rows_b, dtype=np.int64)[None, :]
+        lo, hi = np.minimum(rows_a, rows_b), np.maximum(rows_a, rows_b)
+        same = lo == hi
+        positions = np.where(same, 0, condensed_row_start(lo, len(self.names)) + (hi - lo - 1))
+        if not len(self.condensed):
+            return np.zeros(positions.shape, dtype=np.float32)
+        return np.where(same, 0, self.condensed[positions]).astype(np.float32)
+
+    def row(self, i):
+        """Distances of row i to every row (including itself), as a float32 array"""
+        num_names = len(self.names)
+        row = np.zeros(num_names, dtype=np.float32)
+        before = np.arange(i)
+        row[:i] = self.condensed[condensed_row_start(before, num_names) + (i - before - 1)]
+        if i + 1 < num_names:
+            start = condensed_row_start(i, num_names)
+            row[i + 1:] = self.condensed[start:start + num_names - i - 1]
+        return row
+
+    def iter_upper_triangle_rows(self):
+        """Yield (i, distances of row i to rows i+1 onwards), reading the file sequentially"""
+        num_names = len(self.names)
+        start = 0
+        for i in range(num_names):
+            end = start + num_names - i - 1
+            yield i, self.condensed[start:end]
+            start = end
+
+
+def write_distance_text(fh, matrix):
+    """Write a `DistanceMatrix` as 'name name dist' lines (the text `emb` file), row by row from the diagonal"""
+    names = matrix.names
+    for i, row in matrix.iter_upper_triangle_rows():
+        name_i = names[i]
+        fh.write(f"{name_i} {name_i} 0.0\n")
+        fh.writelines(
+            f"{name_i} {name_j} {dist}\n"
+            for name_j, dist in zip(names[i + 1:], format_distances(row))
+        )
+
+
+def read_text_names(text_path):
+    """Names of a text distance file, in order of first appearance"""
+    names = {}
+    with open(text_path, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3:
+                names.setdefault(fields[0], None)
+                names.setdefault(fields[1], None)
+    return list(names)
+
+
+def text_to_binary(text_path, out_path, names=None):
+    """
+    Convert a text 'name name dist' file into a binary distance matrix
+
+    The text file is streamed, so it is never held in memory. Without `names`,
+    the matrix order is the order in which names first appear in the file,
+    which takes an extra pass. Pairs that are missing from the text file get
+    the missing distance from its header line, if it has one, and are left
+    as NaN otherwise. Returns the number of missing pairs.
+    """
+    missing_distance = read_missing_distance(text_path)
+    if names is None:
+        names = read_text_names(text_path)
+    index = {name: i for i, name in enumerate(names)}
+    with DistanceMatrixWriter(out_path, names) as writer:
+        with open(text_path, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                writer.set(index[fields[0]], index[fields[1]], float(fields[2]))
+        num_missing = writer.num_unset()
+        if num_missing and missing_distance is not None:
+            writer.fill_unset(missing_distance)
+            LOG.info(f"{num_missing} pair(s) missing from {text_path} set to its missing distance, {missing_distance}")
+            return num_missing
+    if num_missing:
+        LOG.warning(f"{num_missing} pair(s) missing from {text_path} are NaN in {out_path}")
+    return num_missing
+
+
+def binary_to_text(binary_path, out_path):
+    """Convert a binary distance matrix into a text 'name name dist' file"""
+    matrix = DistanceMatrix(binary_path)
+    with open(out_path, "w") as fh:
+        write_distance_text(fh, matrix)
+
+
+def format_graph_text(names, offsets, cols, dists):
+    """
+    The 'name name dist' lines of a distance graph in CSR layout (see `write_graph()`)
+
+    Each pair is written once, even if it is in both of its rows: from the
+    lower row.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    rows = np.repeat(np.arange(len(names), dtype=np.int64), np.diff(offsets))
+    keys = rows * len(names) + cols
+    keep = (cols >= rows) | ~np.isin(cols * len(names) + rows, keys)
+    lines = []
+    for i, name_i in enumerate(names):
+        start, end = offsets[i], offsets[i + 1]
+        row_keep = keep[start:end]
+        lines.extend(
+            f"{name_i} {names[j]} {dist}\n"
+            for j, dist in zip(cols[start:end][row_keep].tolist(), format_distances(np.asarray(dists[start:end])[row_keep]))
+        )
+    return "".join(lines)
+
+
+def write_graph_text(fh, names, offsets, cols, dists, missing_distance):
+    """Write a distance graph as 'name name dist' lines, after a header line with its missing distance"""
+    fh.write(f"{MISSING_DISTANCE_HEADER} {missing_distance}\n")
+    fh.write(format_graph_text(names, offsets, cols, dists))
+
+
+def knn_to_graph(neighbours, distances):
+    """
+    (offsets, cols, dists) CSR arrays (see `write_graph()`) of a k-nearest-neighbour graph
+
+    `neighbours` and `distances` are (names x k) arrays of neighbour row
+    indices (-1 for none) and their distances, nearest first.
+    """
+    neighbours = np.asarray(neighbours)
+    found = neighbours >= 0
+    offsets = np.zeros(len(neighbours) + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(found, axis=1), out=offsets[1:])
+    return offsets, neighbours[found], np.asarray(distances)[found]
+
+
+def write_knn_text(fh, names, neighbours, distances, missing_distance):
+    """Write a k-nearest-neighbour graph as 'name name dist' lines, after a header line with its missing distance"""
+    write_graph_text(fh, names, *knn_to_graph(neighbours, distances), missing_distance)
+
+
+def write_graph(path, names, offsets, cols, dists, missing_distance):
+    """
+    Write a binary distance graph of `names`
+
+    `offsets` (of length names + 1) delimits the pairs of each row in `cols`
+    (their column) and `dists` (their distance), as from `sparse_to_graph()`.
+    """
+    num_names = len(offsets) - 1
+    with open(path, "wb") as fh:
+        fh.write(struct.pack(KNN_HEADER_FORMAT, KNN_MAGIC, GRAPH_FORMAT_VERSION, num_names, int(offsets[-1]), missing_distance).ljust(HEADER_SIZE, b"\0"))
+        fh.write(np.asarray(offsets, dtype=OFFSET_DTYPE).tobytes())
+        fh.write(np.asarray(cols, dtype=INDEX_DTYPE).tobytes())
+        fh.write(np.asarray(dists, dtype=DTYPE).tobytes())
+    _write_names(path, names)
+
+
+def write_knn_graph(path, names, neighbours, distances, missing_distance):
+    """Write a k-nearest-neighbour graph (see `knn_to_graph()`) as a binary distance graph of `names`"""
+    write_graph(path, names, *knn_to_graph(neighbours, distances), missing_distance)
+
+
+def sparse_to_graph(num_names, rows, cols, dists):
+    """
+    (offsets, cols, dists) CSR arrays for `write_graph()` of the pairs (rows[i], cols[i]) with distance dists[i]
+
+    Each pair is stored once, in the row of `rows` (`KnnGraph` looks in both
+    rows), nearest first.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.lexsort((dists, rows))
+    offsets = np.zeros(num_names + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_names), out=offsets[1:])
+    return offsets, np.asarray(cols)[order], np.asarray(dists)[order]
+
+
+def write_sparse_text(fh, names, rows, cols, dists, missing_distance):
+    """
+    Write the pairs (rows[i], cols[i]) with distance dists[i] as 'name name dist' lines
+
+    The lines come after a header line with the `missing_distance` of every
+    other pair, row by row from each name's own diagonal line (as for a full
+    matrix), each row's pairs in column order.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.lexsort((cols, rows))
+    rows, cols, dists = rows[order], np.asarray(cols)[order], np.asarray(dists)[order]
+    row_starts = np.searchsorted(rows, np.arange(len(names) + 1))
+    fh.write(f"{MISSING_DISTANCE_HEADER} {missing_distance}\n")
+    for i, name_i in enumerate(names):
+        start, end = row_starts[i], row_starts[i + 1]
+        fh.write(f"{name_i} {name_i} 0.0\n")
+        fh.writelines(
+            f"{name_i} {names[j]} {dist}\n"
+            for j, dist in zip(cols[start:end].tolist(), format_distances(dists[start:end]))
+        )
+
+
+class KnnGraph:
+    """
+    Read-only, memory-mapped view of a binary distance graph, such as a k-nearest-neighbour graph
+
+    `distance(i, j)` looks for each row among the pairs of the other, and
+    gives `missing_distance` for pairs that are in neither row.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            magic, version, num_names, num_pairs, missing_distance = struct.unpack(KNN_HEADER_FORMAT, fh.read(struct.calcsize(KNN_HEADER_FORMAT)))
+        if magic != KNN_MAGIC:
+            raise ValueError(f"{path} is not a binary distance graph")
+        if version != GRAPH_FORMAT_VERSION:
+            raise ValueError(f"{path} has format version {version}, expected {GRAPH_FORMAT_VERSION}")
+        with open(names_path(path), "r") as f:
+            self.names = [line.rstrip("\n") for line in f]
+        if len(self.names) != num_names:
+            raise ValueError(f"{names_path(path)} has {len(self.names)} names, but {path} has {num_names}")
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.missing_distance = missing_distance
+        self.offsets = np.memmap(path, dtype=OFFSET_DTYPE, mode="r", offset=HEADER_SIZE, shape=(num_names + 1,))
+        cols_start = HEADER_SIZE + (num_names + 1) * OFFSET_DTYPE.itemsize
+        dists_start = cols_start + num_pairs * INDEX_DTYPE.itemsize
+        self.cols = np.memmap(path, dtype=INDEX_DTYPE, mode="r", offset=cols_start, shape=(num_pairs,)) if num_pairs else np.zeros(0, dtype=INDEX_DTYPE)
+        self.distances = np.memmap(path, dtype=DTYPE, mode="r", offset=dists_start, shape=(num_pairs,)) if num_pairs else np.zeros(0, dtype=DTYPE)
+
+    def __len__(self):
+        return len(self.names)
+
+    def distance(self, i, j):
+        """Distance between rows i and j (the missing distance if neither row has the pair)"""
+        if i == j:
+            return 0.0
+        for a, b in ((i, j), (j, i)):
+            start, end = self.offsets[a], self.offsets[a + 1]
+            hits = np.flatnonzero(self.cols[start:end] == b)
+            if len(hits):
+                return float(self.distances[start + hits[0]])
+        return self.missing_distance
+
+    def distance_by_name(self, name_a, name_b):
+        """Distance between two names"""
+        return self.distance(self.index[name_a], self.index[name_b])
+
+    def row_pairs(self, rows):
+        """(positions in `rows`, columns, distances) of all the pairs of a list of rows, gathered at once"""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        positions = np.repeat(np.arange(len(rows)), counts)
+        pairs = np.arange(int(counts.sum())) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return positions, self.cols[pairs], self.distances[pairs]
+
+    def submatrix(self, rows_a, rows_b):
+        """
+        (len(rows_a) x len(rows_b)) float32 array of the distances between two lists of rows
+
+        The pairs of all the rows of each list are gathered at once and
+        matched against the other (sorted) list, so the cost grows with the
+        number of pairs of the rows rather than with a search per cell. As
+        for `distance()`, a pair in the row of a member of `rows_a` comes
+        before the same pair in the row of a member of `rows_b`.
+        """
+        rows_a, inverse_a = np.unique(np.asarray(rows_a, dtype=np.int64), return_inverse=True)
+        rows_b, inverse_b = np.unique(np.asarray(rows_b, dtype=np.int64), return_inverse=True)
+        sub = np.full((len(rows_a), len(rows_b)), self.missing_distance, dtype=np.float32)
+        if len(rows_a) and len(rows_b):
+            for rows_from, rows_to, transposed in ((rows_b, rows_a, True), (rows_a, rows_b, False)):
+                positions, cols, dists = self.row_pairs(rows_from)
+                found = np.minimum(np.searchsorted(rows_to, cols), len(rows_to) - 1)
+                hit = rows_to[found] == cols
+                if transposed:
+                    sub[found[hit], positions[hit]] = dists[hit]
+                else:
+                    sub[positions[hit], found[hit]] = dists[hit]
+            sub[rows_a[:, None] == rows_b[None, :]] = 0
+        return sub[np.ix_(inverse_a.ravel(), inverse_b.ravel())]
+
+
+def knn_graph_to_text(binary_path, out_path):
+    """Convert a binary distance graph into a text 'name name dist' file (with its missing distance header)"""
+    graph = KnnGraph(binary_path)
+    with open(out_path, "w") as fh:
+        write_graph_text(fh, graph.names, graph.offsets, graph.cols, graph.distances, graph.missing_distance)
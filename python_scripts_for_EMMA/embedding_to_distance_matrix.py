@@ -1,14 +1,23 @@
 import argparse
 import logging
+import os
+
 import numpy as np
 
+from distance_store import BinaryRowsWriter, DistanceMatrix, write_knn_graph, write_knn_text
+from emmautils import load_named_embeddings, read_names, select_embeddings
+from pairwise_distances import DEFAULT_MEMORY_BUDGET_MB, append_to_distance_matrix, iter_upper_triangle_blocks, knn_graph, shard_rows
+
+
+LOGGER = logging.getLogger(__name__)
+
 
 parser = argparse.ArgumentParser(
     description="Generate a distance matrix file for ProtT5 embeddings",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 parser.add_argument('--embed', '-e', type=str, dest='embed_file', required=True,
-                    help='npz file from embedding')  
+                    help='npz file from embedding (or an .npy file, which is memory-mapped)')  
 
 parser.add_argument('--names', '-n', type=str, dest='names_file', required=True,
                     help='file containing the names in the same order as the embedding file')  
@@ -19,59 +28,162 @@ parser.add_argument('--subset', '-s', type=str, dest='subset_file', required=Fal
 parser.add_argument('--output', '-o', type=str, dest='out_file', required=True,
                     help='Name for output difference file')                                                                                                           
 
+parser.add_argument('--format', '-f', type=str, dest='out_format', choices=['text', 'binary'], default='text',
+                    help="'name name dist' text lines, or a binary condensed matrix (plus a .names file) for convert_distance_matrix.py and other readers")
+
+parser.add_argument('--knn', '-k', type=int, dest='knn', default=None,
+                    help='only write the k nearest neighbours of each sequence (a sparse graph, for sets too big for the full matrix), '
+                         'with a #missing_distance header line giving the distance of every other pair')
+
+parser.add_argument('--cutoff', type=float, dest='cutoff', default=None,
+                    help='with --knn, also leave out neighbours further away than this')
+
+parser.add_argument('--missing_distance', type=float, dest='missing_distance', default=None,
+                    help='with --knn, distance of the pairs that are left out (default: the --cutoff if given, otherwise the largest distance in the graph)')
+
+parser.add_argument('--memory_budget', '-m', type=int, dest='memory_budget', default=DEFAULT_MEMORY_BUDGET_MB,
+                    help='memory (in MB) to use for each block of distances (in each worker)')
+
+parser.add_argument('--num_workers', '-w', type=int, dest='num_workers', default=1,
+                    help='number of processes computing blocks of distances')
+
+parser.add_argument('--threads_per_worker', type=int, dest='threads_per_worker', default=None,
+                    help='number of BLAS threads for each worker process (default: the CPUs split between the workers)')
+
+parser.add_argument('--shard', type=str, dest='shard', default=None,
+                    help="only write shard I of N (0-based, e.g. '2/8') of the matrix rows, so that several nodes can share one matrix; "
+                         "concatenate the shards in order afterwards (cat for text, convert_distance_matrix.py for binary)")
+
+parser.add_argument('--append_to', '-a', type=str, dest='append_to', default=None,
+                    help='existing binary distance matrix to update: only the distances of the names that are not in it yet are computed, '
+                         'and the updated matrix (old names first, then the new ones) is written to --output')
+
+parser.add_argument('--drop_removed', action='store_true', dest='drop_removed',
+                    help='with --append_to, leave out the names of the existing matrix that are not in --names (or --subset)')
+
 parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
                     help='more verbose logging')
 
 
 
+def write_knn_graph_output(args, embeddings, names):
+    """Write the k-nearest-neighbour graph of the embeddings"""
+    neighbours, distances = knn_graph(
+        embeddings,
+        args.knn,
+        cutoff=args.cutoff,
+        num_workers=args.num_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_budget_mb=args.memory_budget,
+    )
+    missing_distance = args.missing_distance
+    if missing_distance is None:
+        found = distances[np.isfinite(distances)]
+        missing_distance = args.cutoff if args.cutoff is not None else (float(found.max()) if len(found) else 0.0)
+    LOGGER.info(f'Pairs that are not in the graph have distance {missing_distance}')
+    if args.out_format == 'binary':
+        write_knn_graph(args.out_file, names, neighbours, distances, missing_distance)
+    else:
+        with open(args.out_file, 'w') as g:
+            write_knn_text(g, names, neighbours, distances, missing_distance)
+
+
+def write_appended_matrix_output(args, embeddings, names):
+    """Write the --append_to matrix updated with the distances of the new names"""
+    out_names = append_to_distance_matrix(
+        DistanceMatrix(args.append_to),
+        args.out_file,
+        embeddings,
+        names,
+        drop_removed=args.drop_removed,
+        memory_budget_mb=args.memory_budget,
+    )
+    LOGGER.info(f'Wrote the distances of {len(out_names)} names to {args.out_file}')
+
+
+def write_distance_matrix_output(args, embeddings, names):
+    """Write the upper triangle distance matrix of the embeddings (or the --shard of it)"""
+    row_start, row_end = 0, len(embeddings)
+    if args.shard:
+        shard_idx, num_shards = (int(part) for part in args.shard.split('/'))
+        row_start, row_end = shard_rows(len(embeddings), shard_idx, num_shards)
+        LOGGER.info(f'Shard {shard_idx}/{num_shards}: rows {row_start}-{row_end}')
+
+    blocks = iter_upper_triangle_blocks(
+        embeddings,
+        names,
+        out_format=args.out_format,
+        num_workers=args.num_workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_budget_mb=args.memory_budget,
+        row_start=row_start,
+        row_end=row_end,
+    )
+
+    # Print only the upper triangle distance matrix
+    if args.out_format == 'binary':
+        with BinaryRowsWriter(args.out_file, names, row_start, row_end) as writer:
+            for block_start, block_end, condensed in blocks:
+                writer.add_condensed(block_start, block_end, condensed)
+    else:
+        with open(args.out_file, 'w') as g:
+            for _, _, text in blocks:
+                g.write(text)
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.shard:
+        try:
+            shard_idx, num_shards = (int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error(f"--shard must be I/N (e.g. 2/8), got '{args.shard}'")
+        if num_shards < 1 or not 0 <= shard_idx < num_shards:
+            parser.error(f"--shard must be I/N with 0 <= I < N, got '{args.shard}'")
+    if args.knn is not None:
+        if args.knn < 1:
+            parser.error('--knn must be at least 1')
+        if args.shard:
+            parser.error('--shard cannot be used with --knn')
+    if args.append_to:
+        if args.knn is not None or args.shard:
+            parser.error('--append_to cannot be used with --knn or --shard')
+        if args.out_format != 'binary':
+            parser.error('--append_to writes a binary matrix: use --format binary')
+        if os.path.abspath(args.append_to) == os.path.abspath(args.out_file):
+            parser.error('--output must be a new file, not the --append_to matrix')
     log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
     logging.basicConfig(level=log_level)
-    LOGGER = logging.getLogger(__name__)   
 
 
     LOGGER.info('Running program')
 
 
-    embed_list = []
-    embed = np.load(args.embed_file)
-    for i in range(len(embed["arr_0"])):
-        embed_list.append(embed["arr_0"][i])
+    try:
+        embed_array, name_index = load_named_embeddings(args.embed_file, args.names_file)
+    except (KeyError, ValueError) as error:
+        parser.error(error.args[0])
 
-    print("loaded embs")
-
-
-    name_list = []
-    with open(args.names_file, "r") as f:
-        for line_count,line in enumerate(f):
-            name_list.append(line.rstrip())
-
-    print("loaded names")
+    print("loaded embs and names")
 
 
     # If you do not want to create output for all files in the embedding you can
-    # define a subset with the --subset file.
+    # define a subset with the --subset file. The rows are taken in the order of
+    # the subset file, so each name stays with its own embedding.
     if args.subset_file:
-        embed_names = []
-        with open(args.subset_file, "r") as f:
-            for line_count,line in enumerate(f):
-                embed_names.append(line.rstrip())
-
-        embed_tree = []
-        for i in range(len(name_list)):
-            if name_list[i] in embed_names:
-                embed_tree.append(embed_list[i])
+        embed_names = [name for name in read_names(args.subset_file) if name]
+        try:
+            embed_tree = select_embeddings(embed_array, name_index, embed_names)
+        except (KeyError, ValueError) as error:
+            parser.error(f'--subset {args.subset_file}: {error.args[0]}')
     else:
-        embed_tree = embed_list
-        embed_names = name_list
+        embed_tree = embed_array
+        embed_names = name_index.names
 
 
-    # Print only the upper triangle distance matrix
-    with open(args.out_file, 'w') as g:
-        for i in range(len(embed_tree)):
-            for j in range(i,len(embed_tree)):
-                print(embed_names[i],embed_names[j],np.linalg.norm(embed_tree[i]-embed_tree[j]), file=g)
-
-   
-   
\ No newline at end of file
+    if args.append_to:
+        write_appended_matrix_output(args, embed_tree, embed_names)
+    elif args.knn is not None:
+        write_knn_graph_output(args, embed_tree, embed_names)
+    else:
+        write_distance_matrix_output(args, embed_tree, embed_names)
@@ -0,0 +1,230 @@
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+def load_embeddings(path, *, key=None):
+    """
+    Load a (sequences x embedding size) matrix of embeddings from an .npz or .npy file
+
+    An .npz array is read (and decompressed) once, in a single pass; use `key`
+    for an archive holding more than one array (default: 'arr_0', as written
+    by np.savez, or the only array in the archive). An .npy file is
+    memory-mapped read-only rather than read, so only the rows that are used
+    are ever paged in.
+    """
+    if not zipfile.is_zipfile(path):
+        embeddings = np.load(path, mmap_mode='r')
+        LOG.debug(f"Memory-mapped {embeddings.shape} embeddings from {path}")
+        return embeddings
+
+    with np.load(path) as npz:
+        if key is None:
+            key = 'arr_0' if 'arr_0' in npz.files or len(npz.files) != 1 else npz.files[0]
+        if key not in npz.files:
+            raise KeyError(f"{path} has no array '{key}' (it has {', '.join(npz.files)})")
+        embeddings = npz[key]
+    LOG.debug(f"Loaded {embeddings.shape} embeddings from {path}")
+    return embeddings
+
+
+def read_names(path):
+    """Read a file of names, one per line (e.g. the names in the order of an embedding file)"""
+    with open(path, "r") as f:
+        return [line.rstrip() for line in f]
+
+
+class NameIndex:
+    """
+    Index of the row of each name in a list of names (such as the names file of an embedding file)
+
+    Built once, in O(n), so each lookup is O(1). Names must be unique. With
+    `strip_chars`, names are matched ignoring any of those characters at their
+    start, on both sides (e.g. '>' to match FASTA IDs to the '>A0A.../1-100'
+    names that the embedding scripts write).
+    """
+
+    def __init__(self, names, *, strip_chars=''):
+        self.names = list(names)
+        self.strip_chars = strip_chars
+        self._rows = {}
+        duplicates = []
+        for row, name in enumerate(self.names):
+            key = name.lstrip(strip_chars) if strip_chars else name
+            if key in self._rows:
+                duplicates.append(name)
+            self._rows[key] = row
+        if duplicates:
+            raise ValueError(f"{len(duplicates)} name(s) appear more than once (e.g. {duplicates[0]})")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self._key(name) in self._rows
+
+    def __getitem__(self, name):
+        return self._rows[self._key(name)]
+
+    def _key(self, name):
+        return name.lstrip(self.strip_chars) if self.strip_chars else name
+
+    def rows(self, names, what='names'):
+        """
+        Array of the rows of `names`, in their order, for a single fancy-indexing gather
+
+        Raises a KeyError naming how many of the `what` are not in the index.
+        """
+        rows = np.fromiter((self._rows.get(self._key(name), -1) for name in names), dtype=np.int64)
+        missing = [name for name, row in zip(names, rows) if row < 0]
+        if missing:
+            raise KeyError(f"{len(missing)} of the {what} are not in the index (e.g. {missing[0]})")
+        return rows
+
+
+def load_named_embeddings(embed_path, names_path):
+    """
+    The embeddings of an .npz/.npy file (see `load_embeddings()`) and a `NameIndex` of its names file
+
+    Checks that there is exactly one (unique) name per embedding.
+    """
+    embeddings = load_embeddings(embed_path)
+    index = NameIndex(read_names(names_path))
+    if len(index) != len(embeddings):
+        raise ValueError(f"{names_path} has {len(index)} names, but {embed_path} has {len(embeddings)} embeddings")
+    return embeddings, index
+
+
+def select_embeddings(embeddings, index, subset):
+    """
+    The embeddings of the `subset` names (in the order of `subset`), with one gather
+
+    `index` is the `NameIndex` of the rows of `embeddings`. The subset names
+    must be unique and all in the index.
+    """
+    NameIndex(subset)  # checks the subset for duplicates
+    rows = index.rows(subset, what='subset names')
+    return embeddings[rows]
+
+
+class CdhitClusters:
+    """
+    The clusters of a CD-HIT .clstr file, indexed by member and by center
+
+    Each cluster's `ids`, `centers` and `members` (in file order, center
+    included) are at the same position; `cluster_of_member` and
+    `cluster_of_center` map a sequence ID to that position in O(1).
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.centers = []
+        self.members = []
+        self.cluster_of_member = {}
+        self.cluster_of_center = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def read(cls, path):
+        """Read a .clstr file, in one pass"""
+        clusters = cls()
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0].startswith('>'):
+                    clusters.ids.append(fields[1])
+                    clusters.centers.append('')
+                    clusters.members.append([])
+                    continue
+                # e.g. '0	312aa, >I1PZB9/134-445... at 91.99%' ('... *' for the center)
+                seq_id = fields[2][1:-3]
+                cluster = len(clusters.ids) - 1
+                clusters.members[cluster].append(seq_id)
+                clusters.cluster_of_member[seq_id] = cluster
+                if fields[3] == '*':
+                    clusters.centers[cluster] = seq_id
+                    clusters.cluster_of_center[seq_id] = cluster
+        LOG.debug(f"Read {len(clusters)} clusters of {len(clusters.cluster_of_member)} sequences from {path}")
+        return clusters
+
+
+class FastaOffsetIndex:
+    """
+    Read-only index of where each record of a FASTA file starts and ends, for random access
+
+    Like Bio.SeqIO.index(), keyed on the first word of each header, but the
+    index is a plain dict of byte offsets, so it can be handed to worker
+    processes (each opens the file itself on its first lookup).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self._fh = None
+        with open(path, 'rb') as f:
+            seq_id, start, offset = None, 0, 0
+            for line in f:
+                if line.startswith(b'>'):
+                    if seq_id is not None:
+                        self._add(seq_id, start, offset)
+                    seq_id, start = line[1:].split(None, 1)[0].decode(), offset
+                offset += len(line)
+            if seq_id is not None:
+                self._add(seq_id, start, offset)
+
+    def _add(self, seq_id, start, end):
+        if seq_id in self.offsets:
+            raise ValueError(f"{self.path} has more than one sequence {seq_id}")
+        self.offsets[seq_id] = (start, end)
+
+    def __getstate__(self):
+        return {'path': self.path, 'offsets': self.offsets, '_fh': None}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, seq_id):
+        return seq_id in self.offsets
+
+    def record(self, seq_id):
+        """The record of `seq_id` as '>header\\nsequence\\n', with the sequence on one line"""
+        start, end = self.offsets[seq_id]
+        if self._fh is None:
+            self._fh = open(self.path, 'rb')
+        self._fh.seek(start)
+        header, _, sequence = self._fh.read(end - start).decode().partition('\n')
+        return f">{header[1:].rstrip()}\n{''.join(sequence.split())}\n"
+
+
+def read_fasta_ids(path):
+    """IDs (the first word of each header line, without the '>') of the sequences in a FASTA file"""
+    with open(path, "r") as f:
+        return [line[1:].split()[0] for line in f if line.startswith('>')]
+
+
+def read_starting_clusters(starting_cluster_dir, suffix='.faa'):
+    """
+    Members of each starting cluster in a GeMMA starting clusters directory
+
+    Returns a dict of cluster ID (the file name without `suffix`) to the IDs
+    of the sequences in its file, in file name order.
+    """
+    clusters = {}
+    for filename in sorted(os.listdir(starting_cluster_dir)):
+        if filename.endswith(suffix):
+            clusters[filename[:-len(suffix)]] = read_fasta_ids(os.path.join(starting_cluster_dir, filename))
+    return clusters
+
+
+def read_projects(path):
+    """Read a GeMMA projects file (one project name per line, blank lines ignored)"""
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
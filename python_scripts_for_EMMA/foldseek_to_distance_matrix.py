@@ -1,65 +1,226 @@
 
 import argparse
 import logging
-import os
-import sys
+import re
 import numpy as np
-from skbio import DistanceMatrix
-from skbio.tree import nj
+import pandas as pd
+
+from distance_store import DistanceMatrixWriter, format_distances, sparse_to_graph, write_graph, write_sparse_text
+from emmautils import NameIndex, read_names
+
+
+# distance of the pairs of proteins that foldseek found no hit for
+DEFAULT_MISSING_DISTANCE = 0.02
+
+# the columns that get_fs.sh asks foldseek/mmseqs convertalis for
+DEFAULT_M8_COLUMNS = 'query,target,qlen,tlen,alnlen,bits'
+
+# hits are kept if the alignment covers more than this fraction of both sequences
+DEFAULT_MIN_COVERAGE = 0.6
+
+# lines of an .m8 file parsed at a time
+DEFAULT_M8_CHUNK_LINES = 1000000
+
+# structure files are named after the domain with a 'p' for the '/' before its
+# segment ranges, e.g. A9B055p118-356.pdb for A9B055/118-356
+PDB_FILE_ID_RE = re.compile(r'^(.*)p([0-9][0-9_-]*)$')
+
+
+LOGGER = logging.getLogger(__name__)
 
 
 parser = argparse.ArgumentParser(
-    description="Build a newick tree file based on Grantham differneces of sequences",
+    description="Generate a distance matrix file (1/bitscore) from foldseek hits",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-parser.add_argument('--foldseek_out', '-fso', type=str, dest='foldseek_file', required=True,
-                    help='file from the foldseek output')  
+inputs = parser.add_mutually_exclusive_group(required=True)
+
+inputs.add_argument('--foldseek_out', '-fso', type=str, dest='foldseek_file',
+                    help="'query target bitscore' hits (as get_fs.sh used to write)")
+
+inputs.add_argument('--m8', type=str, dest='m8_file',
+                    help='tab-separated foldseek/mmseqs convertalis output (db_vs_db.m8, optionally compressed), '
+                         'read a chunk at a time and filtered on --min_coverage')
+
+parser.add_argument('--m8_columns', type=str, dest='m8_columns', default=DEFAULT_M8_COLUMNS,
+                    help='comma-separated columns of the --m8 file (its --format-output); needs query, target, qlen, tlen, alnlen and bits')
+
+parser.add_argument('--min_coverage', type=float, dest='min_coverage', default=DEFAULT_MIN_COVERAGE,
+                    help='with --m8, only keep hits with min(alnlen/qlen, alnlen/tlen) above this')
+
+parser.add_argument('--chunk_lines', type=int, dest='chunk_lines', default=DEFAULT_M8_CHUNK_LINES,
+                    help='with --m8, number of lines parsed at a time')
 
 parser.add_argument('--names', '-n', type=str, dest='names_file', required=True,
-                    help='file containing the names of the proteins')                                                                                                           
+                    help='file containing the names of the proteins')
 
 parser.add_argument('--output', '-o', type=str, dest='out_file', required=True,
-                    help='Name for output difference file')   
+                    help='Name for output difference file')
+
+parser.add_argument('--sparse', action='store_true', dest='sparse',
+                    help='only write the pairs with a hit (and the diagonal), with a #missing_distance header line '
+                         'giving the distance of every other pair, instead of a line for every pair')
+
+parser.add_argument('--format', '-f', type=str, dest='out_format', choices=['text', 'binary'], default='text',
+                    help="'name name dist' text lines, or a binary file (plus a .names file): "
+                         "a condensed matrix, or with --sparse a graph of the hits")
+
+parser.add_argument('--missing_distance', type=float, dest='missing_distance', default=DEFAULT_MISSING_DISTANCE,
+                    help='distance of the pairs without a hit')
 
 parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
                     help='more verbose logging')
 
 
 
+def read_foldseek_hits(foldseek_file, index):
+    """The (queries, targets, bitscores) arrays of the hits between `index` names in a 'query target bitscore' file"""
+    queries, targets, bitscores = [], [], []
+    with open(foldseek_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3 or fields[0] not in index or fields[1] not in index:
+                continue
+            queries.append(index[fields[0]])
+            targets.append(index[fields[1]])
+            bitscores.append(float(fields[2]))
+    return np.array(queries, dtype=np.int64), np.array(targets, dtype=np.int64), np.array(bitscores, dtype=np.float64)
+
+
+def structure_id_to_name(structure_id):
+    """
+    The domain name of a foldseek structure ID: without any '.pdb', and with a '/' for the 'p' before the segment ranges
+
+    Only that one 'p' is replaced, so names that contain other p's (e.g. 1pdbA01) stay as they are.
+    """
+    if structure_id.endswith('.pdb'):
+        structure_id = structure_id[:-len('.pdb')]
+    return PDB_FILE_ID_RE.sub(r'\1/\2', structure_id)
+
+
+def read_m8_hits(m8_file, index, columns=DEFAULT_M8_COLUMNS, min_coverage=DEFAULT_MIN_COVERAGE, chunk_lines=DEFAULT_M8_CHUNK_LINES):
+    """
+    The (queries, targets, bitscores) arrays of the hits between `index` names in a foldseek/mmseqs .m8 file
+
+    The file is parsed `chunk_lines` at a time, and each chunk is filtered
+    on coverage (min(alnlen/qlen, alnlen/tlen) > `min_coverage`) and mapped to
+    rows of `index` as whole columns, so only the hits that are kept are held
+    in memory. Each structure ID is mapped once: to itself if it is in
+    `index`, otherwise with `structure_id_to_name()`.
+    """
+    columns = columns.split(',')
+    missing = {'query', 'target', 'qlen', 'tlen', 'alnlen', 'bits'} - set(columns)
+    if missing:
+        raise ValueError(f"the .m8 columns have no {', '.join(sorted(missing))}")
+    rows_of_ids = {}
+
+    def id_rows(ids):
+        for structure_id in ids.unique():
+            if structure_id not in rows_of_ids:
+                name = structure_id if structure_id in index else structure_id_to_name(structure_id)
+                rows_of_ids[structure_id] = index[name] if name in index else -1
+        return ids.map(rows_of_ids).to_numpy(dtype=np.int32)
+
+    queries, targets, bitscores = [], [], []
+    num_lines = 0
+    try:
+        chunks = pd.read_csv(
+            m8_file,
+            sep='\t',
+            header=None,
+            names=columns,
+            usecols=['query', 'target', 'qlen', 'tlen', 'alnlen', 'bits'],
+            dtype={'query': str, 'target': str, 'qlen': np.float64, 'tlen': np.float64, 'alnlen': np.float64, 'bits': np.float64},
+            chunksize=chunk_lines,
+        )
+    except pd.errors.EmptyDataError:
+        chunks = []
+    for chunk in chunks:
+        num_lines += len(chunk)
+        coverage = np.minimum(chunk['alnlen'].to_numpy() / chunk['qlen'].to_numpy(), chunk['alnlen'].to_numpy() / chunk['tlen'].to_numpy())
+        chunk = chunk[coverage > min_coverage]
+        chunk_queries = id_rows(chunk['query'])
+        chunk_targets = id_rows(chunk['target'])
+        known = (chunk_queries >= 0) & (chunk_targets >= 0)
+        queries.append(chunk_queries[known])
+        targets.append(chunk_targets[known])
+        bitscores.append(chunk['bits'].to_numpy()[known])
+    unknown = sum(row < 0 for row in rows_of_ids.values())
+    if unknown:
+        LOGGER.warning(f'{unknown} structure ID(s) of {m8_file} are not in the names (e.g. {next(i for i, row in rows_of_ids.items() if row < 0)})')
+    LOGGER.info(f'Kept {sum(map(len, queries))} of the {num_lines} hits in {m8_file}')
+    if not queries:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+    return np.concatenate(queries), np.concatenate(targets), np.concatenate(bitscores)
+
+
+def best_hits(queries, targets, bitscores, num_names):
+    """
+    The (rows, cols, distances) of the pairs of names with a hit, sorted, with rows < cols and distance 1/bitscore
+
+    A pair with hits both ways takes the hit whose query comes first in the
+    names (and the last such hit), as the pair-by-pair loop did. Hits of a
+    protein to itself are left out.
+    """
+    queries, targets = queries.astype(np.int64, copy=False), targets.astype(np.int64, copy=False)
+    not_self = queries != targets
+    queries, targets, bitscores = queries[not_self], targets[not_self], bitscores[not_self]
+    rows, cols = np.minimum(queries, targets), np.maximum(queries, targets)
+    pair_keys = rows * num_names + cols
+    # for each pair, the forward hit if there is one, and the last one in the file of those
+    order = np.lexsort((-np.arange(len(pair_keys)), queries != rows, pair_keys))
+    _, first = np.unique(pair_keys[order], return_index=True)
+    best = order[first]
+    return rows[best], cols[best], 1 / bitscores[best]
+
+
+def write_dense_text(g, names, rows, cols, dists, missing_distance):
+    """Write a 'name name dist' line for every pair, from each name's diagonal, with `missing_distance` for the pairs without a hit"""
+    row_starts = np.searchsorted(rows, np.arange(len(names) + 1))
+    for i, name_i in enumerate(names):
+        row = np.full(len(names) - i, missing_distance, dtype=np.float64)
+        row[0] = 0.0
+        start, end = row_starts[i], row_starts[i + 1]
+        row[cols[start:end] - i] = dists[start:end]
+        g.writelines(
+            f"{name_i} {name_j} {dist}\n"
+            for name_j, dist in zip(names[i:], format_distances(row))
+        )
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
     log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
     logging.basicConfig(level=log_level)
-    LOGGER = logging.getLogger(__name__)   
 
 
     LOGGER.info('Running program')
 
 
-    fs_list = {}
-    with open(args.foldseek_file,'r') as f:
-        for line_count,line in enumerate(f):
-            line=line.rstrip().split()
-            fs_list[(line[0],line[1])] = line[2]
-
-    name_list = []
-    with open(args.names_file, "r") as f:
-        for line_count,line in enumerate(f):
-            name_list.append(line.rstrip())
-
-
-    with open(args.out_file,'w') as g:
-        for i in range(len(name_list)):
-            for j in range(i,len(name_list)):
-                if name_list[i] == name_list[j]:
-                    print(name_list[i],name_list[j],0.0, file=g)
-                elif (name_list[i],name_list[j]) in fs_list:
-                    print(name_list[i],name_list[j],1/float(fs_list[(name_list[i],name_list[j])]), file=g)
-                elif (name_list[j],name_list[i]) in fs_list:
-                    print(name_list[i],name_list[j],1/float(fs_list[(name_list[j],name_list[i])]), file=g)
-                else:
-                    print(name_list[i],name_list[j],0.02, file=g)
-
-  
-
-   
\ No newline at end of file
+    name_list = [name for name in read_names(args.names_file) if name]
+    index = NameIndex(name_list)
+
+    if args.m8_file:
+        hits = read_m8_hits(args.m8_file, index, args.m8_columns, args.min_coverage, args.chunk_lines)
+    else:
+        hits = read_foldseek_hits(args.foldseek_file, index)
+    rows, cols, dists = best_hits(*hits, len(name_list))
+    LOGGER.info(f'{len(rows)} pairs of the {len(name_list)} proteins have a hit')
+
+
+    if args.out_format == 'binary' and args.sparse:
+        # the graph takes 8 bytes per pair with a hit, the matrix 4 per pair
+        if 2 * len(rows) > len(name_list) * (len(name_list) - 1) // 2:
+            LOGGER.warning('Most pairs have a hit, so the binary matrix (without --sparse) would be smaller than the graph')
+        write_graph(args.out_file, name_list, *sparse_to_graph(len(name_list), rows, cols, dists), args.missing_distance)
+    elif args.out_format == 'binary':
+        with DistanceMatrixWriter(args.out_file, name_list) as writer:
+            writer.fill_unset(args.missing_distance)
+            writer.set_pairs(rows, cols, dists)
+    elif args.sparse:
+        with open(args.out_file, 'w') as g:
+            write_sparse_text(g, name_list, rows, cols, dists, args.missing_distance)
+    else:
+        with open(args.out_file, 'w') as g:
+            # rows are in order already, as best_hits() returns the pairs sorted
+            write_dense_text(g, name_list, rows, cols, dists, args.missing_distance)
@@ -4,7 +4,6 @@ import logging
 import os
 # import sys
 from Bio import SeqIO
-import matplotlib.pyplot as plt
 import numpy as np
 
 # This script follows the formula from the following manuscript from the Sjolander group:
@@ -0,0 +1,436 @@
+import collections
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from distance_store import DTYPE, BinaryRowsWriter, condensed_row_start, format_distances, strip_to_condensed
+from emmautils import NameIndex
+
+LOG = logging.getLogger(__name__)
+
+# memory (in MB) that one strip of distances (and its temporaries) may take up
+DEFAULT_MEMORY_BUDGET_MB = 512
+
+# squared distances below this fraction of the squared norms lose too many
+# digits to cancellation in the norm identity, so they are recomputed directly
+RECOMPUTE_RELATIVE_TOLERANCE = 1e-6
+
+# environment variables that set the number of threads of the common BLAS libraries
+BLAS_THREAD_ENVVARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+# rows converted to float64 at a time when computing norms
+NORM_CHUNK_ROWS = 4096
+
+
+def squared_norms(embeddings):
+    """Squared Euclidean norm of each row, in float64 (a chunk of rows at a time)"""
+    norms = np.empty(len(embeddings), dtype=np.float64)
+    for start in range(0, len(embeddings), NORM_CHUNK_ROWS):
+        chunk = np.asarray(embeddings[start:start + NORM_CHUNK_ROWS], dtype=np.float64)
+        norms[start:start + len(chunk)] = np.einsum('ij,ij->i', chunk, chunk)
+    return norms
+
+
+def block_shape(num_rows, embedding_size, itemsize=4, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Number of rows in each strip of the distance matrix, and of columns in each tile of a strip
+
+    Half of the budget goes on the strip of distances (`itemsize` bytes each)
+    and half on computing one tile of it: the float64 product and norm sums
+    plus the tile's columns of the embeddings in float64.
+    """
+    half_budget = memory_budget_mb * 1024 * 1024 // 2
+    strip_rows = max(1, half_budget // (max(num_rows, 1) * itemsize))
+    tile_cols = max(1, half_budget // (strip_rows * 2 * 8 + embedding_size * 8))
+    return min(strip_rows, max(num_rows, 1)), min(tile_cols, max(num_rows, 1))
+
+
+def distance_block(rows, cols, row_norms=None, col_norms=None):
+    """
+    Euclidean distances between every row of `rows` and every row of `cols`
+
+    Uses ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, so the work is one float64
+    matrix product. Pass the `squared_norms()` of the rows and columns to avoid
+    recomputing them for every block. Distances that are tiny compared with the
+    norms are recomputed as norm(a - b), so near-duplicates (and a vector with
+    itself) get the same value as the direct calculation rather than rounding noise.
+    The distances have the precision of the embeddings (float32, or float64 if
+    the embeddings are float64), as norm(a - b) would.
+    """
+    out_dtype = np.promote_types(np.asarray(rows).dtype, np.float32)
+    rows64 = np.asarray(rows, dtype=np.float64)
+    cols64 = np.asarray(cols, dtype=np.float64)
+    if row_norms is None:
+        row_norms = squared_norms(rows64)
+    if col_norms is None:
+        col_norms = squared_norms(cols64)
+
+    norm_sums = row_norms[:, None] + col_norms[None, :]
+    squared = rows64 @ cols64.T
+    squared *= -2
+    squared += norm_sums
+    np.maximum(squared, 0, out=squared)
+
+    inexact_rows, inexact_cols = np.nonzero(squared <= RECOMPUTE_RELATIVE_TOLERANCE * norm_sums)
+    del norm_sums
+    if len(inexact_rows):
+        diffs = np.asarray(rows, dtype=out_dtype)[inexact_rows] - np.asarray(cols, dtype=out_dtype)[inexact_cols]
+        squared[inexact_rows, inexact_cols] = np.einsum('ij,ij->i', diffs, diffs)
+
+    return np.sqrt(squared, out=squared).astype(out_dtype, copy=False)
+
+
+def row_blocks(num_rows, embedding_size, itemsize=4, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, row_start=0, row_end=None):
+    """
+    Split the rows [row_start, row_end) of the upper triangle into (start, end) strips
+
+    Later rows have fewer columns to their right, so their strips get more
+    rows: each strip stays within the memory budget and strips do similar
+    amounts of work.
+    """
+    row_end = num_rows if row_end is None else row_end
+    blocks = []
+    start = row_start
+    while start < row_end:
+        strip_rows, _ = block_shape(num_rows - start, embedding_size, itemsize, memory_budget_mb)
+        blocks.append((start, min(start + strip_rows, row_end)))
+        start = blocks[-1][1]
+    return blocks
+
+
+def shard_rows(num_rows, shard_idx, num_shards):
+    """
+    The rows [row_start, row_end) of shard `shard_idx` of `num_shards` of the upper triangle
+
+    Shards are contiguous and hold about the same number of pairs, so their
+    outputs can simply be concatenated in shard order.
+    """
+    # number of upper triangle pairs (with the diagonal) before each row
+    pairs_before = np.arange(num_rows + 1) * num_rows - np.arange(num_rows + 1) * (np.arange(num_rows + 1) - 1) // 2
+    bounds = np.searchsorted(pairs_before, [pairs_before[-1] * k / num_shards for k in (shard_idx, shard_idx + 1)])
+    return int(bounds[0]), int(bounds[1])
+
+
+def upper_triangle_strip(embeddings, norms, row_start, row_end, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Distances of rows [row_start, row_end) to the columns from row_start onwards
+
+    Row i of the matrix from column i is `strip[i - row_start, i - row_start:]`.
+    The strip is computed tile by tile to stay within `memory_budget_mb`.
+    """
+    num_rows = len(embeddings)
+    out_dtype = np.promote_types(embeddings.dtype, np.float32)
+    _, tile_cols = block_shape(num_rows - row_start, embeddings.shape[1], out_dtype.itemsize, memory_budget_mb)
+    strip = np.empty((row_end - row_start, num_rows - row_start), dtype=out_dtype)
+    for col_start in range(row_start, num_rows, tile_cols):
+        col_end = min(col_start + tile_cols, num_rows)
+        strip[:, col_start - row_start:col_end - row_start] = distance_block(
+            embeddings[row_start:row_end],
+            embeddings[col_start:col_end],
+            norms[row_start:row_end],
+            norms[col_start:col_end],
+        )
+    return strip
+
+
+def iter_upper_triangle_rows(embeddings, *, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, row_start=0, row_end=None):
+    """
+    Yield (row_start, strip) for the upper triangle (with the diagonal) of the distance matrix
+
+    Covers rows [row_start, row_end) (default: all of them) in order; see
+    `upper_triangle_strip()` for the layout of each strip.
+    """
+    embeddings = np.asarray(embeddings)
+    norms = squared_norms(embeddings)
+    out_dtype = np.promote_types(embeddings.dtype, np.float32)
+    for start, end in row_blocks(len(embeddings), embeddings.shape[1], out_dtype.itemsize, memory_budget_mb, row_start, row_end):
+        yield start, upper_triangle_strip(embeddings, norms, start, end, memory_budget_mb)
+
+
+def format_upper_triangle_text(names, row_start, strip):
+    """
+    The 'name name dist' lines (the `emb` file format) of a strip of rows
+
+    Lines come in the same order as the original pair-by-pair loop: row by
+    row, each row starting at its own diagonal.
+    """
+    lines = []
+    for offset, row in enumerate(strip):
+        i = row_start + offset
+        name_i = names[i]
+        lines.extend(
+            f"{name_i} {name_j} {dist}\n"
+            for name_j, dist in zip(names[i:], format_distances(row[offset:]))
+        )
+    return "".join(lines)
+
+
+def write_upper_triangle_text(fh, names, embeddings, *, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Write the upper triangle distances as 'name name dist' lines"""
+    for row_start, strip in iter_upper_triangle_rows(embeddings, memory_budget_mb=memory_budget_mb):
+        fh.write(format_upper_triangle_text(names, row_start, strip))
+
+
+def cross_distance_strip(rows, row_norms, cols, col_norms, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Distances of every row of `rows` to every row of `cols`, computed tile by tile (see `upper_triangle_strip()`)"""
+    out_dtype = np.promote_types(rows.dtype, np.float32)
+    _, tile_cols = block_shape(len(cols), rows.shape[1], out_dtype.itemsize, memory_budget_mb)
+    strip = np.empty((len(rows), len(cols)), dtype=out_dtype)
+    for col_start in range(0, len(cols), tile_cols):
+        col_end = min(col_start + tile_cols, len(cols))
+        strip[:, col_start:col_end] = distance_block(rows, cols[col_start:col_end], row_norms, col_norms[col_start:col_end])
+    return strip
+
+
+def append_to_distance_matrix(matrix, out_path, embeddings, names, *, drop_removed=False, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Write to `out_path` the binary distance matrix of `matrix` (a `DistanceMatrix`) updated to `names`
+
+    The names of `matrix` that are also in `names` keep their order and come
+    first, followed by the names that are new, in the order of `names`. Only
+    the distances involving a new name are computed (the new x old and
+    new x new blocks, from the `embeddings` of `names`); the old ones are
+    copied over, so the work grows with the number of new names rather than
+    with the size of the whole matrix. Names of `matrix` that are not in
+    `names` are left out with `drop_removed`, and are an error otherwise (as
+    there is no embedding to compute their distances to the new names from).
+    Returns the names of the updated matrix.
+    """
+    embeddings = np.asarray(embeddings) if not isinstance(embeddings, np.memmap) else embeddings
+    embedding_rows = NameIndex(names)
+    removed = [name for name in matrix.names if name not in embedding_rows]
+    if removed and not drop_removed:
+        raise ValueError(f"{len(removed)} name(s) of {matrix.path} have no embedding (e.g. {removed[0]}); drop them or add their embeddings")
+    kept_rows = np.array([i for i, name in enumerate(matrix.names) if name in embedding_rows], dtype=np.int64)
+    kept_names = [matrix.names[i] for i in kept_rows]
+    new_names = [name for name in names if name not in matrix.index]
+    out_names = kept_names + new_names
+    LOG.info(f"Appending {len(new_names)} name(s) to the {len(kept_names)} kept of {len(matrix)} in {matrix.path} (dropping {len(removed)})")
+
+    kept_embeddings = embeddings[embedding_rows.rows(kept_names)]
+    new_embeddings = embeddings[embedding_rows.rows(new_names)]
+    kept_norms = squared_norms(kept_embeddings)
+    new_norms = squared_norms(new_embeddings)
+    num_kept, num_old = len(kept_names), len(matrix)
+
+    with BinaryRowsWriter(out_path, out_names) as writer:
+        # each kept row: its old distances to the later kept rows, then its new distances to the new rows
+        for start, end in row_blocks(len(out_names), embeddings.shape[1], DTYPE.itemsize, memory_budget_mb, 0, num_kept):
+            start_time = time.perf_counter()
+            to_new = cross_distance_strip(kept_embeddings[start:end], kept_norms[start:end], new_embeddings, new_norms, memory_budget_mb)
+            parts = []
+            for offset, old_row in enumerate(kept_rows[start:end]):
+                old_start = condensed_row_start(old_row, num_old)
+                old_dists = matrix.condensed[old_start:old_start + num_old - old_row - 1]
+                if len(removed):
+                    old_dists = old_dists[kept_rows[start + offset + 1:] - old_row - 1]
+                parts.append(old_dists)
+                parts.append(to_new[offset])
+            writer.add_condensed(start, end, np.concatenate(parts) if parts else np.zeros(0, dtype=DTYPE))
+            LOG.info(f"Rows {start}-{end}: {to_new.size} new distances in {time.perf_counter() - start_time:.2f}s")
+        # the new rows: the upper triangle of the new x new block
+        for start, strip in iter_upper_triangle_rows(new_embeddings, memory_budget_mb=memory_budget_mb):
+            writer.add_condensed(num_kept + start, num_kept + start + len(strip), strip_to_condensed(strip))
+    return out_names
+
+
+def knn_strip(embeddings, norms, row_start, row_end, k, cutoff=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    The k nearest neighbours of each of the rows [row_start, row_end) among all the rows
+
+    Returns (neighbours, distances): (rows x k) arrays of row indices (int32)
+    and distances, nearest first. Each row is searched against the columns a
+    tile at a time, keeping only the best k so far, so the dense rows are never
+    held in memory. A row is not its own neighbour. Rows with fewer than k
+    neighbours (within `cutoff`, if given) are padded with index -1 and an
+    infinite distance.
+    """
+    num_rows = len(embeddings)
+    out_dtype = np.promote_types(embeddings.dtype, np.float32)
+    _, tile_cols = block_shape(num_rows, embeddings.shape[1], out_dtype.itemsize, memory_budget_mb)
+    row_idxs = np.arange(row_start, row_end)
+    best_idxs = np.full((len(row_idxs), k), -1, dtype=np.int64)
+    best_dists = np.full((len(row_idxs), k), np.inf, dtype=out_dtype)
+    for col_start in range(0, num_rows, tile_cols):
+        col_end = min(col_start + tile_cols, num_rows)
+        block = distance_block(
+            embeddings[row_start:row_end],
+            embeddings[col_start:col_end],
+            norms[row_start:row_end],
+            norms[col_start:col_end],
+        )
+        col_idxs = np.arange(col_start, col_end)
+        block[row_idxs[:, None] == col_idxs[None, :]] = np.inf
+        cand_dists = np.concatenate([best_dists, block], axis=1)
+        cand_idxs = np.concatenate([best_idxs, np.broadcast_to(col_idxs, block.shape)], axis=1)
+        keep = np.argpartition(cand_dists, k - 1, axis=1)[:, :k]
+        best_dists = np.take_along_axis(cand_dists, keep, axis=1)
+        best_idxs = np.take_along_axis(cand_idxs, keep, axis=1)
+
+    order = np.argsort(best_dists, axis=1, kind='stable')
+    best_dists = np.take_along_axis(best_dists, order, axis=1)
+    best_idxs = np.take_along_axis(best_idxs, order, axis=1)
+    missing = ~np.isfinite(best_dists)
+    if cutoff is not None:
+        missing |= best_dists > cutoff
+    best_idxs[missing] = -1
+    best_dists[missing] = np.inf
+    return best_idxs.astype(np.int32), best_dists.astype(np.float32)
+
+
+def knn_graph(embeddings, k, *, cutoff=None, num_workers=1, threads_per_worker=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    Exact k-nearest-neighbour graph of the embeddings (see `knn_strip()`)
+
+    Returns (neighbours, distances) arrays of shape (rows x k), which take
+    O(rows * k) memory; the dense distance matrix is never materialized.
+    The rows are searched in strips, in parallel as for `iter_upper_triangle_blocks()`.
+    """
+    embeddings = np.asarray(embeddings) if not isinstance(embeddings, np.memmap) else embeddings
+    num_rows = len(embeddings)
+    out_dtype = np.promote_types(embeddings.dtype, np.float32)
+    strip_rows, _ = block_shape(num_rows, embeddings.shape[1], out_dtype.itemsize, memory_budget_mb)
+    blocks = [(start, min(start + strip_rows, num_rows)) for start in range(0, num_rows, strip_rows)]
+    neighbours = np.empty((num_rows, k), dtype=np.int32)
+    distances = np.empty((num_rows, k), dtype=np.float32)
+    task = {'kind': 'knn', 'k': k, 'cutoff': cutoff, 'memory_budget_mb': memory_budget_mb}
+    LOG.info(f"Searching the {k} nearest neighbours of {num_rows} rows in {len(blocks)} strip(s) with {num_workers} worker(s)")
+    for start, end, (strip_neighbours, strip_distances) in _iter_block_outputs(embeddings, blocks, task, num_workers, threads_per_worker):
+        neighbours[start:end] = strip_neighbours
+        distances[start:end] = strip_distances
+    return neighbours, distances
+
+
+# state of each worker process, set up by `_init_worker()`
+_WORKER = {}
+
+
+def _compute_block(embeddings, norms, task, row_start, row_end):
+    """
+    The output of one strip of rows for `task`, the number of distances computed and how long it took
+
+    The output is the text lines or the condensed float32 distances of the
+    upper triangle rows (for task kinds 'text' and 'binary'), or the
+    (neighbours, distances) of the rows (for 'knn').
+    """
+    start_time = time.perf_counter()
+    if task['kind'] == 'knn':
+        output = knn_strip(embeddings, norms, row_start, row_end, task['k'], task['cutoff'], task['memory_budget_mb'])
+        num_distances = (row_end - row_start) * len(embeddings)
+    else:
+        strip = upper_triangle_strip(embeddings, norms, row_start, row_end, task['memory_budget_mb'])
+        if task['kind'] == 'text':
+            output = format_upper_triangle_text(task['names'], row_start, strip)
+        else:
+            output = strip_to_condensed(strip)
+        num_rows = len(embeddings)
+        num_distances = (row_end - row_start) * (num_rows - row_start) - (row_end - row_start) * (row_end - row_start - 1) // 2
+    return output, num_distances, time.perf_counter() - start_time
+
+
+def _init_worker(embeddings_path, norms, task):
+    _WORKER['args'] = (np.load(embeddings_path, mmap_mode='r'), norms, task)
+
+
+def _worker_block(row_start, row_end):
+    return _compute_block(*_WORKER['args'], row_start, row_end)
+
+
+def _shared_embeddings_path(embeddings, tmp_dir):
+    """
+    Path of an .npy file of `embeddings` that the workers can memory-map
+
+    A memory-mapped .npy input is used as it is. Anything else is written to
+    `tmp_dir` (in /dev/shm where there is one), so that all the workers share
+    one copy of the embeddings through the page cache.
+    """
+    if isinstance(embeddings, np.memmap) and embeddings.filename:
+        try:
+            shared = np.load(embeddings.filename, mmap_mode='r')
+            if shared.shape == embeddings.shape and shared.dtype == embeddings.dtype:
+                return embeddings.filename
+        except ValueError:
+            pass
+    path = os.path.join(tmp_dir, 'embeddings.npy')
+    np.save(path, np.asarray(embeddings))
+    return path
+
+
+def iter_upper_triangle_blocks(embeddings, names, *, out_format='text', num_workers=1, threads_per_worker=None,
+                               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, row_start=0, row_end=None):
+    """
+    Yield (row_start, row_end, output) for strips of the upper triangle, in row order
+
+    `output` is the text lines (for `out_format` 'text') or the condensed
+    float32 distances (for 'binary') of rows [row_start, row_end), ready for a
+    single writer. With more than one worker, the strips are computed in a pool
+    of processes sharing one memory-mapped copy of the embeddings, each using
+    `threads_per_worker` BLAS threads (default: the CPUs split between them)
+    and up to `memory_budget_mb`. The throughput of each strip is logged.
+    """
+    embeddings = np.asarray(embeddings) if not isinstance(embeddings, np.memmap) else embeddings
+    num_rows = len(embeddings)
+    out_dtype = np.promote_types(embeddings.dtype, np.float32)
+    blocks = row_blocks(num_rows, embeddings.shape[1], out_dtype.itemsize, memory_budget_mb, row_start, row_end)
+    task = {'kind': out_format, 'names': names, 'memory_budget_mb': memory_budget_mb}
+    LOG.info(f"Computing {len(blocks)} strip(s) of rows {row_start}-{blocks[-1][1] if blocks else row_start} of {num_rows} with {num_workers} worker(s)")
+    yield from _iter_block_outputs(embeddings, blocks, task, num_workers, threads_per_worker)
+
+
+def _iter_block_outputs(embeddings, blocks, task, num_workers, threads_per_worker):
+    """Yield (row_start, row_end, output) of `task` for each (row_start, row_end) block, in order"""
+    norms = squared_norms(embeddings)
+
+    def log_throughput(start, end, num_distances, seconds):
+        LOG.info(f"Rows {start}-{end}: {num_distances} distances in {seconds:.2f}s ({num_distances / max(seconds, 1e-9):.0f}/s)")
+
+    if num_workers <= 1:
+        for start, end in blocks:
+            output, num_distances, seconds = _compute_block(embeddings, norms, task, start, end)
+            log_throughput(start, end, num_distances, seconds)
+            yield start, end, output
+        return
+
+    threads_per_worker = threads_per_worker or max(1, len(os.sched_getaffinity(0)) // num_workers)
+    tmp_dir = tempfile.mkdtemp(prefix='emma_distances_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        embeddings_path = _shared_embeddings_path(embeddings, tmp_dir)
+        # spawned workers read these when they import numpy, so they don't each
+        # start a BLAS thread per CPU
+        saved_environ = {var: os.environ.get(var) for var in BLAS_THREAD_ENVVARS}
+        os.environ.update({var: str(threads_per_worker) for var in BLAS_THREAD_ENVVARS})
+        try:
+            pool = multiprocessing.get_context('spawn').Pool(
+                num_workers,
+                initializer=_init_worker,
+                initargs=(embeddings_path, norms, task),
+            )
+        finally:
+            for var, value in saved_environ.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+
+        with pool:
+            # keep a bounded number of strips in flight, so finished strips
+            # never pile up in memory waiting for the writer
+            pending = collections.deque()
+            next_block = 0
+            while pending or next_block < len(blocks):
+                while next_block < len(blocks) and len(pending) < 2 * num_workers:
+                    start, end = blocks[next_block]
+                    pending.append((start, end, pool.apply_async(_worker_block, (start, end))))
+                    next_block += 1
+                start, end, result = pending.popleft()
+                output, num_distances, seconds = result.get()
+                log_throughput(start, end, num_distances, seconds)
+                yield start, end, output
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -1,7 +1,14 @@
 import argparse
 import logging
+import multiprocessing
 import os
-from Bio import SeqIO
+import re
+import uuid
+
+from emmautils import CdhitClusters, FastaOffsetIndex
+
+
+LOGGER = logging.getLogger(__name__)
 
 
 parser = argparse.ArgumentParser(
@@ -14,80 +21,149 @@ parser.add_argument('--funfamdir', '-ffd', type=str, dest='funfamdir', required=
 parser.add_argument('--clusterfile', '-cf', type=str, dest='cluster_file', required=True,
                     help='file containing the clusters')                   
 
-parser.add_argument('--sequences', '-seqs', type=str, dest='seqfile', required=False,
+parser.add_argument('--sequences', '-seqs', type=str, dest='seqfile', required=True,
                     help='file containing all of the sequences')  
 
 parser.add_argument('--out_sc', '-o', type=str, dest='out_sc', required=True,
                     help='Folder for the new starting clusters')                                                                                                           
+
+parser.add_argument('--num_workers', '-w', type=int, dest='num_workers', default=1,
+                    help='number of processes reducing FunFam files')
+
 parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
                     help='more verbose logging')
 
 # This script reduces FunFams to just their starting clusters. The names for the 
-# new starting clusters are working_XX.aln. You can use this script sequentially
-# on several sets of FunFam folders as the numbering of XX will continuously go up.
+# new starting clusters are working_XX.faa. You can use this script sequentially
+# on several sets of FunFam folders as the numbering of XX will continuously go up,
+# or at the same time on one folder, as each number is only ever taken once.
+
+
+# names of the starting cluster files this script writes: working_<N>.faa
+WORKING_PREFIX = 'working_'
+WORKING_SUFFIX = '.faa'
+WORKING_FILE_RE = re.compile(rf'^{WORKING_PREFIX}(\d+){re.escape(WORKING_SUFFIX)}$')
+
+# FunFam files handed to a worker at a time
+POOL_CHUNK_FILES = 16
+
+
+def reduce_funfam(funfam_path, clusters, sequences):
+    """
+    The starting cluster of a FunFam alignment: the FASTA records of the cluster centers among its sequences
+
+    Each header is looked up in the center index of `clusters` (a
+    `CdhitClusters`); the records come from `sequences` (a
+    `FastaOffsetIndex`), without gaps.
+    """
+    records = []
+    with open(funfam_path, 'r') as f:
+        for line in f:
+            if line.startswith('>') and line.rstrip()[1:] in clusters.cluster_of_center:
+                header, sequence, _ = sequences.record(line.rstrip()[1:]).split('\n')
+                records.append(f"{header}\n{sequence.replace('-', '')}\n")
+    return ''.join(records)
+
+
+def next_working_number(out_dir):
+    """The number after the highest of the working_N files in `out_dir` (1 if there are none)"""
+    numbers = [int(match.group(1)) for match in map(WORKING_FILE_RE.match, os.listdir(out_dir)) if match]
+    return max(numbers, default=0) + 1
+
+
+def write_working_file(out_dir, text, number):
+    """
+    Write `text` to the first free working_N.faa of `out_dir` from N = `number`, and return N
+
+    The text is written to a temporary file, which is then hard linked to
+    the name. Linking fails if the name is taken, so several processes (or
+    runs, on any of the nodes sharing the directory) can write into one
+    directory at the same time without ever sharing a number, and no one
+    sees a partly written file. The temporary file has a random name, as
+    process IDs are only unique on one node.
+    """
+    tmp_path = os.path.join(out_dir, f'.{WORKING_PREFIX}tmp.{uuid.uuid4().hex}')
+    try:
+        with open(tmp_path, 'x') as g:
+            g.write(text)
+        while True:
+            try:
+                os.link(tmp_path, os.path.join(out_dir, f'{WORKING_PREFIX}{number}{WORKING_SUFFIX}'))
+                return number
+            except FileExistsError:
+                number += 1
+    finally:
+        # don't let a failed clean up hide the error (if any) of the write or link
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            LOGGER.warning(f'Could not remove temporary file {tmp_path}: {error}')
+
+
+# state of each worker process, set up by `_init_worker()`
+_WORKER = {}
+
+
+def _init_worker(clusters, sequences):
+    _WORKER['clusters'] = clusters
+    _WORKER['sequences'] = sequences
+
+
+def _worker_reduce_funfam(funfam_path):
+    return reduce_funfam(funfam_path, _WORKER['clusters'], _WORKER['sequences'])
+
+
+def reduce_funfams(funfam_dir, out_dir, clusters, sequences, num_workers=1):
+    """
+    Write a starting cluster file to `out_dir` for each FunFam alignment (.aln) in `funfam_dir`
+
+    The FunFams are reduced by `num_workers` processes sharing `clusters` and
+    `sequences`, and written in file name order, numbered on from the
+    working_N files already in `out_dir`. Returns the numbers written.
+    """
+    funfam_paths = [os.path.join(funfam_dir, funfam_file) for funfam_file in sorted(os.listdir(funfam_dir)) if funfam_file.endswith('.aln')]
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(clusters, sequences))
+        texts = pool.imap(_worker_reduce_funfam, funfam_paths, chunksize=POOL_CHUNK_FILES)
+    else:
+        pool = None
+        texts = (reduce_funfam(funfam_path, clusters, sequences) for funfam_path in funfam_paths)
+    numbers = []
+    try:
+        number = next_working_number(out_dir)
+        for text in texts:
+            number = write_working_file(out_dir, text, number)
+            numbers.append(number)
+            number += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return numbers
 
 
-class Starting_clust:
-    def __init__(self,clust_id):
-        self.id = clust_id
-        self.seqs = set()
-        self.center = ''
-
-    def add_seq(self,seqid):
-        self.seqs.add(seqid)
-
-    def add_center(self,seqid):
-        self.seqs.add(seqid)
-        self.center = seqid
 
 if __name__ == '__main__':
     args = parser.parse_args()
     log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
     logging.basicConfig(level=log_level)
-    LOGGER = logging.getLogger(__name__)   
 
 
     LOGGER.info('Running program')
 
-    allseqs = SeqIO.index(args.seqfile, "fasta")
-
-
-
-    # Load up cluster info
-    allclusts = []
-    with open(args.cluster_file, 'r') as f:
-        for line_count,line in enumerate(f):
-            line=line.rstrip().split()
-            if line[0].startswith('>'):
-                try:
-                    allclusts.append(curr_clust)
-                except:
-                    LOGGER.debug('no')
-                curr_clust = Starting_clust(line[1])
-            else:
-                if line[3] == '*':
-                    curr_clust.add_center(line[2][1:][:-3])
-                else:
-                    curr_clust.add_seq(line[2][1:][:-3])
-        allclusts.append(curr_clust)
-    
+    sequences = FastaOffsetIndex(args.seqfile)
+    LOGGER.info(f'Indexed {len(sequences)} sequences')
+
+    # Load up cluster info (indexed by cluster center)
+    clusters = CdhitClusters.read(args.cluster_file)
+    LOGGER.info(f'Loaded {len(clusters)} clusters')
+
     # redo all the cluster files
 
     os.makedirs(args.out_sc, exist_ok=True)
 
-    # Get the number of starting clusters already present in the directroy
-    scnum=1
-    for scfile in os.listdir(args.out_sc):
-        scnum+=1
-        
-    for funfam_file in os.listdir(args.funfamdir):
-        if funfam_file.endswith('.aln'):
-            scnum+=1
-            with open(args.funfamdir+'/'+funfam_file,'r') as f:
-                with open(args.out_sc+'/working_'+str(scnum)+'.faa','w') as g:
-                    for line_count,line in enumerate(f):
-                        if line.startswith('>'):
-                            for clust in allclusts:
-                                if clust.center == line.rstrip()[1:]:
-                                    print('>'+allseqs[clust.center].description, file=g)
-                                    print(str(allseqs[clust.center].seq).replace("-",""),file=g)
+    numbers = reduce_funfams(args.funfamdir, args.out_sc, clusters, sequences, args.num_workers)
+    if numbers:
+        LOGGER.info(f'Wrote {len(numbers)} starting clusters, {WORKING_PREFIX}{numbers[0]} to {WORKING_PREFIX}{numbers[-1]}')
@@ -1,10 +1,27 @@
 import argparse
+import glob
 import logging
+import multiprocessing
 import os
-import sys
-import numpy as np
-from Bio import SeqIO
-from subprocess import call
+import shutil
+import time
+
+from emmautils import CdhitClusters, FastaOffsetIndex
+
+
+LOGGER = logging.getLogger(__name__)
+
+# bytes buffered by each output file before it is written out
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+# the alignment directories of a GeMMA tree, refilled in this order
+ALIGNMENT_DIRS = ['starting_cluster_alignments', 'merge_node_alignments']
+
+# alignment files handed to a worker at a time
+POOL_CHUNK_FILES = 16
+
+# ways of filling in an output file that is the same as one already written
+LINK_MODES = ['copy', 'hardlink', 'symlink']
 
 
 parser = argparse.ArgumentParser(
@@ -22,22 +39,152 @@ parser.add_argument('--sequences', '-seqs', type=str, dest='seqfile', required=T
 
 parser.add_argument('--out_tree', '-o', type=str, dest='out_tree', required=True,
                     help='Folder for the new enhanced tree')                                                                                                           
+
+parser.add_argument('--num_workers', '-w', type=int, dest='num_workers', default=1,
+                    help='number of processes reading and writing alignment files')
+
+parser.add_argument('--link', type=str, dest='link', choices=LINK_MODES, default='copy',
+                    help='how to fill in the tree files: copy them, or hard link or symlink them to the input tree. '
+                         'An alignment is only linked if its clusters are exactly those of one already written, '
+                         'which does not happen in a normal tree (every node has a different set of clusters)')
+
 parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
                     help='more verbose logging')
 
 
-class Starting_clust:
-    def __init__(self,clust_id):
-        self.id = clust_id
-        self.seqs = set()
-        self.center = ''
 
-    def add_seq(self,seqid):
-        self.seqs.add(seqid)
+def alignment_clusters(alignment_path, clusters):
+    """
+    The clusters of the sequences in the alignment at `alignment_path`, in order, each once
+
+    The alignment is read in one pass; each header is looked up in the
+    member index of `clusters` (a `CdhitClusters`). Returns a tuple of cluster
+    positions, so alignments with the same clusters have equal keys.
+    """
+    found = {}
+    with open(alignment_path, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                cluster = clusters.cluster_of_member.get(line.rstrip()[1:])
+                if cluster is not None:
+                    found.setdefault(cluster, None)
+    return tuple(found)
+
+
+def write_clusters(out_path, cluster_list, clusters, sequences):
+    """
+    Atomically write the FASTA records (from `sequences`, a `FastaOffsetIndex`) of all the members of `cluster_list`
+
+    The records go to a temporary file next to `out_path` through a buffered
+    writer, which then replaces `out_path`, so readers never see a partly
+    written file. Returns the number of sequences written.
+    """
+    tmp_path = f'{out_path}.tmp{os.getpid()}'
+    num_written = 0
+    with open(tmp_path, 'w', buffering=WRITE_BUFFER_BYTES) as g:
+        for cluster in cluster_list:
+            members = clusters.members[cluster]
+            g.write(''.join(sequences.record(seq_id) for seq_id in members))
+            num_written += len(members)
+    os.replace(tmp_path, out_path)
+    return num_written
+
+
+def refill_alignment(alignment_path, out_path, clusters, sequences):
+    """Write to `out_path` all the members of the clusters of the sequences in the alignment at `alignment_path`"""
+    return write_clusters(out_path, alignment_clusters(alignment_path, clusters), clusters, sequences)
+
+
+def link_file(src_path, out_path, link):
+    """Atomically make `out_path` a copy, hard link or (relative) symlink of `src_path`"""
+    tmp_path = f'{out_path}.tmp{os.getpid()}'
+    if link == 'hardlink':
+        os.link(src_path, tmp_path)
+    elif link == 'symlink':
+        os.symlink(os.path.relpath(src_path, os.path.dirname(out_path)), tmp_path)
+    else:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, out_path)
+
+
+# state of each worker process, set up by `_init_worker()`
+_WORKER = {}
+
+
+def _init_worker(clusters, sequences):
+    _WORKER['clusters'] = clusters
+    _WORKER['sequences'] = sequences
+
+
+def _worker_alignment_clusters(alignment_path):
+    return alignment_clusters(alignment_path, _WORKER['clusters'])
+
+
+def _worker_write_clusters(job):
+    out_path, cluster_list = job
+    return write_clusters(out_path, cluster_list, _WORKER['clusters'], _WORKER['sequences'])
+
+
+def refill_tree(treedir, out_tree, clusters, sequences, num_workers=1, link='copy'):
+    """
+    Refill the starting cluster and merge node alignments of the tree in `treedir` into `out_tree`
+
+    The files are first read for their clusters, then written, each step
+    spread over `num_workers` processes that share `clusters` and the
+    `sequences` offset index. With `link` 'hardlink' or 'symlink', an output
+    whose alignment has exactly the same clusters as one already written is
+    linked to that one instead of being written again. In a GeMMA tree every
+    starting cluster and merge node has a different set of clusters, so this
+    only saves anything for trees with duplicated alignment files.
+    """
+    jobs = []
+    for alignment_dir in ALIGNMENT_DIRS:
+        os.makedirs(os.path.join(out_tree, alignment_dir), exist_ok=True)
+        for alignment_file in sorted(os.listdir(os.path.join(treedir, alignment_dir))):
+            jobs.append((os.path.join(treedir, alignment_dir, alignment_file), os.path.join(out_tree, alignment_dir, alignment_file)))
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(clusters, sequences))
+
+        def map_jobs(func, items):
+            return pool.imap(func, items, chunksize=POOL_CHUNK_FILES)
+    else:
+        pool = None
+        _init_worker(clusters, sequences)
+        map_jobs = map
+    try:
+        start_time = time.perf_counter()
+        keys = list(map_jobs(_worker_alignment_clusters, [in_path for in_path, _ in jobs]))
+        LOGGER.info(f'Read the clusters of {len(jobs)} alignment(s) in {time.perf_counter() - start_time:.2f}s')
+
+        # with linking, only the first output of each set of clusters is written
+        to_write, linked, first_out_paths = [], [], {}
+        for (_, out_path), key in zip(jobs, keys):
+            if link != 'copy' and key in first_out_paths:
+                linked.append((first_out_paths[key], out_path))
+            else:
+                first_out_paths.setdefault(key, out_path)
+                to_write.append((out_path, key))
+
+        start_time = time.perf_counter()
+        num_written = sum(map_jobs(_worker_write_clusters, to_write))
+        LOGGER.info(f'Wrote {len(to_write)} alignment(s) with {num_written} sequences in {time.perf_counter() - start_time:.2f}s')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for src_path, out_path in linked:
+        link_file(src_path, out_path, link)
+    if linked:
+        LOGGER.info(f'Linked ({link}) {len(linked)} alignment(s) that are the same as others')
+
 
-    def add_center(self,seqid):
-        self.seqs.add(seqid)
-        self.center = seqid
+def copy_tree_files(treedir, out_tree, link='copy'):
+    """Copy (or link) the newick and trace files of the tree"""
+    for tree_file in glob.glob(os.path.join(treedir, 'tree*')):
+        if os.path.isfile(tree_file):
+            link_file(tree_file, os.path.join(out_tree, os.path.basename(tree_file)), link)
 
 
 
@@ -45,64 +192,24 @@ if __name__ == '__main__':
     args = parser.parse_args()
     log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
     logging.basicConfig(level=log_level)
-    LOGGER = logging.getLogger(__name__)   
 
 
     LOGGER.info('Running program')
 
-    allseqs = SeqIO.index(args.seqfile, "fasta")
-
-    # Load up cluster info. This tells us which sequences are in each cluster
-    allclusts = []
-    with open(args.cluster_file, 'r') as f:
-        for line_count,line in enumerate(f):
-            line=line.rstrip().split()
-            if line[0].startswith('>'):
-                try:
-                    allclusts.append(curr_clust)
-                except:
-                    LOGGER.debug('no')
-                curr_clust = Starting_clust(line[1])
-            else:
-                if line[3] == '*':
-                    curr_clust.add_center(line[2][1:][:-3])
-                else:
-                    curr_clust.add_seq(line[2][1:][:-3])
-        allclusts.append(curr_clust)
-    
+    sequences = FastaOffsetIndex(args.seqfile)
+    LOGGER.info(f'Indexed {len(sequences)} sequences')
+
+    # Load up cluster info. This tells us which sequences are in each cluster,
+    # and (through its member index) which cluster each sequence is in
+    clusters = CdhitClusters.read(args.cluster_file)
+    LOGGER.info(f'Loaded {len(clusters)} clusters')
+
     # redo files
 
-    os.makedirs(args.out_tree+'/starting_cluster_alignments/', exist_ok=True)
-    os.makedirs(args.out_tree+'/merge_node_alignments/', exist_ok=True)
+    os.makedirs(args.out_tree, exist_ok=True)
 
     # copy the newick and trace files
-    call([f'cp {args.treedir}/tree* {args.out_tree}/' ], shell=True)
-
-
-
-    # Go through all starting cluster files
-    for alignment_file in os.listdir(args.treedir+'/starting_cluster_alignments/'):
-        # Get all the clusters in the file
-        with open(args.out_tree+'/starting_cluster_alignments/'+alignment_file,'w') as g:
-            with open(args.treedir+'/starting_cluster_alignments/'+alignment_file,'r') as f:
-                for line_count,line in enumerate(f):
-                    if line.startswith('>'):
-                        for clust in allclusts:
-                            if line.rstrip()[1:] in clust.seqs:
-                                for seq_to_add in clust.seqs:
-                                    print('>'+allseqs[seq_to_add].description, file=g)
-                                    print(allseqs[seq_to_add].seq,file=g)
-
-
-    # Go through all merge node files
-    for alignment_file in os.listdir(args.treedir+'/merge_node_alignments/'):
-        # Get all the clusters in the file
-        with open(args.out_tree+'/merge_node_alignments/'+alignment_file,'w') as g:
-            with open(args.treedir+'/merge_node_alignments/'+alignment_file,'r') as f:
-                for line_count,line in enumerate(f):
-                    if line.startswith('>'):
-                        for clust in allclusts:
-                            if line.rstrip()[1:] in clust.seqs:
-                                for seq_to_add in clust.seqs:
-                                    print('>'+allseqs[seq_to_add].description, file=g)
-                                    print(allseqs[seq_to_add].seq,file=g)
+    copy_tree_files(args.treedir, args.out_tree, args.link)
+
+    # Go through all starting cluster files, then all merge node files
+    refill_tree(args.treedir, args.out_tree, clusters, sequences, args.num_workers, args.link)
@@ -0,0 +1,37 @@
+import argparse
+import logging
+
+from distance_lookup import DEFAULT_SOCKET_ENVVAR, DistanceServer
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(
+    description="Serve average distances between sets of sequences from a memory-mapped binary distance file over a Unix socket",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--distances', '-d', type=str, dest='distances_file', required=True,
+                    help='binary distance matrix or k-nearest-neighbour graph (see convert_distance_matrix.py)')
+
+parser.add_argument('--socket', '-s', type=str, dest='socket_path', required=True,
+                    help=f'path of the Unix socket to listen on (point ${DEFAULT_SOCKET_ENVVAR} at it for the clients)')
+
+parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
+                    help='more verbose logging')
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
+    logging.basicConfig(level=log_level)
+
+
+    with DistanceServer(args.socket_path, args.distances_file) as server:
+        LOGGER.info(f'Serving the distances of {len(server.lookup)} sequences from {args.distances_file} on {args.socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    LOGGER.info('Stopped')
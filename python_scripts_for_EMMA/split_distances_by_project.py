@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+
+from distance_store import (
+    MISSING_DISTANCE_HEADER,
+    BinaryRowsWriter,
+    DistanceMatrix,
+    format_distances,
+    is_binary_distance_file,
+    is_knn_graph_file,
+    read_missing_distance,
+)
+from emmautils import read_projects, read_starting_clusters
+
+
+LOGGER = logging.getLogger(__name__)
+
+# name of the manifest, which HHSuiteScanner.pm looks for in its working directory
+MANIFEST_FILENAME = 'embs.manifest'
+
+# lines held for each project before they are appended to its file
+BUFFER_LINES = 10000
+
+
+parser = argparse.ArgumentParser(
+    description="Split a distance file into one file per GeMMA project, with only the pairs within each project",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--distances', '-d', type=str, dest='dist_file', required=True,
+                    help="global distance file: text 'name name dist' lines (e.g. emb) or a binary distance matrix")
+
+parser.add_argument('--projects', '-p', type=str, dest='projects_file', required=True,
+                    help='file of project names, one per line (projects.txt)')
+
+parser.add_argument('--starting_clusters', '-sc', type=str, dest='starting_clusters_dir', required=True,
+                    help='directory holding the starting_clusters/<project>/ directories')
+
+parser.add_argument('--out_dir', '-o', type=str, dest='out_dir', default='.',
+                    help=f'directory for the per-project files and their manifest ({MANIFEST_FILENAME}); '
+                         'HHSuiteScanner.pm uses them when the manifest is in the directory it runs in')
+
+parser.add_argument('--format', '-f', type=str, dest='out_format', choices=['text', 'binary'], default='text',
+                    help='per-project files as text lines or, from a binary distance matrix, as binary matrices '
+                         '(HHSuiteScanner.pm only reads text ones: it warns about binary ones and reads the global file)')
+
+parser.add_argument('--verbose', '-v', required=False, action='count', default=0,
+                    help='more verbose logging')
+
+
+def project_members(projects, starting_clusters_dir):
+    """Dict of each sequence name (without any leading '>') to the list of the projects that it is in"""
+    projects_of_name = {}
+    for project in projects:
+        for members in read_starting_clusters(os.path.join(starting_clusters_dir, project)).values():
+            for member in members:
+                projects_of_name.setdefault(member.lstrip('>'), []).append(project)
+    return projects_of_name
+
+
+def split_text(dist_file, projects, projects_of_name, out_dir):
+    """
+    Split a text distance file into `embs.<project>` files, reading it once
+
+    Returns the number of pairs written for each project.
+    """
+    paths = {project: os.path.join(out_dir, f'embs.{project}') for project in projects}
+    missing_distance = read_missing_distance(dist_file)
+    for project, path in paths.items():
+        with open(path, 'w') as g:
+            if missing_distance is not None:
+                g.write(f'{MISSING_DISTANCE_HEADER} {missing_distance}\n')
+
+    buffers = {project: [] for project in projects}
+    num_pairs = dict.fromkeys(projects, 0)
+
+    def flush(project):
+        with open(paths[project], 'a') as g:
+            g.writelines(buffers[project])
+        num_pairs[project] += len(buffers[project])
+        buffers[project] = []
+
+    with open(dist_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            projects_a = projects_of_name.get(fields[0].lstrip('>'))
+            projects_b = projects_of_name.get(fields[1].lstrip('>'))
+            if not projects_a or not projects_b:
+                continue
+            for project in projects_a:
+                if project in projects_b:
+                    buffers[project].append(line)
+                    if len(buffers[project]) >= BUFFER_LINES:
+                        flush(project)
+    for project in projects:
+        flush(project)
+    return num_pairs
+
+
+def split_binary(dist_file, projects, projects_of_name, out_dir, out_format):
+    """
+    Split a binary distance matrix into one (text or binary) file per project
+
+    Returns the number of pairs written for each project.
+    """
+    matrix = DistanceMatrix(dist_file)
+    num_pairs = {}
+    for project in projects:
+        rows = sorted(i for i, name in enumerate(matrix.names) if project in projects_of_name.get(name.lstrip('>'), ()))
+        names = [matrix.names[i] for i in rows]
+        if out_format == 'binary':
+            with BinaryRowsWriter(os.path.join(out_dir, f'embs.{project}.bin'), names) as writer:
+                for offset, i in enumerate(rows):
+                    writer.add_condensed(offset, offset + 1, matrix.row(i)[rows[offset + 1:]])
+        else:
+            with open(os.path.join(out_dir, f'embs.{project}'), 'w') as g:
+                for offset, i in enumerate(rows):
+                    row = format_distances(matrix.row(i)[rows[offset:]])
+                    g.writelines(f'{names[offset]} {name_j} {dist}\n' for name_j, dist in zip(names[offset:], row))
+        num_pairs[project] = len(rows) * (len(rows) + 1) // 2
+    return num_pairs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    log_level = logging.DEBUG if args.verbose > 0 else logging.INFO
+    logging.basicConfig(level=log_level)
+
+
+    projects = read_projects(args.projects_file)
+    projects_of_name = project_members(projects, args.starting_clusters_dir)
+    LOGGER.info(f'Read the members of {len(projects)} project(s): {len(projects_of_name)} sequences')
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    if is_knn_graph_file(args.dist_file):
+        parser.error('split a nearest-neighbour graph after converting it to text with convert_distance_matrix.py')
+    if is_binary_distance_file(args.dist_file):
+        num_pairs = split_binary(args.dist_file, projects, projects_of_name, args.out_dir, args.out_format)
+    else:
+        if args.out_format == 'binary':
+            parser.error('binary per-project files can only be made from a binary distance matrix')
+        num_pairs = split_text(args.dist_file, projects, projects_of_name, args.out_dir)
+
+    # one 'project<TAB>file<TAB>format<TAB>number of pairs' line per project,
+    # with the file relative to the manifest itself
+    suffix = '.bin' if args.out_format == 'binary' else ''
+    with open(os.path.join(args.out_dir, MANIFEST_FILENAME), 'w') as g:
+        for project in projects:
+            g.write(f'{project}\tembs.{project}{suffix}\t{args.out_format}\t{num_pairs[project]}\n')
+            LOGGER.info(f'{project}: {num_pairs[project]} pairs')
@@ -31,6 +31,7 @@ setup(
     """,
     install_requires=[
         "click",
+        "numpy",
         "pandas",
         "fair-esm",
         "torch",
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the EMMA scripts import each other as top-level modules (e.g. `from emmautils import ...`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "python_scripts_for_EMMA"))
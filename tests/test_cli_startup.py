@@ -0,0 +1,71 @@
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+# modules that take seconds to import and are only needed once a command runs
+HEAVY_MODULES = ["torch", "esm", "pandas", "Bio", "matplotlib"]
+
+CHECK_IMPORTS = """
+import sys
+from cath_emma.cli import cli
+try:
+    cli({args!r})
+except SystemExit:
+    pass
+print("imported:", *(module for module in {heavy_modules!r} if module in sys.modules))
+"""
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--help"],
+        ["benchmark-esm-to-embed", "--help"],
+        ["calculate-esm-to-embed", "--help"],
+        ["convert-fasta-to-csv-for-embed", "--help"],
+        ["merge-esm-embeddings", "--help"],
+        ["serve-esm-embed", "--help"],
+    ],
+)
+def test_cli_help_does_not_import_heavy_modules(args):
+    # run in a fresh interpreter, as the modules may already be imported here
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK_IMPORTS.format(args=args, heavy_modules=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip().splitlines()[-1] == "imported:"
+
+
+def test_cli_lists_all_commands():
+    from cath_emma.cli import SUBCOMMANDS, cli
+
+    result = subprocess.run(
+        [sys.executable, "-c", "from cath_emma.cli import cli; cli(['--help'])"],
+        capture_output=True,
+        text=True,
+    )
+    for cmd_name in SUBCOMMANDS:
+        assert cmd_name in result.stdout
+        assert cli.get_command(None, cmd_name) is not None
+
+
+# modules that the commands only import once they run, so --help never checks them
+DEFERRED_MODULES = [
+    "cath_emma.embedding_cache",
+    "cath_emma.embedding_job",
+    "cath_emma.embedding_server",
+    "cath_emma.embedding_store",
+    "cath_emma.embeddings",
+    "cath_emma.parallel_embedding",
+]
+
+
+@pytest.mark.parametrize("module_name", DEFERRED_MODULES)
+def test_deferred_modules_import(module_name):
+    pytest.importorskip("torch")
+    pytest.importorskip("esm")
+    importlib.import_module(module_name)
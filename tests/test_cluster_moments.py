@@ -0,0 +1,85 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from cluster_moments import ClusterMoments, node_id_of_clusters
+
+NAMES = [f">s{i}" for i in range(20)]
+CLUSTERS = {
+    "1": ["s0", "s1", "s2"],
+    "2": ["s3"],
+    "3": ["s4", "s5", "s6", "s7", "s8"],
+    "4": [f"s{i}" for i in range(9, 20)],
+}
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).normal(size=(len(NAMES), 8)).astype(np.float32)
+
+
+def members(embeddings, member_names):
+    return embeddings[[NAMES.index(">" + name) for name in member_names]].astype(np.float64)
+
+
+def brute_force_mean_squared(members_a, members_b):
+    return np.mean([np.linalg.norm(a - b) ** 2 for a in members_a for b in members_b])
+
+
+def test_mean_squared_distances_match_brute_force(embeddings):
+    moments = ClusterMoments.from_members(embeddings, NAMES, CLUSTERS)
+    cluster_ids = list(CLUSTERS)
+    expected = np.array([
+        [brute_force_mean_squared(members(embeddings, CLUSTERS[a]), members(embeddings, CLUSTERS[b])) for b in cluster_ids]
+        for a in cluster_ids
+    ])
+
+    np.testing.assert_allclose(moments.mean_squared_distances(cluster_ids, cluster_ids), expected, rtol=1e-10)
+    assert moments.mean_squared_distance("1", "3") == pytest.approx(expected[0, 2], rel=1e-10)
+
+
+def test_merged_moments_match_brute_force(embeddings):
+    moments = ClusterMoments.from_members(embeddings, NAMES, CLUSTERS)
+    new_id = moments.merge("1", "3")
+
+    assert new_id == node_id_of_clusters(["1", "3"])
+    assert moments.current_ids() == ["2", "4", new_id]
+    merged = members(embeddings, CLUSTERS["1"] + CLUSTERS["3"])
+    assert moments.mean_squared_distance(new_id, "4") == pytest.approx(
+        brute_force_mean_squared(merged, members(embeddings, CLUSTERS["4"])), rel=1e-10
+    )
+
+
+def test_scan_results(embeddings):
+    moments = ClusterMoments.from_members(embeddings, NAMES, CLUSTERS)
+    results = list(moments.iter_scan_results(["1", "2"], ["2", "4"], score="rms"))
+
+    assert [(query_id, match_id) for query_id, match_id, _ in results] == [("1", "2"), ("1", "4"), ("2", "4")]
+    for query_id, match_id, score in results:
+        expected = brute_force_mean_squared(members(embeddings, CLUSTERS[query_id]), members(embeddings, CLUSTERS[match_id]))
+        assert score == pytest.approx(np.sqrt(expected), rel=1e-10)
+
+
+def test_save_and_load(tmp_path, embeddings):
+    moments = ClusterMoments.from_members(embeddings, NAMES, CLUSTERS)
+    new_id = moments.merge("2", "4")
+    moments.save(str(tmp_path / "moments.npz"))
+    loaded = ClusterMoments.load(str(tmp_path / "moments.npz"))
+
+    assert loaded.current_ids() == moments.current_ids()
+    assert loaded.starting_clusters[new_id] == ["2", "4"]
+    np.testing.assert_array_equal(
+        loaded.mean_squared_distances(loaded.current_ids(), loaded.current_ids()),
+        moments.mean_squared_distances(moments.current_ids(), moments.current_ids()),
+    )
+
+
+def test_node_id_of_clusters():
+    assert node_id_of_clusters(["7"]) == "7"
+    assert node_id_of_clusters(["7", "12"]) == "n0de_" + hashlib.md5(b"712").hexdigest()
+
+
+def test_members_must_have_embeddings(embeddings):
+    with pytest.raises(KeyError, match="members of cluster 5"):
+        ClusterMoments.from_members(embeddings, NAMES, {"5": ["s1", "missing"]})
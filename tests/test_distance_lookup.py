@@ -0,0 +1,144 @@
+import os
+import socket
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+
+import distance_lookup
+from distance_lookup import DistanceClient, DistanceLookup, DistanceServer, open_distance_lookup
+from distance_store import sparse_to_graph, text_to_binary, write_graph, write_sparse_text
+
+NAMES = [f">s{i}" for i in range(12)]
+MISSING_DISTANCE = 0.5
+SET_PAIRS = [
+    ([">s0"], [">s1"]),
+    ([">s0", ">s1", ">s2"], [">s3", ">s4"]),
+    # overlapping sets, with pairs of a name with itself
+    ([">s5", ">s6", ">s7"], [">s7", ">s8", ">s5", ">s11"]),
+    (NAMES, NAMES),
+]
+
+
+@pytest.fixture
+def distance_files(tmp_path):
+    """The same sparse distances as text (with a missing distance), a binary matrix and a binary graph"""
+    rng = np.random.default_rng(0)
+    pairs = sorted({tuple(sorted(pair)) for pair in rng.integers(len(NAMES), size=(40, 2)) if pair[0] != pair[1]})
+    rows, cols = np.array(pairs).T
+    # powers of two, so that the distances are the same in float32 and float64
+    dists = 2.0 ** -rng.integers(1, 8, size=len(pairs))
+    with open(tmp_path / "emb", "w") as g:
+        write_sparse_text(g, NAMES, rows, cols, dists, MISSING_DISTANCE)
+    text_to_binary(str(tmp_path / "emb"), str(tmp_path / "dists.bin"), NAMES)
+    write_graph(str(tmp_path / "graph.bin"), NAMES, *sparse_to_graph(len(NAMES), rows, cols, dists), MISSING_DISTANCE)
+
+    full = np.full((len(NAMES), len(NAMES)), MISSING_DISTANCE)
+    full[rows, cols] = full[cols, rows] = dists
+    np.fill_diagonal(full, 0)
+    return {"text": str(tmp_path / "emb"), "matrix": str(tmp_path / "dists.bin"), "graph": str(tmp_path / "graph.bin"), "full": full}
+
+
+def expected_averages(full):
+    return [full[np.ix_([NAMES.index(name) for name in names_a], [NAMES.index(name) for name in names_b])].mean() for names_a, names_b in SET_PAIRS]
+
+
+@pytest.mark.parametrize("kind", ["text", "matrix", "graph"])
+def test_lookup_averages(distance_files, kind):
+    lookup = DistanceLookup(distance_files[kind])
+    expected = expected_averages(distance_files["full"])
+
+    assert lookup.average_distances(SET_PAIRS) == pytest.approx(expected, rel=1e-12)
+    assert lookup.average_distance(*SET_PAIRS[1]) == pytest.approx(expected[1], rel=1e-12)
+
+
+def test_text_lookup_without_missing_distance(tmp_path):
+    (tmp_path / "emb").write_text(">a >a 0.0\n>a >b 0.25\n>b >b 0.0\n>c >c 0.0\n")
+    lookup = DistanceLookup(str(tmp_path / "emb"))
+
+    assert lookup.average_distance([">a"], [">a", ">b"]) == 0.125
+    with pytest.raises(KeyError, match="no distance between >a and >c"):
+        lookup.average_distance([">a"], [">c"])
+
+
+def test_binary_lookup_unknown_name(distance_files):
+    with pytest.raises(KeyError, match=">x is not in"):
+        DistanceLookup(distance_files["matrix"]).average_distance([">s0"], [">x"])
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are limited to about 100 characters, too few for some pytest tmp_paths
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yield os.path.join(tmp_dir, "distances.sock")
+
+
+def start_server(socket_path, distances_path):
+    server = DistanceServer(socket_path, distances_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, thread
+
+
+@pytest.mark.parametrize("kind", ["matrix", "graph"])
+def test_server_round_trip(monkeypatch, distance_files, socket_path, kind):
+    # several batches of requests
+    monkeypatch.setattr(distance_lookup, "CLIENT_BATCH_SIZE", 3)
+    server, thread = start_server(socket_path, distance_files[kind])
+    try:
+        with open_distance_lookup(distance_files[kind], socket_path) as client:
+            assert isinstance(client, DistanceClient)
+            assert len(client) == len(NAMES)
+            assert client.average_distances(SET_PAIRS * 4) == DistanceLookup(distance_files[kind]).average_distances(SET_PAIRS * 4)
+            with pytest.raises(RuntimeError, match=">x is not in"):
+                client.average_distance([">s0"], [">x"])
+        with DistanceClient(socket_path) as client:
+            client.shutdown()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not os.path.exists(socket_path)
+
+
+def test_server_needs_a_binary_file(distance_files, socket_path):
+    with pytest.raises(ValueError, match="text file"):
+        DistanceServer(socket_path, distance_files["text"])
+
+
+def make_stale_socket(socket_path):
+    """Leave a socket file behind with nothing listening on it, as after a server is killed"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.close()
+
+
+def test_stale_socket_falls_back_to_the_file(caplog, monkeypatch, distance_files, socket_path):
+    monkeypatch.delenv(distance_lookup.DEFAULT_SOCKET_ENVVAR, raising=False)
+    make_stale_socket(socket_path)
+    with caplog.at_level("WARNING"):
+        lookup = open_distance_lookup(distance_files["matrix"], socket_path)
+
+    assert isinstance(lookup, DistanceLookup)
+    assert "Cannot connect to the distance server" in caplog.text
+    assert lookup.average_distances(SET_PAIRS) == pytest.approx(expected_averages(distance_files["full"]), rel=1e-12)
+    # no socket at all, and no $CATH_EMMA_DISTANCE_SERVER either
+    os.remove(socket_path)
+    assert isinstance(open_distance_lookup(distance_files["matrix"], socket_path), DistanceLookup)
+
+
+def test_server_replaces_a_stale_socket(distance_files, socket_path):
+    make_stale_socket(socket_path)
+    server, thread = start_server(socket_path, distance_files["matrix"])
+    try:
+        with DistanceClient(socket_path) as client:
+            assert len(client) == len(NAMES)
+        # but not a live one
+        with pytest.raises(OSError, match="already running"):
+            DistanceServer(socket_path, distance_files["matrix"])
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(timeout=10)
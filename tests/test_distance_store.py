@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from distance_store import (
+    BinaryRowsWriter,
+    DistanceMatrix,
+    DistanceMatrixWriter,
+    binary_to_text,
+    concatenate_binary_shards,
+    names_path,
+    text_to_binary,
+)
+from pairwise_distances import iter_upper_triangle_rows, shard_rows
+
+NAMES = [f">s{i}" for i in range(9)]
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.default_rng(0).normal(size=(len(NAMES), 16)).astype(np.float32)
+
+
+@pytest.fixture
+def full_matrix(embeddings):
+    return np.linalg.norm(embeddings[:, None, :] - embeddings[None, :, :], axis=2).astype(np.float32)
+
+
+def write_rows(path, embeddings, row_start=0, row_end=None):
+    row_end = len(NAMES) if row_end is None else row_end
+    with BinaryRowsWriter(path, NAMES, row_start, row_end) as writer:
+        for start, strip in iter_upper_triangle_rows(embeddings, row_start=row_start, row_end=row_end):
+            writer.add_rows(start, strip)
+
+
+def test_binary_round_trip(tmp_path, embeddings, full_matrix):
+    write_rows(str(tmp_path / "dists.bin"), embeddings)
+    matrix = DistanceMatrix(str(tmp_path / "dists.bin"))
+
+    assert matrix.names == NAMES
+    np.testing.assert_allclose(matrix.submatrix(range(len(NAMES)), range(len(NAMES))), full_matrix, rtol=1e-5, atol=1e-6)
+    for i in range(len(NAMES)):
+        np.testing.assert_array_equal(matrix.row(i), matrix.submatrix([i], range(len(NAMES)))[0])
+    assert matrix.distance_by_name(">s2", ">s7") == matrix.distance(7, 2)
+    assert matrix.distance(3, 3) == 0.0
+
+
+def test_writers_agree(tmp_path, embeddings):
+    write_rows(str(tmp_path / "rows.bin"), embeddings)
+    with DistanceMatrixWriter(str(tmp_path / "set.bin"), NAMES) as writer:
+        for start, strip in iter_upper_triangle_rows(embeddings):
+            writer.set_rows(start, strip)
+        assert writer.num_unset() == 0
+
+    assert (tmp_path / "rows.bin").read_bytes() == (tmp_path / "set.bin").read_bytes()
+
+
+def test_text_round_trip(tmp_path, embeddings):
+    write_rows(str(tmp_path / "dists.bin"), embeddings)
+    binary_to_text(str(tmp_path / "dists.bin"), str(tmp_path / "emb"))
+    assert text_to_binary(str(tmp_path / "emb"), str(tmp_path / "back.bin")) == 0
+
+    assert (tmp_path / "back.bin").read_bytes() == (tmp_path / "dists.bin").read_bytes()
+    assert (tmp_path / "back.bin.names").read_text() == (tmp_path / "dists.bin.names").read_text()
+
+
+def test_missing_pairs_get_the_missing_distance(tmp_path):
+    (tmp_path / "emb").write_text("#missing_distance 0.5\n>a >a 0.0\n>a >b 0.25\n>b >c 0.125\n")
+    assert text_to_binary(str(tmp_path / "emb"), str(tmp_path / "dists.bin")) == 1
+
+    matrix = DistanceMatrix(str(tmp_path / "dists.bin"))
+    assert matrix.names == [">a", ">b", ">c"]
+    assert (matrix.distance(0, 1), matrix.distance(1, 2), matrix.distance(0, 2)) == (0.25, 0.125, 0.5)
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 4, 9])
+def test_concatenated_shards_equal_one_file(tmp_path, embeddings, num_shards):
+    write_rows(str(tmp_path / "whole.bin"), embeddings)
+    shard_paths = []
+    # in reverse order, as the shards can be concatenated in any order
+    for shard_idx in reversed(range(num_shards)):
+        shard_paths.append(str(tmp_path / f"shard{shard_idx}.bin"))
+        write_rows(shard_paths[-1], embeddings, *shard_rows(len(NAMES), shard_idx, num_shards))
+
+    concatenate_binary_shards(shard_paths, str(tmp_path / "joined.bin"))
+
+    assert (tmp_path / "joined.bin").read_bytes() == (tmp_path / "whole.bin").read_bytes()
+    assert open(names_path(str(tmp_path / "joined.bin"))).read() == open(names_path(str(tmp_path / "whole.bin"))).read()
+
+
+def test_shard_is_not_a_matrix(tmp_path, embeddings):
+    write_rows(str(tmp_path / "shard.bin"), embeddings, *shard_rows(len(NAMES), 0, 2))
+    with pytest.raises(ValueError, match="shard"):
+        DistanceMatrix(str(tmp_path / "shard.bin"))
+
+
+def test_incomplete_shards_are_an_error(tmp_path, embeddings):
+    shard_paths = [str(tmp_path / f"shard{shard_idx}.bin") for shard_idx in range(3)]
+    for shard_idx in (0, 2):
+        write_rows(shard_paths[shard_idx], embeddings, *shard_rows(len(NAMES), shard_idx, 3))
+    with pytest.raises(ValueError, match="no rows from"):
+        concatenate_binary_shards([shard_paths[0], shard_paths[2]], str(tmp_path / "joined.bin"))
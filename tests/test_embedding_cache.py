@@ -0,0 +1,50 @@
+import numpy as np
+
+from cath_emma.embedding_cache import MAX_QUERY_PARAMS, EmbeddingCache, sequence_md5
+
+# enough sequences for several chunks of MAX_QUERY_PARAMS
+MD5S = [sequence_md5("MKTAY" + "A" * i) for i in range(2 * MAX_QUERY_PARAMS + 100)]
+
+
+def random_vectors(num_vectors, seed=0):
+    return np.random.default_rng(seed).normal(size=(num_vectors, 6)).astype(np.float32)
+
+
+def cached(cache, model, layer, md5s):
+    found = {}
+    for chunk_md5s, vectors in cache.iter_cached(model, layer, md5s):
+        assert len(chunk_md5s) == len(vectors) <= MAX_QUERY_PARAMS
+        found.update(zip(chunk_md5s, vectors))
+    return found
+
+
+def test_put_and_iter_cached(tmp_path):
+    vectors = random_vectors(len(MD5S))
+    with EmbeddingCache(str(tmp_path / "cache.sqlite")) as cache:
+        cache.put("esm2", 33, MD5S, vectors)
+
+    # read back from a new connection, with unknown md5s mixed in
+    with EmbeddingCache(str(tmp_path / "cache.sqlite")) as cache:
+        query = [sequence_md5("unknown")] + MD5S[::-1] + [sequence_md5("other")]
+        found = cached(cache, "esm2", 33, query)
+        assert sorted(found) == sorted(MD5S)
+        for md5, vector in zip(MD5S, vectors):
+            np.testing.assert_array_equal(found[md5], vector)
+
+        assert cached(cache, "esm2", 32, MD5S) == {}
+        assert cached(cache, "esm1b", 33, MD5S) == {}
+        assert list(cache.iter_cached("esm2", 33, [])) == []
+
+
+def test_put_replaces(tmp_path):
+    with EmbeddingCache(str(tmp_path / "cache.sqlite")) as cache:
+        cache.put("esm2", 33, MD5S[:3], random_vectors(3, seed=1))
+        cache.put("esm2", 33, MD5S[1:2], random_vectors(1, seed=2))
+        found = cached(cache, "esm2", 33, MD5S[:3])
+
+    np.testing.assert_array_equal(found[MD5S[1]], random_vectors(1, seed=2)[0])
+    np.testing.assert_array_equal(found[MD5S[2]], random_vectors(3, seed=1)[2])
+
+
+def test_sequence_md5():
+    assert sequence_md5("MKTAY") == "9bb83a6828fb548c7c438b0663911536"
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+esm = pytest.importorskip("esm")
+
+from cath_emma.embedding_cache import EmbeddingCache, sequence_md5
+from cath_emma.embedding_job import run_embedding_job
+
+SEQUENCES = {
+    "d1": "MKTAYIAKQR",
+    "d2": "MK",
+    "d3": "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEVQAPILSRVGDGTQDNLSGAEKAVQVKVKALPDAQ",
+    "d4": "GGSSGG",
+    # the same sequence as d1, so only embedded once
+    "d5": "MKTAYIAKQR",
+    "d6": "MKTAYIAKQRQISFVKSHFSRQLEERLGLIEV",
+}
+
+
+class FakeModel(torch.nn.Module):
+    """Stands in for an ESM model: each token gets a fixed random vector in every layer"""
+
+    def __init__(self, alphabet, embedding_size=4):
+        super().__init__()
+        torch.manual_seed(0)
+        self.embed = torch.nn.Embedding(len(alphabet), embedding_size)
+        self.batch_sizes = []
+
+    def forward(self, tokens, repr_layers):
+        self.batch_sizes.append(len(tokens))
+        vectors = self.embed(tokens)
+        return {"representations": {layer: vectors for layer in repr_layers}}
+
+
+@pytest.fixture
+def fake_model():
+    alphabet = esm.data.Alphabet.from_architecture("ESM-1b")
+    return FakeModel(alphabet), alphabet
+
+
+@pytest.fixture
+def sequence_csv(tmp_path):
+    path = tmp_path / "sequences.csv"
+    path.write_text("".join(f"{label},{sequence}\n" for label, sequence in SEQUENCES.items()))
+    return str(path)
+
+
+def expected_mean(fake_model, sequence):
+    model, alphabet = fake_model
+    with torch.no_grad():
+        return model.embed(torch.tensor([alphabet.get_idx(residue) for residue in sequence])).mean(dim=0).numpy()
+
+
+def test_pt_output_is_in_file_order(tmp_path, fake_model, sequence_csv):
+    result = run_embedding_job(
+        sequence_csv, str(tmp_path / "embs.pt"), max_tokens_per_batch=80, load_model=lambda name: fake_model
+    )
+    embeddings = torch.load(str(tmp_path / "embs.pt"))
+
+    assert result == {"num_rows": 6, "num_embedded": 5}
+    # longest first: d3 on its own, then d6 and d1, then d4 and d2
+    assert fake_model[0].batch_sizes == [1, 2, 2]
+    assert [embedding["label"] for embedding in embeddings] == list(SEQUENCES)
+    for embedding, sequence in zip(embeddings, SEQUENCES.values()):
+        np.testing.assert_allclose(embedding["mean_representations"][33].numpy(), expected_mean(fake_model, sequence), rtol=1e-5)
+
+
+def test_cached_only_with_every_representation(tmp_path, fake_model, sequence_csv):
+    cache_path = str(tmp_path / "cache.sqlite")
+    cached_vector = np.full((1, 4), 42.0, dtype=np.float32)
+    with EmbeddingCache(cache_path) as cache:
+        # d4 has both representations in the cache, d1 (and so d5) only the mean one
+        cache.put("esm2", 33, [sequence_md5(SEQUENCES["d4"])], cached_vector)
+        cache.put("esm2:max", 33, [sequence_md5(SEQUENCES["d4"])], cached_vector)
+        cache.put("esm2", 33, [sequence_md5(SEQUENCES["d1"])], cached_vector)
+
+    result = run_embedding_job(
+        sequence_csv, str(tmp_path / "embs.pt"), poolings=("mean", "max"), embedding_cache=cache_path,
+        load_model=lambda name: fake_model,
+    )
+    embeddings = {embedding["label"]: embedding for embedding in torch.load(str(tmp_path / "embs.pt"))}
+
+    assert result == {"num_rows": 6, "num_embedded": 4}
+    for pooling in ("mean", "max"):
+        np.testing.assert_array_equal(embeddings["d4"][f"{pooling}_representations"][33].numpy(), cached_vector[0])
+    for label in ("d1", "d5"):
+        np.testing.assert_allclose(embeddings[label]["mean_representations"][33].numpy(), expected_mean(fake_model, SEQUENCES["d1"]), rtol=1e-5)
+
+    # the embedded sequences are cached afterwards, under every representation
+    with EmbeddingCache(cache_path) as cache:
+        for cache_model in ("esm2", "esm2:max"):
+            found = [md5 for md5s, _ in cache.iter_cached(cache_model, 33, map(sequence_md5, SEQUENCES.values())) for md5 in md5s]
+            assert sorted(found) == sorted(set(map(sequence_md5, SEQUENCES.values())))
@@ -0,0 +1,127 @@
+import json
+
+import click
+import numpy as np
+import pytest
+
+from cath_emma.commands.calculate_esm_embeddings import parse_slice
+from cath_emma.embedding_store import (
+    MANIFEST_FILENAME,
+    ShardedEmbeddings,
+    ShardedEmbeddingWriter,
+    merge_sharded_embeddings,
+)
+
+LABELS = [f"seq{i}" for i in range(10)]
+METADATA = {"model": "esm2", "representations": ["layer33_mean", "layer33_max"]}
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    return {name: rng.normal(size=(len(LABELS), 4)).astype(np.float32) for name in METADATA["representations"]}
+
+
+def rows(vectors, start, end):
+    return {name: matrix[start:end] for name, matrix in vectors.items()}
+
+
+def read_manifest(out_dir):
+    return json.loads((out_dir / MANIFEST_FILENAME).read_text())
+
+
+def test_shards_round_trip(tmp_path, vectors):
+    with ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA) as writer:
+        # batches that do not line up with the shards
+        for start, end in [(0, 3), (3, 9), (9, 10)]:
+            writer.add(LABELS[start:end], rows(vectors, start, end))
+
+    manifest = read_manifest(tmp_path)
+    assert manifest["complete"]
+    assert [shard["rows"] for shard in manifest["shards"]] == [4, 4, 2]
+    for name, matrix in vectors.items():
+        stored = ShardedEmbeddings(str(tmp_path), representation=name)
+        assert stored.labels == LABELS
+        np.testing.assert_array_equal(stored.to_array(), matrix)
+
+
+def test_resume_after_crash_mid_shard(tmp_path, vectors):
+    writer = ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA)
+    writer.add(LABELS[:7], rows(vectors, 0, 7))
+    # the run dies here: seq4..seq6 are still buffered and never reach a shard
+    del writer
+    assert not read_manifest(tmp_path)["complete"]
+
+    with ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA, resume=True) as writer:
+        assert writer.num_written == 4
+        assert writer.written_labels() == set(LABELS[:4])
+        todo = [i for i, label in enumerate(LABELS) if label not in writer.written_labels()]
+        writer.add([LABELS[i] for i in todo], {name: matrix[todo] for name, matrix in vectors.items()})
+
+    manifest = read_manifest(tmp_path)
+    assert manifest["complete"]
+    assert [shard["name"] for shard in manifest["shards"]] == ["shard_00000", "shard_00001", "shard_00002"]
+    stored = ShardedEmbeddings(str(tmp_path), representation="layer33_max")
+    assert stored.labels == LABELS
+    np.testing.assert_array_equal(stored.to_array(), vectors["layer33_max"])
+
+
+def test_existing_manifest_needs_resume(tmp_path, vectors):
+    with ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA) as writer:
+        writer.add(LABELS, vectors)
+    with pytest.raises(FileExistsError, match="already contains embedding shards"):
+        ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA)
+
+
+def test_resume_metadata_mismatch(tmp_path, vectors):
+    with ShardedEmbeddingWriter(str(tmp_path), shard_size=4, metadata=METADATA) as writer:
+        writer.add(LABELS, vectors)
+    with pytest.raises(ValueError, match="written with model='esm2', not 'esm1b'"):
+        ShardedEmbeddingWriter(str(tmp_path), metadata={**METADATA, "model": "esm1b"}, resume=True)
+
+
+def test_add_checks_representations(tmp_path, vectors):
+    writer = ShardedEmbeddingWriter(str(tmp_path), metadata=METADATA)
+    with pytest.raises(ValueError, match="got representations"):
+        writer.add(LABELS, vectors["layer33_mean"])
+    with pytest.raises(ValueError, match="got 9 labels for 10 vectors"):
+        writer.add(LABELS[1:], vectors)
+
+
+def test_merge_slices(tmp_path, vectors):
+    slice_dirs = [tmp_path / "slice0", tmp_path / "slice1"]
+    for slice_idx, (start, end) in enumerate([(0, 6), (6, 10)]):
+        with ShardedEmbeddingWriter(str(slice_dirs[slice_idx]), shard_size=4, metadata={**METADATA, "slice": [slice_idx, 2]}) as writer:
+            writer.add(LABELS[start:end], rows(vectors, start, end))
+
+    merge_sharded_embeddings([str(path) for path in slice_dirs], str(tmp_path / "merged"))
+
+    manifest = read_manifest(tmp_path / "merged")
+    assert manifest["complete"] and "slice" not in manifest
+    assert [(shard["name"], shard["rows"]) for shard in manifest["shards"]] == [
+        ("shard_00000", 4), ("shard_00001", 2), ("shard_00002", 4)
+    ]
+    for name, matrix in vectors.items():
+        stored = ShardedEmbeddings(str(tmp_path / "merged"), representation=name)
+        assert stored.labels == LABELS
+        np.testing.assert_array_equal(stored.to_array(), matrix)
+
+
+def test_merge_refuses_other_models(tmp_path, vectors):
+    for model in ("esm2", "esm1b"):
+        with ShardedEmbeddingWriter(str(tmp_path / model), metadata={**METADATA, "model": model}) as writer:
+            writer.add(LABELS, vectors)
+    with pytest.raises(ValueError, match="model='esm1b' differs"):
+        merge_sharded_embeddings([str(tmp_path / "esm2"), str(tmp_path / "esm1b")], str(tmp_path / "merged"))
+
+
+def test_parse_slice():
+    assert parse_slice(None) is None
+    assert parse_slice("0/1") == (0, 1)
+    assert parse_slice("7/8") == (7, 8)
+
+
+@pytest.mark.parametrize("value", ["8/8", "-1/8", "0/0", "2", "a/b", "1/2/3"])
+def test_parse_slice_errors(value):
+    with pytest.raises(click.BadParameter):
+        parse_slice(value)
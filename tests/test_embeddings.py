@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("esm")
+
+from cath_emma.embeddings import combine_windows, sequence_windows, token_budget_batches, windowed_pairs
+
+
+def random_lengths(num_sequences, seed=0):
+    return np.random.default_rng(seed).integers(1, 300, size=num_sequences).tolist()
+
+
+@pytest.mark.parametrize("max_tokens", [100, 1000, 4096])
+def test_token_budget_batches_stay_within_budget(max_tokens):
+    lengths = random_lengths(200)
+    batches = token_budget_batches(lengths, max_tokens)
+
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(lengths)))
+    for batch in batches:
+        padded_size = (max(lengths[idx] for idx in batch) + 2) * len(batch)
+        assert padded_size <= max_tokens or len(batch) == 1
+    # longest first
+    batch_lengths = [lengths[idx] for batch in batches for idx in batch]
+    assert batch_lengths == sorted(lengths, reverse=True)
+
+
+def test_token_budget_batches_over_budget_sequence_on_its_own():
+    assert token_budget_batches([10, 500, 20, 30, 5], 100) == [[1], [3, 2, 0], [4]]
+
+
+def test_token_budget_batches_extra_tokens():
+    # 3 * (30 + 2) fits in 100, 3 * (30 + 4) does not
+    assert token_budget_batches([30, 30, 30], 100) == [[0, 1, 2]]
+    assert token_budget_batches([30, 30, 30], 100, extra_tokens_per_seq=4) == [[0, 1], [2]]
+
+
+@pytest.mark.parametrize("length, window_length, overlap", [(10, 10, 3), (11, 10, 3), (25, 10, 3), (100, 30, 0), (1500, 1022, 128)])
+def test_sequence_windows_cover_the_sequence(length, window_length, overlap):
+    # a "sequence" of residue positions, so each window shows where it starts
+    windows = sequence_windows(list(range(length)), window_length, overlap)
+    starts = [window[0] for window in windows]
+
+    assert all(window == list(range(start, start + window_length)) for start, window in zip(starts, windows))
+    assert starts[0] == 0
+    # consecutive windows overlap by at least `overlap` residues, so every residue is covered
+    assert all(0 < later - earlier <= window_length - overlap for earlier, later in zip(starts, starts[1:]))
+    # the last window is aligned to the end of the sequence
+    assert windows[-1][-1] == length - 1
+
+
+def test_sequence_windows_short_sequence():
+    assert sequence_windows("MKTAY", 10, 3) == ["MKTAY"]
+    assert sequence_windows("MKTAY" * 100, None, 3) == ["MKTAY" * 100]
+
+
+POOLINGS_BY_NAME = {"mean_33": "mean", "max_33": "max"}
+
+
+def test_combine_windows_weights_by_window_length():
+    # combine_windows() takes the window lengths from the labels, which lets them differ here
+    labels = [("a", 10), ("a", 30), ("b", 7)]
+    vectors = {
+        "mean_33": np.array([[1.0, 8.0], [5.0, 0.0], [2.0, 2.0]], dtype=np.float32),
+        "max_33": np.array([[1.0, 8.0], [5.0, 0.0], [2.0, 2.0]], dtype=np.float32),
+    }
+    [(combined_labels, combined)] = combine_windows([(labels, vectors)], {"a": 2, "b": 1}, POOLINGS_BY_NAME)
+
+    assert combined_labels == ["a", "b"]
+    np.testing.assert_allclose(combined["mean_33"], [[(10 * 1.0 + 30 * 5.0) / 40, (10 * 8.0) / 40], [2.0, 2.0]])
+    np.testing.assert_array_equal(combined["max_33"], [[5.0, 8.0], [2.0, 2.0]])
+    assert combined["mean_33"].dtype == np.float32
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 3, 100])
+def test_combine_windows_across_batches(batch_size):
+    sequences = {"a": "ACDEFGHIKLMNPQRSTVWYACDEF", "b": "MKTA", "c": "GGSSGGSSGGSS"}
+    pairs, num_windows = windowed_pairs(sequences.items(), 10, 3)
+    assert num_windows == {"a": 4, "b": 1, "c": 2}
+
+    window_vectors = {name: np.random.default_rng(0).normal(size=(len(pairs), 5)).astype(np.float32) for name in POOLINGS_BY_NAME}
+    # with small batches, the windows of one sequence are spread over several of them
+    results = [
+        ([label for label, _ in pairs[start:start + batch_size]], {name: vectors[start:start + batch_size] for name, vectors in window_vectors.items()})
+        for start in range(0, len(pairs), batch_size)
+    ]
+    combined = list(combine_windows(results, num_windows, POOLINGS_BY_NAME))
+
+    # each label comes out with the batch holding its last window
+    last_window = {label: idx for idx, ((label, _), _) in enumerate(pairs)}
+    assert [label for labels, _ in combined for label in labels] == sorted(sequences, key=last_window.get)
+    for labels, vectors in combined:
+        for row, label in enumerate(labels):
+            rows = [idx for idx, ((window_label, _), _) in enumerate(pairs) if window_label == label]
+            np.testing.assert_allclose(vectors["mean_33"][row], window_vectors["mean_33"][rows].mean(axis=0), rtol=1e-6)
+            np.testing.assert_array_equal(vectors["max_33"][row], window_vectors["max_33"][rows].max(axis=0))
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from emmautils import NameIndex, load_named_embeddings, select_embeddings
+
+NAMES = [">a", ">b", ">c", ">d", ">e"]
+
+
+@pytest.fixture
+def embeddings():
+    # row i is all i, so each row shows which name it belongs to
+    return np.repeat(np.arange(len(NAMES), dtype=np.float32)[:, None], 3, axis=1)
+
+
+def test_name_index():
+    index = NameIndex(NAMES)
+    assert len(index) == len(NAMES)
+    assert index[">c"] == 2
+    assert ">e" in index and "e" not in index
+    np.testing.assert_array_equal(index.rows([">e", ">a", ">c"]), [4, 0, 2])
+
+
+def test_name_index_strip_chars():
+    index = NameIndex(NAMES, strip_chars=">")
+    assert index["c"] == index[">c"] == 2
+    np.testing.assert_array_equal(index.rows(["d", ">b"]), [3, 1])
+
+
+def test_name_index_duplicates():
+    with pytest.raises(ValueError, match="more than once"):
+        NameIndex([">a", ">b", ">a"])
+    with pytest.raises(ValueError, match="more than once"):
+        NameIndex([">a", "a"], strip_chars=">")
+
+
+def test_name_index_missing_names():
+    with pytest.raises(KeyError, match="2 of the subset names are not in the index"):
+        NameIndex(NAMES).rows([">a", ">x", ">y"], what="subset names")
+
+
+def test_select_embeddings_keeps_subset_order(embeddings):
+    subset = [">d", ">a", ">e"]
+    selected = select_embeddings(embeddings, NameIndex(NAMES), subset)
+    # each name stays with its own embedding, in the order of the subset
+    np.testing.assert_array_equal(selected[:, 0], [NAMES.index(name) for name in subset])
+
+
+def test_select_embeddings_errors(embeddings):
+    with pytest.raises(KeyError, match="subset names"):
+        select_embeddings(embeddings, NameIndex(NAMES), [">a", ">x"])
+    with pytest.raises(ValueError, match="more than once"):
+        select_embeddings(embeddings, NameIndex(NAMES), [">a", ">a"])
+
+
+def test_load_named_embeddings(tmp_path, embeddings):
+    np.save(tmp_path / "embs.npy", embeddings)
+    (tmp_path / "names").write_text("".join(f"{name}\n" for name in NAMES))
+    loaded, index = load_named_embeddings(str(tmp_path / "embs.npy"), str(tmp_path / "names"))
+    np.testing.assert_array_equal(loaded, embeddings)
+    assert index.names == NAMES
+
+    (tmp_path / "short_names").write_text("".join(f"{name}\n" for name in NAMES[:-1]))
+    with pytest.raises(ValueError, match="4 names, but .* has 5 embeddings"):
+        load_named_embeddings(str(tmp_path / "embs.npy"), str(tmp_path / "short_names"))
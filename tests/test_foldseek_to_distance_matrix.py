@@ -0,0 +1,167 @@
+import io
+
+import numpy as np
+import pytest
+
+from distance_store import DistanceMatrix, KnnGraph, knn_graph_to_text, sparse_to_graph, text_to_binary, write_graph, write_sparse_text
+from emmautils import NameIndex
+from foldseek_to_distance_matrix import best_hits, read_foldseek_hits, read_m8_hits, structure_id_to_name, write_dense_text
+
+NAMES = [f"d{i}/1-100" for i in range(30)]
+MISSING_DISTANCE = 0.02
+
+
+@pytest.fixture
+def foldseek_file(tmp_path):
+    rng = np.random.default_rng(0)
+    lines = []
+    for _ in range(400):
+        query, target = rng.integers(len(NAMES), size=2)
+        # powers of two, so that 1/bitscore is the same in float32 and float64
+        bits = 2.0 ** rng.integers(2, 12)
+        lines.append(f"{NAMES[query]} {NAMES[target]} {bits}\n")
+    # hits both ways, self hits and hits of proteins that are not in the names
+    lines += [f"{NAMES[3]} {NAMES[7]} 8.0\n", f"{NAMES[7]} {NAMES[3]} 16.0\n", f"{NAMES[5]} {NAMES[5]} 4.0\n", f"{NAMES[5]} x/1-10 4.0\n"]
+    (tmp_path / "fs.out").write_text("".join(lines))
+    return str(tmp_path / "fs.out")
+
+
+def pair_loop_text(foldseek_file, names):
+    """The output of the pair-by-pair loop that best_hits() replaced"""
+    fs_list = {}
+    with open(foldseek_file, "r") as f:
+        for line in f:
+            line = line.rstrip().split()
+            fs_list[(line[0], line[1])] = line[2]
+    out = io.StringIO()
+    for i in range(len(names)):
+        for j in range(i, len(names)):
+            if names[i] == names[j]:
+                print(names[i], names[j], 0.0, file=out)
+            elif (names[i], names[j]) in fs_list:
+                print(names[i], names[j], 1 / float(fs_list[(names[i], names[j])]), file=out)
+            elif (names[j], names[i]) in fs_list:
+                print(names[i], names[j], 1 / float(fs_list[(names[j], names[i])]), file=out)
+            else:
+                print(names[i], names[j], MISSING_DISTANCE, file=out)
+    return out.getvalue()
+
+
+def test_best_hits_match_the_pair_loop(foldseek_file):
+    rows, cols, dists = best_hits(*read_foldseek_hits(foldseek_file, NameIndex(NAMES)), len(NAMES))
+    out = io.StringIO()
+    write_dense_text(out, NAMES, rows, cols, dists, MISSING_DISTANCE)
+
+    assert out.getvalue() == pair_loop_text(foldseek_file, NAMES)
+    assert np.all(rows < cols)
+    assert np.all(np.diff(rows * len(NAMES) + cols) > 0)
+
+
+def test_best_hits_prefers_the_forward_hit_then_the_last_one():
+    # pair (0, 1): a reverse hit after the forward ones; pair (1, 2): only reverse hits
+    queries = np.array([0, 1, 0, 1, 2, 2, 1, 1])
+    targets = np.array([1, 0, 1, 0, 1, 1, 1, 2])
+    bitscores = np.array([2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0])
+    rows, cols, dists = best_hits(queries, targets, bitscores, 3)
+
+    np.testing.assert_array_equal(rows, [0, 1])
+    np.testing.assert_array_equal(cols, [1, 2])
+    np.testing.assert_array_equal(dists, [1 / 8.0, 1 / 256.0])
+
+
+def parse_pairs(text):
+    return {
+        (name_a, name_b): np.float32(dist)
+        for name_a, name_b, dist in (line.split() for line in text.splitlines() if not line.startswith("#"))
+        if name_a != name_b
+    }
+
+
+def test_sparse_text_binary_round_trip(tmp_path, foldseek_file):
+    rows, cols, dists = best_hits(*read_foldseek_hits(foldseek_file, NameIndex(NAMES)), len(NAMES))
+    with open(tmp_path / "sparse.txt", "w") as g:
+        write_sparse_text(g, NAMES, rows, cols, dists, MISSING_DISTANCE)
+    dense = io.StringIO()
+    write_dense_text(dense, NAMES, rows, cols, dists, MISSING_DISTANCE)
+
+    # sparse text -> binary matrix: the pairs without a hit get the missing distance from the header
+    text_to_binary(str(tmp_path / "sparse.txt"), str(tmp_path / "dists.bin"), NAMES)
+    matrix = DistanceMatrix(str(tmp_path / "dists.bin"))
+    expected = np.full((len(NAMES), len(NAMES)), MISSING_DISTANCE, dtype=np.float32)
+    expected[rows, cols] = expected[cols, rows] = dists
+    np.fill_diagonal(expected, 0)
+    np.testing.assert_array_equal(matrix.submatrix(range(len(NAMES)), range(len(NAMES))), expected)
+
+    # the same pairs -> binary graph -> text
+    write_graph(str(tmp_path / "graph.bin"), NAMES, *sparse_to_graph(len(NAMES), rows, cols, dists), MISSING_DISTANCE)
+    graph = KnnGraph(str(tmp_path / "graph.bin"))
+    assert graph.missing_distance == pytest.approx(MISSING_DISTANCE)
+    np.testing.assert_array_equal(graph.submatrix(range(len(NAMES)), range(len(NAMES))), expected)
+    knn_graph_to_text(str(tmp_path / "graph.bin"), str(tmp_path / "graph.txt"))
+    graph_text = (tmp_path / "graph.txt").read_text()
+    sparse_text = (tmp_path / "sparse.txt").read_text()
+    assert graph_text.splitlines()[0] == sparse_text.splitlines()[0] == f"#missing_distance {MISSING_DISTANCE}"
+    assert parse_pairs(graph_text) == parse_pairs(sparse_text)
+    assert {pair: dist for pair, dist in parse_pairs(dense.getvalue()).items() if dist != np.float32(MISSING_DISTANCE)} == parse_pairs(sparse_text)
+
+
+@pytest.mark.parametrize("structure_id, name", [
+    ("A9B055p118-356.pdb", "A9B055/118-356"),
+    ("A9B055p118-356", "A9B055/118-356"),
+    ("Q9p1Ap5-100_120-150.pdb", "Q9p1A/5-100_120-150"),
+    ("1pdbA01", "1pdbA01"),
+    ("1pdbA01.pdb", "1pdbA01"),
+    ("Xp12p1-40", "Xp12/1-40"),
+])
+def test_structure_id_to_name(structure_id, name):
+    assert structure_id_to_name(structure_id) == name
+
+
+M8_NAMES = ["A9B055/118-356", "Q9p1A/5-100", "1pdbA01", "Xp12/1-40"]
+
+
+def write_m8(path, hits):
+    """Write (query, target, qlen, tlen, alnlen, bits) hits in the default column order"""
+    with open(path, "w") as f:
+        f.writelines("\t".join(str(field) for field in hit) + "\n" for hit in hits)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_lines", [1, 2, 1000])
+def test_read_m8_hits(tmp_path, caplog, chunk_lines):
+    m8_file = write_m8(tmp_path / "db.m8", [
+        ("A9B055p118-356.pdb", "Q9p1Ap5-100.pdb", 100, 200, 130, 50.0),
+        # only covers 0.6 of the target, which is not more than the minimum coverage
+        ("A9B055p118-356.pdb", "1pdbA01.pdb", 100, 200, 120, 40.0),
+        ("1pdbA01", "Xp12p1-40", 40, 40, 40, 30.0),
+        # structure IDs that are already names
+        ("Q9p1A/5-100", "A9B055/118-356", 100, 100, 61, 20.0),
+        ("unknownp1-50.pdb", "Xp12p1-40.pdb", 50, 40, 40, 10.0),
+    ])
+    with caplog.at_level("WARNING"):
+        queries, targets, bitscores = read_m8_hits(m8_file, NameIndex(M8_NAMES), chunk_lines=chunk_lines)
+
+    np.testing.assert_array_equal(queries, [0, 2, 1])
+    np.testing.assert_array_equal(targets, [1, 3, 0])
+    np.testing.assert_array_equal(bitscores, [50.0, 30.0, 20.0])
+    assert "1 structure ID(s)" in caplog.text and "unknownp1-50.pdb" in caplog.text
+
+
+def test_read_m8_hits_columns_and_coverage(tmp_path):
+    # a hit covering 0.7 of both sequences, with the columns in another order and an extra one
+    (tmp_path / "db.m8").write_text("0.9\t50.0\tA9B055p118-356\tQ9p1Ap5-100\t100\t100\t70\n")
+    columns = "evalue,bits,query,target,qlen,tlen,alnlen"
+    assert len(read_m8_hits(str(tmp_path / "db.m8"), NameIndex(M8_NAMES), columns, min_coverage=0.6)[0]) == 1
+    assert len(read_m8_hits(str(tmp_path / "db.m8"), NameIndex(M8_NAMES), columns, min_coverage=0.7)[0]) == 0
+
+    with pytest.raises(ValueError, match="no alnlen, tlen"):
+        read_m8_hits(str(tmp_path / "db.m8"), NameIndex(M8_NAMES), "query,target,qlen,bits")
+
+
+def test_read_m8_hits_empty_file(tmp_path):
+    (tmp_path / "db.m8").write_text("")
+    queries, targets, bitscores = read_m8_hits(str(tmp_path / "db.m8"), NameIndex(M8_NAMES))
+
+    assert len(queries) == len(targets) == len(bitscores) == 0
+    rows, cols, dists = best_hits(queries, targets, bitscores, len(M8_NAMES))
+    assert len(rows) == len(cols) == len(dists) == 0
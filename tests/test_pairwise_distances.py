@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+
+from distance_store import BinaryRowsWriter, DistanceMatrix, KnnGraph, write_knn_graph
+from pairwise_distances import (
+    append_to_distance_matrix,
+    distance_block,
+    format_upper_triangle_text,
+    iter_upper_triangle_rows,
+    knn_graph,
+)
+
+
+def brute_force_distances(rows, cols):
+    return np.array([[np.linalg.norm(row - col) for col in cols] for row in rows])
+
+
+def random_embeddings(num_rows, embedding_size=32, dtype=np.float32, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(num_rows, embedding_size)).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_distance_block_matches_norm(dtype):
+    rows = random_embeddings(17, dtype=dtype, seed=1)
+    cols = random_embeddings(23, dtype=dtype, seed=2)
+    block = distance_block(rows, cols)
+    assert block.dtype == dtype
+    np.testing.assert_allclose(block, brute_force_distances(rows, cols), rtol=1e-5 if dtype == np.float32 else 1e-12)
+
+
+def test_distance_block_near_duplicates_match_norm():
+    rows = random_embeddings(10) * 1000
+    # near-duplicates lose every digit to cancellation in the norm identity
+    cols = np.concatenate([rows, rows + np.float32(1e-3)])
+    block = distance_block(rows, cols)
+    expected = brute_force_distances(rows, cols).astype(np.float32)
+    assert np.all(np.diag(block[:, :10]) == 0)
+    np.testing.assert_allclose(block, expected, rtol=1e-4)
+
+
+def test_upper_triangle_text_has_float32_precision():
+    embeddings = random_embeddings(6)
+    names = [f">s{i}" for i in range(len(embeddings))]
+    text = "".join(format_upper_triangle_text(names, start, strip) for start, strip in iter_upper_triangle_rows(embeddings))
+    lines = [line.split() for line in text.splitlines()]
+    expected = brute_force_distances(embeddings, embeddings).astype(np.float32)
+
+    assert [(a, b) for a, b, _ in lines] == [(names[i], names[j]) for i in range(6) for j in range(i, 6)]
+    for a, b, dist in lines:
+        value = np.float32(dist)
+        # written as the shortest string of the float32, as str() of a numpy float32 is
+        assert dist == str(value)
+        assert value == pytest.approx(expected[names.index(a), names.index(b)], rel=1e-5)
+
+
+def brute_force_knn(embeddings, k):
+    dists = np.array([np.linalg.norm(embeddings - row, axis=1) for row in embeddings])
+    np.fill_diagonal(dists, np.inf)
+    neighbours = np.argsort(dists, axis=1, kind="stable")[:, :k]
+    return neighbours, np.take_along_axis(dists, neighbours, axis=1)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_knn_graph_matches_brute_force(num_workers):
+    # enough rows for several strips, and tiles within each strip, at a 1MB budget
+    embeddings = random_embeddings(2000, embedding_size=8)
+    neighbours, distances = knn_graph(embeddings, 5, num_workers=num_workers, memory_budget_mb=1)
+    expected_neighbours, expected_distances = brute_force_knn(embeddings, 5)
+
+    np.testing.assert_array_equal(neighbours, expected_neighbours)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-5)
+
+
+def test_knn_graph_cutoff():
+    embeddings = random_embeddings(50, embedding_size=4)
+    expected_neighbours, expected_distances = brute_force_knn(embeddings, 8)
+    cutoff = float(np.median(expected_distances))
+    neighbours, distances = knn_graph(embeddings, 8, cutoff=cutoff)
+
+    within = expected_distances <= cutoff
+    np.testing.assert_array_equal(neighbours, np.where(within, expected_neighbours, -1))
+    assert np.all(np.isinf(distances[~within]))
+
+
+def test_knn_graph_file_lookups(tmp_path):
+    embeddings = random_embeddings(30, embedding_size=4)
+    names = [f">s{i}" for i in range(len(embeddings))]
+    neighbours, distances = knn_graph(embeddings, 3, cutoff=2.0)
+    write_knn_graph(str(tmp_path / "knn.bin"), names, neighbours, distances, 2.0)
+    graph = KnnGraph(str(tmp_path / "knn.bin"))
+
+    full = brute_force_distances(embeddings, embeddings).astype(np.float32)
+    in_graph = np.zeros(full.shape, dtype=bool)
+    for i, row in enumerate(neighbours):
+        in_graph[i, row[row >= 0]] = in_graph[row[row >= 0], i] = True
+    np.fill_diagonal(in_graph, True)
+    expected = np.where(in_graph, full, np.float32(2.0))
+    np.fill_diagonal(expected, 0)
+
+    lookups = np.array([[graph.distance(i, j) for j in range(len(names))] for i in range(len(names))], dtype=np.float32)
+    np.testing.assert_allclose(lookups, expected, rtol=1e-5)
+    np.testing.assert_array_equal(graph.submatrix(range(len(names)), range(len(names))), lookups)
+    np.testing.assert_array_equal(graph.submatrix([4, 1, 4], [0, 29, 1]), lookups[np.ix_([4, 1, 4], [0, 29, 1])])
+
+
+def write_matrix(path, embeddings, names):
+    with BinaryRowsWriter(path, names) as writer:
+        for start, strip in iter_upper_triangle_rows(embeddings):
+            writer.add_rows(start, strip)
+    return DistanceMatrix(path)
+
+
+@pytest.mark.parametrize("drop_removed", [False, True])
+def test_append_matches_full_recompute(tmp_path, drop_removed):
+    embeddings = random_embeddings(40, embedding_size=8)
+    names = [f">s{i}" for i in range(len(embeddings))]
+    # the old matrix has the first 25 names (and, to drop, two names that are gone)
+    old_rows = list(range(25))
+    old_names = [names[i] for i in old_rows]
+    old_embeddings = embeddings[old_rows]
+    if drop_removed:
+        old_names = old_names[:10] + [">gone0"] + old_names[10:] + [">gone1"]
+        old_embeddings = np.concatenate([old_embeddings[:10], random_embeddings(1, 8, seed=3), old_embeddings[10:], random_embeddings(1, 8, seed=4)])
+    old_matrix = write_matrix(str(tmp_path / "old.bin"), old_embeddings, old_names)
+
+    # the new names come in a different order from the old ones
+    order = np.random.default_rng(5).permutation(len(names))
+    out_names = append_to_distance_matrix(
+        old_matrix,
+        str(tmp_path / "new.bin"),
+        embeddings[order],
+        [names[i] for i in order],
+        drop_removed=drop_removed,
+        memory_budget_mb=1,
+    )
+
+    assert out_names == names[:25] + [names[i] for i in order if i >= 25]
+    appended = DistanceMatrix(str(tmp_path / "new.bin"))
+    recomputed = write_matrix(str(tmp_path / "full.bin"), embeddings[[names.index(name) for name in out_names]], out_names)
+    assert appended.names == out_names
+    np.testing.assert_allclose(appended.condensed, recomputed.condensed, rtol=1e-6)
+
+
+def test_append_without_embeddings_for_old_names(tmp_path):
+    embeddings = random_embeddings(10, embedding_size=8)
+    names = [f">s{i}" for i in range(len(embeddings))]
+    old_matrix = write_matrix(str(tmp_path / "old.bin"), embeddings, names)
+    with pytest.raises(ValueError, match="1 name"):
+        append_to_distance_matrix(old_matrix, str(tmp_path / "new.bin"), embeddings[1:], names[1:])
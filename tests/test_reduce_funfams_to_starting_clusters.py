@@ -0,0 +1,106 @@
+import os
+import threading
+
+import pytest
+
+from emmautils import CdhitClusters, FastaOffsetIndex
+from reduce_funfams_to_starting_clusters import WORKING_FILE_RE, next_working_number, reduce_funfams, write_working_file
+
+CLUSTERS = {
+    "c0": ["s1", "s2"],
+    "c1": ["s3"],
+    "c2": ["s4", "s5", "s6"],
+}
+SEQUENCES = {f"s{i}": "MKTAYIAKQR"[:i + 3] for i in range(1, 7)}
+# the members of the clusters in each FunFam alignment
+FUNFAMS = {
+    "n0de_0.aln": ["s1", "s2", "s3"],
+    "n0de_1.aln": ["s4", "s5"],
+    "n0de_2.aln": ["s6", "s3", "s1"],
+}
+
+
+@pytest.fixture
+def clusters_and_sequences(tmp_path):
+    with open(tmp_path / "all.clstr", "w") as f:
+        for cluster_id, members in CLUSTERS.items():
+            f.write(f">Cluster {cluster_id}\n")
+            for i, seq_id in enumerate(members):
+                f.write(f"{i}\t10aa, >{seq_id}... {'*' if i == 0 else 'at 95.00%'}\n")
+    (tmp_path / "all.faa").write_text("".join(f">{seq_id}\n{seq}\n" for seq_id, seq in SEQUENCES.items()))
+    return CdhitClusters.read(str(tmp_path / "all.clstr")), FastaOffsetIndex(str(tmp_path / "all.faa"))
+
+
+@pytest.fixture
+def funfam_dir(tmp_path):
+    (tmp_path / "funfams").mkdir()
+    for funfam, members in FUNFAMS.items():
+        (tmp_path / "funfams" / funfam).write_text("".join(f">{member}\n-{SEQUENCES[member]}-\n" for member in members))
+    (tmp_path / "funfams" / "notes.txt").write_text("not a FunFam\n")
+    return str(tmp_path / "funfams")
+
+
+def expected_starting_cluster(funfam):
+    # only the cluster centers, without gaps
+    centers = {members[0] for members in CLUSTERS.values()}
+    return "".join(f">{member}\n{SEQUENCES[member]}\n" for member in FUNFAMS[funfam] if member in centers)
+
+
+def working_numbers(out_dir):
+    return sorted(int(match.group(1)) for match in map(WORKING_FILE_RE.match, os.listdir(out_dir)) if match)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_reduce_funfams_numbers_on_from_existing_files(tmp_path, clusters_and_sequences, funfam_dir, num_workers):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    for number in (1, 2, 3):
+        (out_dir / f"working_{number}.faa").write_text(f">old{number}\nMK\n")
+    (out_dir / "working_x.faa").write_text(">not numbered\nMK\n")
+
+    # two runs into the same directory
+    first = reduce_funfams(funfam_dir, str(out_dir), *clusters_and_sequences, num_workers=num_workers)
+    second = reduce_funfams(funfam_dir, str(out_dir), *clusters_and_sequences, num_workers=num_workers)
+
+    assert first == [4, 5, 6] and second == [7, 8, 9]
+    # unique numbers without gaps, and the old files untouched
+    assert working_numbers(out_dir) == list(range(1, 10))
+    assert (out_dir / "working_2.faa").read_text() == ">old2\nMK\n"
+    for numbers in (first, second):
+        for number, funfam in zip(numbers, sorted(FUNFAMS)):
+            assert (out_dir / f"working_{number}.faa").read_text() == expected_starting_cluster(funfam)
+    # no temporary files are left behind
+    assert sorted(os.listdir(out_dir)) == sorted([f"working_{number}.faa" for number in range(1, 10)] + ["working_x.faa"])
+
+
+def test_write_working_file_skips_taken_numbers(tmp_path):
+    for number in (1, 2, 4):
+        (tmp_path / f"working_{number}.faa").write_text("taken\n")
+    assert next_working_number(str(tmp_path)) == 5
+
+    # as when another run takes the numbers after this one looked
+    assert write_working_file(str(tmp_path), ">a\nMK\n", 2) == 3
+    assert write_working_file(str(tmp_path), ">b\nMK\n", 4) == 5
+    assert (tmp_path / "working_3.faa").read_text() == ">a\nMK\n"
+    assert (tmp_path / "working_4.faa").read_text() == "taken\n"
+    assert sorted(os.listdir(tmp_path)) == [f"working_{number}.faa" for number in range(1, 6)]
+
+
+def test_concurrent_writers_never_share_a_number(tmp_path):
+    numbers = []
+
+    def write_files(writer):
+        for i in range(50):
+            # the writers look up the next number at the same time, so they race for the same ones
+            numbers.append(write_working_file(str(tmp_path), f">{writer}_{i}\nMK\n", next_working_number(str(tmp_path))))
+
+    writers = [threading.Thread(target=write_files, args=(writer,)) for writer in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    assert sorted(numbers) == list(range(1, 201))
+    assert working_numbers(tmp_path) == list(range(1, 201))
+    texts = [(tmp_path / f"working_{number}.faa").read_text() for number in range(1, 201)]
+    assert len(set(texts)) == 200
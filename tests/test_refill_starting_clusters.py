@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from emmautils import CdhitClusters, FastaOffsetIndex
+from refill_starting_clusters_embedding_gemma_faster import copy_tree_files, refill_tree
+
+CLUSTERS = {
+    "c0": ["s1", "s2", "s3"],
+    "c1": ["s4"],
+    "c2": ["s5", "s6"],
+}
+SEQUENCES = {f"s{i}": "MKTAYIAKQR"[:i + 3] for i in range(1, 7)}
+# the centers (first members) of the clusters in each alignment of the tree
+ALIGNMENTS = {
+    "starting_cluster_alignments/1.faa": ["c0"],
+    "starting_cluster_alignments/2.faa": ["c1"],
+    "starting_cluster_alignments/3.faa": ["c2"],
+    "merge_node_alignments/n0de_a.faa": ["c2", "c0"],
+    "merge_node_alignments/n0de_b.faa": ["c2", "c0", "c1"],
+}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    with open(tmp_path / "all.clstr", "w") as f:
+        for cluster_id, members in CLUSTERS.items():
+            f.write(f">Cluster {cluster_id}\n")
+            for i, seq_id in enumerate(members):
+                f.write(f"{i}\t10aa, >{seq_id}... {'*' if i == 0 else 'at 95.00%'}\n")
+    with open(tmp_path / "all.faa", "w") as f:
+        # sequences split over several lines, as written by other tools
+        f.write("".join(f">{seq_id} some description\n{seq[:4]}\n{seq[4:]}\n" for seq_id, seq in SEQUENCES.items()))
+
+    treedir = tmp_path / "tree"
+    for alignment, cluster_ids in ALIGNMENTS.items():
+        os.makedirs(treedir / os.path.dirname(alignment), exist_ok=True)
+        # only the centers, with alignment gaps
+        (treedir / alignment).write_text("".join(f">{CLUSTERS[cluster_id][0]}\n--{SEQUENCES[CLUSTERS[cluster_id][0]]}\n" for cluster_id in cluster_ids))
+    (treedir / "tree.trace").write_text("1\t2\t3\t0.5\n")
+    (treedir / "tree.newick").write_text("((1,2),3);\n")
+    return tmp_path
+
+
+def expected_alignment(cluster_ids):
+    return "".join(f">{seq_id} some description\n{SEQUENCES[seq_id]}\n" for cluster_id in cluster_ids for seq_id in CLUSTERS[cluster_id])
+
+
+def refill(tree, num_workers=1, link="copy"):
+    clusters = CdhitClusters.read(str(tree / "all.clstr"))
+    sequences = FastaOffsetIndex(str(tree / "all.faa"))
+    copy_tree_files(str(tree / "tree"), str(tree / "out"), link)
+    refill_tree(str(tree / "tree"), str(tree / "out"), clusters, sequences, num_workers, link)
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_refill_writes_all_cluster_members(tree, num_workers):
+    os.makedirs(tree / "out")
+    refill(tree, num_workers)
+
+    for alignment, cluster_ids in ALIGNMENTS.items():
+        assert (tree / "out" / alignment).read_text() == expected_alignment(cluster_ids)
+    assert (tree / "out" / "tree.trace").read_text() == (tree / "tree" / "tree.trace").read_text()
+    assert sorted(os.listdir(tree / "out")) == ["merge_node_alignments", "starting_cluster_alignments", "tree.newick", "tree.trace"]
+
+
+def test_refill_replaces_files_atomically(tree):
+    os.makedirs(tree / "out" / "merge_node_alignments")
+    (tree / "out" / "merge_node_alignments" / "n0de_a.faa").write_text("stale\n")
+    # a reader that opened the old file keeps seeing it whole, as it is replaced rather than rewritten
+    os.link(tree / "out" / "merge_node_alignments" / "n0de_a.faa", tree / "old_n0de_a.faa")
+    refill(tree)
+
+    assert (tree / "old_n0de_a.faa").read_text() == "stale\n"
+    assert (tree / "out" / "merge_node_alignments" / "n0de_a.faa").read_text() == expected_alignment(["c2", "c0"])
+    # no temporary files are left behind
+    for alignment_dir in ("starting_cluster_alignments", "merge_node_alignments"):
+        assert sorted(os.listdir(tree / "out" / alignment_dir)) == sorted(
+            os.path.basename(alignment) for alignment in ALIGNMENTS if alignment.startswith(alignment_dir)
+        )
+
+
+@pytest.mark.parametrize("link", ["copy", "hardlink", "symlink"])
+def test_link_modes(tree, link):
+    # an alignment with exactly the clusters of another one, the only kind that is linked
+    (tree / "tree" / "merge_node_alignments" / "n0de_c.faa").write_text(
+        (tree / "tree" / "merge_node_alignments" / "n0de_a.faa").read_text()
+    )
+    os.makedirs(tree / "out")
+    refill(tree, link=link)
+
+    tree_file, out_tree_file = tree / "tree" / "tree.trace", tree / "out" / "tree.trace"
+    first, duplicate = tree / "out" / "merge_node_alignments" / "n0de_a.faa", tree / "out" / "merge_node_alignments" / "n0de_c.faa"
+    assert duplicate.read_text() == first.read_text() == expected_alignment(["c2", "c0"])
+    assert out_tree_file.read_text() == tree_file.read_text()
+    assert os.path.islink(out_tree_file) == os.path.islink(duplicate) == (link == "symlink")
+    assert os.path.samefile(out_tree_file, tree_file) == os.path.samefile(duplicate, first) == (link != "copy")
+    if link == "symlink":
+        # relative links, so the output tree can be moved with its input
+        assert os.readlink(duplicate) == "n0de_a.faa"
+        assert not os.path.isabs(os.readlink(out_tree_file))
+    # alignments with different clusters are always written out
+    assert not os.path.samefile(tree / "out" / "merge_node_alignments" / "n0de_b.faa", first)
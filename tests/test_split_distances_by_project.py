@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+import split_distances_by_project
+from distance_store import DistanceMatrix, format_distances, text_to_binary
+from split_distances_by_project import project_members, split_binary, split_text
+
+NAMES = [f">s{i}" for i in range(8)]
+# starting clusters of each project: s2 is in both projects, s5 to s7 in neither
+PROJECTS = {
+    "p1": {"1": ["s0", "s1"], "2": ["s2"]},
+    "p2": {"1": ["s4", "s2"], "3": ["s3"]},
+}
+
+
+@pytest.fixture
+def projects_of_name(tmp_path):
+    for project, starting_clusters in PROJECTS.items():
+        (tmp_path / "starting_clusters" / project).mkdir(parents=True)
+        for cluster_id, members in starting_clusters.items():
+            (tmp_path / "starting_clusters" / project / f"{cluster_id}.faa").write_text(
+                "".join(f">{member}\nMKTAY\n" for member in members)
+            )
+    return project_members(list(PROJECTS), str(tmp_path / "starting_clusters"))
+
+
+@pytest.fixture
+def full_matrix():
+    rng = np.random.default_rng(0)
+    dists = rng.uniform(size=(len(NAMES), len(NAMES))).astype(np.float32)
+    return np.triu(dists, 1) + np.triu(dists, 1).T
+
+
+def write_text(path, full_matrix, header=""):
+    with open(path, "w") as f:
+        f.write(header)
+        for i in range(len(NAMES)):
+            for j, dist in zip(range(i, len(NAMES)), format_distances(full_matrix[i, i:])):
+                f.write(f"{NAMES[i]} {NAMES[j]} {dist}\n")
+
+
+def project_pairs(project):
+    members = sorted(int(member[1:]) for starting_cluster in PROJECTS[project].values() for member in starting_cluster)
+    return [(i, j) for a, i in enumerate(members) for j in members[a:]]
+
+
+def read_pairs(path):
+    with open(path) as f:
+        return [tuple(line.split()) for line in f if not line.startswith("#")]
+
+
+def test_project_members(projects_of_name):
+    assert projects_of_name == {"s0": ["p1"], "s1": ["p1"], "s2": ["p1", "p2"], "s3": ["p2"], "s4": ["p2"]}
+
+
+@pytest.mark.parametrize("header", ["", "#missing_distance 1.5\n"])
+def test_split_text(tmp_path, monkeypatch, projects_of_name, full_matrix, header):
+    # flush part way through, as for a large file
+    monkeypatch.setattr(split_distances_by_project, "BUFFER_LINES", 2)
+    write_text(str(tmp_path / "emb"), full_matrix, header)
+    num_pairs = split_text(str(tmp_path / "emb"), list(PROJECTS), projects_of_name, str(tmp_path))
+
+    for project in PROJECTS:
+        expected = [(NAMES[i], NAMES[j], str(full_matrix[i, j])) for i, j in project_pairs(project)]
+        assert read_pairs(tmp_path / f"embs.{project}") == expected
+        assert num_pairs[project] == len(expected)
+        # the missing distance is kept for the pairs that the file leaves out
+        assert (tmp_path / f"embs.{project}").read_text().startswith(header)
+
+
+def test_split_binary_to_text_matches_split_text(tmp_path, projects_of_name, full_matrix):
+    write_text(str(tmp_path / "emb"), full_matrix)
+    text_to_binary(str(tmp_path / "emb"), str(tmp_path / "dists.bin"))
+    (tmp_path / "from_text").mkdir()
+    (tmp_path / "from_binary").mkdir()
+    text_pairs = split_text(str(tmp_path / "emb"), list(PROJECTS), projects_of_name, str(tmp_path / "from_text"))
+    binary_pairs = split_binary(str(tmp_path / "dists.bin"), list(PROJECTS), projects_of_name, str(tmp_path / "from_binary"), "text")
+
+    assert binary_pairs == text_pairs
+    for project in PROJECTS:
+        assert (tmp_path / "from_binary" / f"embs.{project}").read_text() == (tmp_path / "from_text" / f"embs.{project}").read_text()
+
+
+def test_split_binary_to_binary(tmp_path, projects_of_name, full_matrix):
+    write_text(str(tmp_path / "emb"), full_matrix)
+    text_to_binary(str(tmp_path / "emb"), str(tmp_path / "dists.bin"))
+    num_pairs = split_binary(str(tmp_path / "dists.bin"), list(PROJECTS), projects_of_name, str(tmp_path), "binary")
+
+    for project in PROJECTS:
+        matrix = DistanceMatrix(str(tmp_path / f"embs.{project}.bin"))
+        rows = sorted({i for pair in project_pairs(project) for i in pair})
+        assert matrix.names == [NAMES[i] for i in rows]
+        assert num_pairs[project] == len(project_pairs(project))
+        np.testing.assert_array_equal(matrix.submatrix(range(len(rows)), range(len(rows))), full_matrix[np.ix_(rows, rows)])